@@ -13,11 +13,12 @@ from pytorch3d.ops import knn_points, knn_gather
 from pytorch3d.ops.knn import _KNN
 import frnn
 from ..utils.mathHelper import eps_denom, estimate_pointcloud_local_coord_frames, estimate_pointcloud_normals
-from ..utils import mask_from_padding
+from ..utils import (mask_from_padding, num_points_2_cloud_to_packed_first_idx,
+                     num_points_2_packed_to_cloud_idx)
 from .. import logger_py
 
 
-__all__ = ["PointClouds3D", "PointCloudsFilters"]
+__all__ = ["PointClouds3D", "PackedPointClouds", "PointCloudsFilters"]
 
 
 class PointClouds3D(PytorchPointClouds):
@@ -279,6 +280,180 @@ class PointClouds3D(PytorchPointClouds):
         return other
 
 
+class PackedPointClouds(object):
+    """
+    Lightweight point clouds defined by the packed points, normals and features
+    and the number of points of each cloud, the padded tensors are only created
+    on demand. A subset of the points is selected with masked_select in O(P)
+    without rebuilding the point clouds from per-cloud lists.
+    Implements the part of the Pointclouds interface used by the rasterizer.
+    """
+
+    def __init__(self, points_packed, num_points_per_cloud, normals_packed=None,
+                 features_packed=None, packed_to_cloud_idx=None, max_points=None):
+        """
+        Args:
+            points_packed (P, 3)
+            num_points_per_cloud (N,)
+            normals_packed (P, 3)
+            features_packed (P, C)
+            packed_to_cloud_idx (P,): computed from num_points_per_cloud if not given
+            max_points (int): size of the padded tensors, an upper bound of
+                num_points_per_cloud which avoids a host synchronization
+                to compute the maximum
+        """
+        self.device = points_packed.device
+        self._N = num_points_per_cloud.shape[0]
+        self._points_packed = points_packed
+        self._normals_packed = normals_packed
+        self._features_packed = features_packed
+        self._num_points_per_cloud = num_points_per_cloud
+        self._cloud_to_packed_first_idx = num_points_2_cloud_to_packed_first_idx(
+            num_points_per_cloud)
+        if packed_to_cloud_idx is None:
+            packed_to_cloud_idx = num_points_2_packed_to_cloud_idx(
+                num_points_per_cloud, points_packed.shape[0])
+        self._packed_to_cloud_idx = packed_to_cloud_idx
+        self._max_P = max_points
+        self._padded_to_packed_idx = None
+        self._points_padded = None
+        self._normals_padded = None
+        self._features_padded = None
+
+    @classmethod
+    def from_point_clouds(cls, point_clouds):
+        """ Packed view of a Pointclouds object """
+        return cls(point_clouds.points_packed(), point_clouds.num_points_per_cloud(),
+                   normals_packed=point_clouds.normals_packed(),
+                   features_packed=point_clouds.features_packed(),
+                   packed_to_cloud_idx=point_clouds.packed_to_cloud_idx(),
+                   max_points=point_clouds.points_padded().shape[1])
+
+    def __len__(self):
+        return self._N
+
+    def isempty(self):
+        return self._N == 0 or self._points_packed.shape[0] == 0
+
+    def points_packed(self):
+        return self._points_packed
+
+    def normals_packed(self):
+        return self._normals_packed
+
+    def features_packed(self):
+        return self._features_packed
+
+    def num_points_per_cloud(self):
+        return self._num_points_per_cloud
+
+    def cloud_to_packed_first_idx(self):
+        return self._cloud_to_packed_first_idx
+
+    def packed_to_cloud_idx(self):
+        return self._packed_to_cloud_idx
+
+    def _max_points(self):
+        if self._max_P is None:
+            self._max_P = int(self._num_points_per_cloud.max()) if self._N > 0 else 0
+        return self._max_P
+
+    def padded_to_packed_idx(self):
+        """ (P,) index of the packed points in the flattened (N*max_P) padded points """
+        if self._padded_to_packed_idx is None:
+            local_idx = torch.arange(self._packed_to_cloud_idx.shape[0], device=self.device) - \
+                self._cloud_to_packed_first_idx[self._packed_to_cloud_idx]
+            self._padded_to_packed_idx = self._packed_to_cloud_idx * self._max_points() + local_idx
+        return self._padded_to_packed_idx
+
+    def _packed_to_padded(self, packed):
+        padded = packed.new_zeros((self._N * self._max_points(), ) + packed.shape[1:])
+        padded = padded.index_copy(0, self.padded_to_packed_idx(), packed)
+        return padded.view((self._N, self._max_points()) + packed.shape[1:])
+
+    def points_padded(self):
+        if self._points_padded is None:
+            self._points_padded = self._packed_to_padded(self._points_packed)
+        return self._points_padded
+
+    def normals_padded(self):
+        if self._normals_padded is None and self._normals_packed is not None:
+            self._normals_padded = self._packed_to_padded(self._normals_packed)
+        return self._normals_padded
+
+    def features_padded(self):
+        if self._features_padded is None and self._features_packed is not None:
+            self._features_padded = self._packed_to_padded(self._features_packed)
+        return self._features_padded
+
+    def points_list(self):
+        return list(self._points_packed.split(self._num_points_per_cloud.tolist(), 0))
+
+    def normals_list(self):
+        if self._normals_packed is None:
+            return None
+        return list(self._normals_packed.split(self._num_points_per_cloud.tolist(), 0))
+
+    def features_list(self):
+        if self._features_packed is None:
+            return None
+        return list(self._features_packed.split(self._num_points_per_cloud.tolist(), 0))
+
+    def masked_select(self, mask):
+        """
+        Select the points of the (P,) packed boolean mask, the clouds stay
+        in the same order (even if empty). The padded size is kept.
+        Returns:
+            PackedPointClouds
+        """
+        packed_to_cloud_idx = self._packed_to_cloud_idx[mask]
+        num_points_per_cloud = torch.zeros_like(self._num_points_per_cloud).scatter_add_(
+            0, self._packed_to_cloud_idx, mask.to(dtype=self._num_points_per_cloud.dtype))
+        normals_packed = features_packed = None
+        if self._normals_packed is not None:
+            normals_packed = self._normals_packed[mask]
+        if self._features_packed is not None:
+            features_packed = self._features_packed[mask]
+        return self.__class__(self._points_packed[mask], num_points_per_cloud,
+                              normals_packed=normals_packed, features_packed=features_packed,
+                              packed_to_cloud_idx=packed_to_cloud_idx, max_points=self._max_P)
+
+    def index_select(self, index, num_points_per_cloud, packed_to_cloud_idx=None,
+                     max_points=None):
+        """
+        New point clouds made of the packed points at index, e.g. to repeat the
+        clouds, with num_points_per_cloud points in each cloud
+        Returns:
+            PackedPointClouds
+        """
+        normals_packed = features_packed = None
+        if self._normals_packed is not None:
+            normals_packed = self._normals_packed[index]
+        if self._features_packed is not None:
+            features_packed = self._features_packed[index]
+        return self.__class__(self._points_packed[index], num_points_per_cloud,
+                              normals_packed=normals_packed, features_packed=features_packed,
+                              packed_to_cloud_idx=packed_to_cloud_idx, max_points=max_points)
+
+    def update_padded(self, new_points_padded):
+        """
+        Point clouds with the same normals and features but new (N, max_P, 3)
+        padded points
+        """
+        points_packed = new_points_padded.reshape(
+            (-1, ) + new_points_padded.shape[2:])[self.padded_to_packed_idx()]
+        other = self.__class__(points_packed, self._num_points_per_cloud,
+                               normals_packed=self._normals_packed,
+                               features_packed=self._features_packed,
+                               packed_to_cloud_idx=self._packed_to_cloud_idx,
+                               max_points=new_points_padded.shape[1])
+        other._padded_to_packed_idx = self._padded_to_packed_idx
+        other._points_padded = new_points_padded
+        other._normals_padded = self._normals_padded
+        other._features_padded = self._features_padded
+        return other
+
+
 true_tensor = torch.tensor([True], dtype=torch.bool).view(1, 1)
 
 
@@ -0,0 +1,109 @@
+"""
+Native weighted sum compositing of the rasterized points
+"""
+import torch
+import torch.nn as nn
+import torch.autograd as autograd
+from ..utils.profiling import profiled
+from .. import _C
+
+__all__ = ['weighted_sum', 'norm_weighted_sum', 'WeightedCompositor', 'NormWeightedCompositor']
+
+
+class _CompositeWeightedSumPoints(autograd.Function):
+    """
+    Composite features within a z-buffer using a weighted sum, optionally
+    normalized by the sum of the weights of each pixel.
+    Differentiable w.r.t. both the features and the weights (alphas).
+    """
+    @staticmethod
+    def forward(ctx, features, alphas, points_idx, normalize: bool = False):
+        """
+        Args:
+            features (C, P): packed features
+            alphas (N, K, H, W): weights of the points of each pixel
+            points_idx (N, K, H, W): packed point indices of each pixel, -1 if
+                no point
+        Returns:
+            images (N, C, H, W)
+        """
+        pt_cld = _C._weighted_sum(features, alphas, points_idx, normalize)
+
+        ctx.normalize = normalize
+        ctx.save_for_backward(features, alphas, points_idx)
+        return pt_cld
+
+    @staticmethod
+    @profiled('composite_backward')
+    def backward(ctx, grad_output):
+        features, alphas, points_idx = ctx.saved_tensors
+        grad_features = None
+        grad_alphas = None
+        # the alphas usually do not need gradients, e.g. in the renderer the
+        # qvalues are not differentiable and the scalers are detached
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[1]:
+            grad_features, grad_alphas = _C._weighted_sum_backward(
+                grad_output.contiguous(), features, alphas, points_idx, ctx.normalize,
+                ctx.needs_input_grad[0], ctx.needs_input_grad[1])
+        if not ctx.needs_input_grad[0]:
+            grad_features = None
+        if not ctx.needs_input_grad[1]:
+            grad_alphas = None
+        return grad_features, grad_alphas, None, None
+
+
+def weighted_sum(pointsidx, alphas, pt_clds, normalize: bool = False) -> torch.Tensor:
+    """
+    Composite features within a z-buffer using a weighted sum.
+    Args:
+        pointsidx (N, K, H, W): packed point indices of each pixel, -1 if no point
+        alphas (N, K, H, W): weights of the points of each pixel
+        pt_clds (C, P): packed features
+        normalize (bool): divide by the sum of the weights of each pixel
+    Returns:
+        images (N, C, H, W)
+    """
+    return _CompositeWeightedSumPoints.apply(pt_clds, alphas, pointsidx.long(), normalize)
+
+
+def norm_weighted_sum(pointsidx, alphas, pt_clds) -> torch.Tensor:
+    """
+    Composite features within a z-buffer using a weighted sum normalized by
+    the sum of the weights of each pixel (clamped to 1e-4).
+    """
+    return weighted_sum(pointsidx, alphas, pt_clds, normalize=True)
+
+
+def _add_background_color(pix_idxs, images, background_color):
+    """
+    Set the pixels of (N, C, H, W) images without points to background_color
+    """
+    background_mask = pix_idxs[:, 0] < 0  # (N, H, W)
+    background_color = images.new_tensor(background_color).view(1, -1, 1, 1)
+    return torch.where(background_mask.unsqueeze(1), background_color, images)
+
+
+class WeightedCompositor(nn.Module):
+    """
+    Accumulate points using a weighted sum, drop-in replacement of
+    the compositors of pytorch3d.
+    """
+    normalize = False
+
+    def __init__(self, background_color=None):
+        super().__init__()
+        self.background_color = background_color
+
+    def forward(self, fragments, alphas, ptclds, **kwargs) -> torch.Tensor:
+        background_color = kwargs.get("background_color", self.background_color)
+        images = weighted_sum(fragments, alphas, ptclds, normalize=self.normalize)
+        if background_color is not None:
+            images = _add_background_color(fragments, images, background_color)
+        return images
+
+
+class NormWeightedCompositor(WeightedCompositor):
+    """
+    Accumulate points using a weighted sum normalized by the sum of the weights.
+    """
+    normalize = True
@@ -2,7 +2,7 @@
 Surface Splatting Rasterizer
 
 """
-from typing import NamedTuple, Optional
+from typing import NamedTuple, Optional, Tuple, Union
 
 import torch
 import torch.autograd as autograd
@@ -15,10 +15,13 @@ from pytorch3d.renderer import (PointsRasterizationSettings,
                                 )
 from pytorch3d.renderer.points.rasterize_points import kMaxPointsPerBin
 import frnn
-from .cloud import PointClouds3D
-from ..utils import gather_with_neg_idx, gather_batch_to_packed, get_per_point_visibility_mask, num_points_2_cloud_to_packed_first_idx
-from ..utils.mathHelper import eps_denom, eps_sqrt, to_homogen, estimate_pointcloud_local_coord_frames
-from .. import _C, logger_py
+from .cloud import PointClouds3D, PackedPointClouds
+from ..utils import (gather_with_neg_idx, gather_batch_to_packed, get_per_point_visibility_mask,
+                     num_points_2_cloud_to_packed_first_idx, num_points_2_packed_to_cloud_idx)
+from ..utils.mathHelper import (eps_denom, eps_sqrt, to_homogen, estimate_pointcloud_local_coord_frames,
+                                orthonormal_basis)
+from ..utils.profiling import profile_stage, profiled
+from .. import _C, logger_py, get_debugging_mode
 
 """
 A rasterizer takes a point cloud as input and outputs
@@ -42,25 +45,45 @@ class PointsRasterizationSettings:
     TODO: complete documentations
         cutoff_threshold (float): deciding whether inside the splat based on Q < cutoff_threshold
         backface_culling (bool): render only the front-facing faces
+        frustum_culling (bool): skip the points whose splats are outside of the
+            viewport before computing the per-point splat parameters
         depth_merging_threshold (float): depth threshold for determine zbuffer
         Vrk_invariant: use 3D spheres of a uniform size to represent a point
         Vrk_isotropic: use isotropic gaussian in the source space, otherwise compute anisotropic
             gaussian variance
+        Vrk_cache_tolerance (float): the nearest neighbor based splat size of the
+            isotropic and invariant Vrk is reused across forward passes until a point
+            moves more than this fraction of its local point spacing since the size
+            was computed. 0 recomputes it whenever any point moves.
+        Vrk_cache_interval (int): recompute the cached splat size at least every
+            this many renders, 0 disables the periodic refresh.
         radii_backward_scaler (float): the scaler used to increase the splat radius
             for backward pass, used for OccRBFBackward and OccBackward. If zero,
             then use WeightBackward, which contains gradients only for points
             rendered at the pixel.
+        image_size (int or (int, int)): size of the square image or (H, W),
+            for non-square images the shorter side spans [-1, 1] in NDC
+            and the longer side is extended so that pixels stay square
         points_per_pixels (int): rasterize maximum of K points per pixel
-        bin_size (int): used for faster forward-pass
+        bin_size (int): bin size (in pixels) for coarse-to-fine rasterization,
+            0 uses naive rasterization, None selects it automatically from the
+            image size and the screen-space radii of the points
+        max_points_per_bin (int): maximum number of points per bin of the cuda
+            coarse rasterization, None selects it automatically.
+            The automatic selections read the radii and the number of points
+            on the host, set both to avoid the synchronizations.
         clip_pts_grad (float): clip per-point gradient using the gradient norm
         antialiasing_sigma (float): gaussian sigma for anti-aliasing
     """
     __slots__ = [
         "cutoff_threshold",
         "backface_culling",
+        "frustum_culling",
         "depth_merging_threshold",
         "Vrk_invariant",
         "Vrk_isotropic",
+        "Vrk_cache_tolerance",
+        "Vrk_cache_interval",
         "radii_backward_scaler",
         "image_size",
         "points_per_pixel",
@@ -73,23 +96,29 @@ class PointsRasterizationSettings:
     def __init__(
         self,
         backface_culling: bool = True,
+        frustum_culling: bool = True,
         cutoff_threshold: float = 1,
         depth_merging_threshold: float = 0.05,
         Vrk_invariant: bool = False,
         Vrk_isotropic: bool = True,
+        Vrk_cache_tolerance: float = 0.1,
+        Vrk_cache_interval: int = 0,
         radii_backward_scaler: float = 10,
-        image_size: int = 256,
+        image_size: Union[int, Tuple[int, int]] = 256,
         points_per_pixel: int = 8,
-        bin_size: Optional[int] = 0,
+        bin_size: Optional[int] = None,
         max_points_per_bin: Optional[int] = None,
         clip_pts_grad: Optional[float] = -1,
         antialiasing_sigma: Optional[float] = 1.0,
     ):
         self.cutoff_threshold = cutoff_threshold
         self.backface_culling = backface_culling
+        self.frustum_culling = frustum_culling
         self.depth_merging_threshold = depth_merging_threshold
         self.Vrk_invariant = Vrk_invariant
         self.Vrk_isotropic = Vrk_isotropic
+        self.Vrk_cache_tolerance = Vrk_cache_tolerance
+        self.Vrk_cache_interval = Vrk_cache_interval
         self.radii_backward_scaler = radii_backward_scaler
         self.image_size = image_size
         self.points_per_pixel = points_per_pixel
@@ -126,6 +155,33 @@ class SurfaceSplatting(PointsRasterizer):
 
         self.raster_settings = raster_settings
         self.frnn_radius = frnn_radius
+        # cache of the nearest neighbor based splat size (see _get_Vrk_h)
+        self._Vrk_h = None
+        self._Vrk_h_points = None
+        self._Vrk_h_num_points = None
+        self._Vrk_h_age = 0
+
+    def transform(self, point_clouds, **kwargs):
+        """
+        Points in screen space, i.e. xy in NDC and z in view coordinates, as
+        PointsRasterizer.transform. Implemented here so that the new points are
+        always set with update_padded (PackedPointClouds does not support the
+        offset of older pytorch3d versions).
+        """
+        self.cameras = kwargs.get("cameras", self.cameras)
+        if self.cameras is None:
+            msg = "Cameras must be specified either at initialization \
+                or in the forward pass of PointsRasterizer"
+            raise ValueError(msg)
+
+        pts_world = point_clouds.points_padded()
+        pts_ndc = self.cameras.get_full_projection_transform(
+            **kwargs).transform_points(pts_world)
+        pts_view = self.cameras.get_world_to_view_transform(
+            **kwargs).transform_points(pts_world)
+        # retain the view space z
+        pts_screen = torch.cat([pts_ndc[..., :2], pts_view[..., 2:]], dim=-1)
+        return point_clouds.update_padded(pts_screen)
 
     def transform_normals(self, point_clouds, **kwargs):
         """ Return normals in view coordinates (padded) """
@@ -146,85 +202,132 @@ class SurfaceSplatting(PointsRasterizer):
         return normals_in_view
 
     def _filter_backface_points(self, point_clouds, **kwargs):
+        """
+        Remove the points facing away from the cameras
+        Args:
+            point_clouds (PackedPointClouds)
+        Returns:
+            point_clouds (PackedPointClouds)
+            mask (P,): packed mask of the kept points
+        """
+        self.cameras = kwargs.get("cameras", self.cameras)
         with torch.autograd.no_grad():
-            normals_view = self.transform_normals(point_clouds, **kwargs)
-            # mask = (normals_view[:, :, 2] < 1e-3)  # error buffer
-            mask = normals_view[:, :, 2] < 0
+            # z of the normals in view coordinates n @ inverse(M)^T
+            # (as pytorch3d Transform3d.transform_normals)
+            view_transform = self.cameras.get_world_to_view_transform()
+            normals_mat = view_transform.inverse().get_matrix()[:, 2, :3]
+            normals_mat = gather_batch_to_packed(
+                normals_mat, point_clouds.packed_to_cloud_idx())
+            # mask = (normals_view_z < 1e-3)  # error buffer
+            mask_packed = (point_clouds.normals_packed() * normals_mat).sum(dim=-1) < 0
 
-        lengths = point_clouds.num_points_per_cloud()
-        mask_packed = ops3d.padded_to_packed(mask.float(), point_clouds.cloud_to_packed_first_idx(),
-                                             lengths.sum().item()).bool()
         if torch.all(mask_packed):
             return point_clouds, mask_packed
 
-        # create point clouds again from packed
-        points_padded = point_clouds.points_padded()
-        normals_padded = point_clouds.normals_padded()
-        features_padded = point_clouds.features_padded()
-
-        # tuple to list, since pointclouds class doesn't accept tuples
-        points_list = [points_padded[b][mask[b]]
-                       for b in range(points_padded.shape[0])]
-        normals_list = [normals_padded[b][mask[b]]
-                        for b in range(normals_padded.shape[0])]
-        if features_padded is not None:
-            features_list = [features_padded[b][mask[b]]
-                             for b in range(features_padded.shape[0])]
-            new_point_clouds = point_clouds.__class__(
-                points=points_list, normals=normals_list, features=features_list)
-        else:
-            new_point_clouds = point_clouds.__class__(
-                points=points_list, normals=normals_list)
-
-        # for k in per_point_info:
-        #     per_point_info[k] = per_point_info[k][mask_packed]
-        return new_point_clouds, mask_packed
+        return point_clouds.masked_select(mask_packed), mask_packed
 
     def _filter_points_with_invalid_depth(self, point_clouds, **kwargs):
+        """
+        Remove the points outside of the [znear, zfar] depth range of the cameras
+        Args:
+            point_clouds (PackedPointClouds)
+        Returns:
+            point_clouds (PackedPointClouds)
+            mask (P,): packed mask of the kept points
+        """
         self.cameras = kwargs.get('cameras', self.cameras)
-        lengths = point_clouds.num_points_per_cloud()
-        points_padded = point_clouds.points_padded()
         with torch.autograd.no_grad():
             to_view = self.cameras.get_world_to_view_transform()
-            points = to_view.transform_points(points_padded)
+            points = _transform_points_packed(
+                point_clouds.points_packed(), to_view.get_matrix(), point_clouds.packed_to_cloud_idx())
             znear = getattr(self.cameras, 'znear', kwargs.get('znear', 1.0))
             zfar = getattr(self.cameras, 'zfar', kwargs.get('zfar', 100.0))
-            mask = (points[..., 2] >= znear) & (points[..., 2] <= zfar)
+            if torch.is_tensor(znear):
+                znear = gather_batch_to_packed(znear.view(-1, 1), point_clouds.packed_to_cloud_idx()).view(-1)
+            if torch.is_tensor(zfar):
+                zfar = gather_batch_to_packed(zfar.view(-1, 1), point_clouds.packed_to_cloud_idx()).view(-1)
+            mask_packed = (points[..., 2] >= znear) & (points[..., 2] <= zfar)
 
-        mask_packed = ops3d.padded_to_packed(mask.float(
-        ), point_clouds.cloud_to_packed_first_idx(), lengths.sum().item()).bool()
         if torch.all(mask_packed):
             return point_clouds, mask_packed
 
-        # create point clouds again from packed
-        points_padded = point_clouds.points_padded()
-        normals_padded = point_clouds.normals_padded()
-        features_padded = point_clouds.features_padded()
-        # tuple to list, since pointclouds class doesn't accept tuples
-        points_list = [points_padded[b][mask[b]]
-                       for b in range(points_padded.shape[0])]
-        normals_list = features_list = None
-        if normals_padded is not None:
-            normals_list = [normals_padded[b][mask[b]]
-                            for b in range(normals_padded.shape[0])]
-        if features_padded is not None:
-            features_list = [features_padded[b][mask[b]]
-                             for b in range(features_padded.shape[0])]
-        new_point_clouds = point_clouds.__class__(
-            points=points_list, normals=normals_list, features=features_list)
-        # for k in per_point_info:
-        #     per_point_info[k] = per_point_info[k][mask_packed]
-        return new_point_clouds, mask_packed
+        return point_clouds.masked_select(mask_packed), mask_packed
+
+    def _filter_offscreen_points(self, point_clouds, source_clouds=None, source_idx=None, **kwargs):
+        """
+        Remove the points whose splats are entirely outside of the viewport.
+        The screen space splat extent along each axis is bounded by
+        sqrt(cutoff * (h_k * |dndc/dx|^2 + sigma * pixel_size^2)), where h_k is
+        the largest eigenvalue of Vrk (see _compute_variance_and_detMk),
+        so no visible splat is removed. Not available for anisotropic Vrk.
+        Args:
+            point_clouds (PackedPointClouds)
+        Returns:
+            point_clouds (PackedPointClouds)
+            mask (P,): packed mask of the kept points
+            WJk (P_kept, 3, 2): projection Jacobian of the kept points (see
+                _compute_WJk), None if not computed
+        """
+        raster_settings = kwargs.get("raster_settings", self.raster_settings)
+        cameras = kwargs.get('cameras', self.cameras)
+        points_packed = point_clouds.points_packed()
+        mask_packed = torch.ones(
+            points_packed.shape[:1], dtype=torch.bool, device=points_packed.device)
+        if raster_settings.Vrk_invariant:
+            # upper bound of the global h_k
+            Vrk_h = 1e-3
+        elif raster_settings.Vrk_isotropic:
+            Vrk_h, _, _ = self._get_Vrk_h(point_clouds, source_clouds=source_clouds,
+                                          source_idx=source_idx, **kwargs)
+            Vrk_h = Vrk_h.clamp(5e-5, 0.01)
+            if source_idx is not None:
+                Vrk_h = Vrk_h[source_idx]
+        else:
+            return point_clouds, mask_packed, None
+
+        with torch.autograd.no_grad():
+            H, W = _parse_image_size(raster_settings.image_size)
+            pts_ndc = _transform_points_packed(
+                points_packed, cameras.get_full_projection_transform().get_matrix(),
+                point_clouds.packed_to_cloud_idx())[:, :2]
+            # squared norm of the gradient of ndc x and y w.r.t. the points
+            WJk = self._compute_WJk(point_clouds, **kwargs)
+            sq_grad = WJk.pow(2).sum(dim=1)
+            pixel_size = 2.0 / min(H, W)
+            extent = torch.sqrt(raster_settings.cutoff_threshold * (
+                Vrk_h.view(-1, 1) * sq_grad + raster_settings.antialiasing_sigma * pixel_size**2))
+            half_range = pts_ndc.new_tensor([_ndc_range(W, H), _ndc_range(H, W)]) / 2
+            mask_packed = ((pts_ndc.abs() - extent) <= half_range).all(dim=-1)
 
+        if torch.all(mask_packed):
+            return point_clouds, mask_packed, WJk
+
+        return point_clouds.masked_select(mask_packed), mask_packed, WJk[mask_packed]
+
+    @profiled('filter_renderable')
     def filter_renderable(self, point_clouds, point_clouds_filter=None, **kwargs):
+        """
+        Select the points that can be rendered: the activated points (if
+        point_clouds_filter is given) within the depth range of the cameras,
+        and facing the cameras if backface_culling.
+        Returns:
+            point_clouds (PackedPointClouds): renderable points of each camera
+            mask (P,): renderable mask of the activated points extended to
+                the cameras
+            source_clouds (PointClouds3D): activated points before being extended
+                to the cameras
+            source_idx (P_renderable,): packed index of each renderable point
+                in source_clouds
+            WJk (P_renderable, 3, 2): projection Jacobian of the renderable
+                points computed by the frustum culling, None if not computed
+        """
         raster_settings = kwargs.get("raster_settings", self.raster_settings)
         cameras = kwargs.get('cameras', self.cameras)
         if point_clouds.isempty():
-            return None, None, None, None
+            return point_clouds, None, None, None, None
+        self._Vrk_h_age += 1
 
-        P = point_clouds.num_points_per_cloud().sum().item()
-        max_P = point_clouds.num_points_per_cloud().max().item()
-        first_idx = point_clouds.cloud_to_packed_first_idx()
+        max_P = point_clouds.points_padded().shape[1]
         batch_size = len(point_clouds)
 
         if point_clouds_filter is not None:  # activation filter
@@ -233,25 +336,49 @@ class SurfaceSplatting(PointsRasterizer):
             point_clouds = point_clouds_filter.filter_with(
                 point_clouds, ('activation',))
 
+        source_clouds = point_clouds
+        point_clouds = PackedPointClouds.from_point_clouds(source_clouds)
+        source_idx = torch.arange(point_clouds.points_packed().shape[0],
+                                  device=point_clouds.device)
         if cameras.R.shape[0] != len(point_clouds):
             logger_py.warning('Detected unequal number of cameras and pointclouds. '
                               'Call point_clouds.extend(len(cameras)) outside this function, '
                               'otherwise inplace modification to pointclouds will not take effects.')
-            point_clouds = point_clouds.extend(cameras.R.shape[0])
+            # repeat every source cloud num_views times consecutively (as Pointclouds.extend)
+            num_views = cameras.R.shape[0]
+            num_points_per_cloud = source_clouds.num_points_per_cloud().repeat_interleave(num_views)
+            cloud_idx = num_points_2_packed_to_cloud_idx(
+                num_points_per_cloud, num_views * source_idx.shape[0])
+            local_idx = torch.arange(cloud_idx.shape[0], device=cloud_idx.device) - \
+                num_points_2_cloud_to_packed_first_idx(num_points_per_cloud)[cloud_idx]
+            source_idx = source_clouds.cloud_to_packed_first_idx()[
+                cloud_idx // num_views] + local_idx
+            point_clouds = point_clouds.index_select(
+                source_idx, num_points_per_cloud, packed_to_cloud_idx=cloud_idx,
+                max_points=source_clouds.points_padded().shape[1])
 
         point_clouds, valid_depth_mask = self._filter_points_with_invalid_depth(
             point_clouds, **kwargs)
+        source_idx = source_idx[valid_depth_mask]
 
         if point_clouds.isempty():
-            return point_clouds, None, None, None
+            return point_clouds, None, None, None, None
 
         # new point clouds containing only points facing towards the camera
         if raster_settings.backface_culling:
             point_clouds, frontface_mask = self._filter_backface_points(
                 point_clouds, **kwargs)
             valid_depth_mask[valid_depth_mask] = frontface_mask
+            source_idx = source_idx[frontface_mask]
 
-        return point_clouds, valid_depth_mask
+        WJk = None
+        if raster_settings.frustum_culling and not point_clouds.isempty():
+            point_clouds, onscreen_mask, WJk = self._filter_offscreen_points(
+                point_clouds, source_clouds=source_clouds, source_idx=source_idx, **kwargs)
+            valid_depth_mask[valid_depth_mask] = onscreen_mask
+            source_idx = source_idx[onscreen_mask]
+
+        return point_clouds, valid_depth_mask, source_clouds, source_idx, WJk
 
     def _compute_anisotropic_Vrk(self, pointclouds, **kwargs):
         """
@@ -272,12 +399,13 @@ class SurfaceSplatting(PointsRasterizer):
         curvatures, local_frame = estimate_pointcloud_local_coord_frames(
             pointclouds, neighborhood_size=8, disambiguate_directions=False)
 
+        total_P = pointclouds.points_packed().shape[0]
         local_frame = ops3d.padded_to_packed(local_frame.reshape(local_frame.shape[:2] + (-1,)),
                                              pointclouds.cloud_to_packed_first_idx(),
-                                             num_points.sum().item())
+                                             total_P)
         curvatures = ops3d.padded_to_packed(curvatures,
                                             pointclouds.cloud_to_packed_first_idx(
-                                            ), num_points.sum().item())
+                                            ), total_P)
 
         local_frame = local_frame.view(-1, 3, 3)[:, :, 1:]
         # curvature only determines ratio of the two principle axis
@@ -290,7 +418,86 @@ class SurfaceSplatting(PointsRasterizer):
             curvatures) @ local_frame.transpose(1, 2)
         return Vr, local_frame.transpose(1, 2)
 
-    def _compute_global_Vrk(self, pointclouds, refresh=True, **kwargs):
+    def _compute_Vrk_h(self, pointclouds):
+        """
+        heuristically h_k = 0.5 * max squared distance to the 6 nearest neighbors
+        Args:
+            pointclouds: pointclouds in object coordinates
+        Returns:
+            h_k: (totalP, 1) packed
+        """
+        pts_world = pointclouds.points_padded()
+        num_points_per_cloud = pointclouds.num_points_per_cloud()
+        if self.frnn_radius <= 0:
+            sq_dist, _, _ = ops3d.knn_points(pts_world, pts_world,
+                                             num_points_per_cloud, num_points_per_cloud,
+                                             K=7)
+        else:
+            sq_dist, _, _, _ = frnn.frnn_grid_points(pts_world, pts_world,
+                                                     num_points_per_cloud, num_points_per_cloud,
+                                                     K=7, r=self.frnn_radius)
+
+        sq_dist = sq_dist[:, :, 1:]
+        # knn search is unreliable, set sq_dist manually
+        sq_dist[num_points_per_cloud < 7] = 1e-3
+        # (totalP, knnK)
+        sq_dist = ops3d.padded_to_packed(sq_dist,
+                                         pointclouds.cloud_to_packed_first_idx(
+                                         ), pointclouds.points_packed().shape[0])
+        return 0.5 * sq_dist.max(dim=-1, keepdim=True)[0]
+
+    def _is_Vrk_h_stale(self, points, num_points_per_cloud, **kwargs):
+        """
+        Whether the cached h_k needs to be recomputed for the packed points.
+        """
+        raster_settings = kwargs.get("raster_settings", self.raster_settings)
+        if self._Vrk_h is None or self._Vrk_h_points.shape != points.shape or \
+                self._Vrk_h_num_points.shape != num_points_per_cloud.shape or \
+                self._Vrk_h_points.device != points.device:
+            return True
+        if 0 < raster_settings.Vrk_cache_interval <= self._Vrk_h_age:
+            return True
+        # the local spacing is the distance to the farthest neighbor, i.e. 2*h_k
+        sq_displacement = (points - self._Vrk_h_points).pow(2).sum(dim=-1)
+        sq_spacing = 2 * self._Vrk_h.view(-1)
+        # a single host synchronization for both tests
+        stale = (sq_displacement > raster_settings.Vrk_cache_tolerance ** 2 * sq_spacing).any() | \
+            (self._Vrk_h_num_points != num_points_per_cloud).any()
+        return bool(stale)
+
+    def _get_Vrk_h(self, pointclouds, refresh=False, **kwargs):
+        """
+        Get the (unclamped) h_k of the nearest neighbor based Vrk.
+        h_k only depends on the points in object coordinates, so it is computed
+        on the source point clouds (kwargs "source_clouds", see filter_renderable)
+        shared by all cameras, and is reused in the following calls until the
+        points move or change (see Vrk_cache_tolerance and Vrk_cache_interval).
+        Args:
+            pointclouds: pointclouds in object coordinates
+            refresh (bool): recompute h_k regardless of the cache
+        Returns:
+            h_k (totalP_source, 1): h_k of the packed source points
+            source_clouds: the point clouds h_k is computed on
+            source_idx (totalP,): index of the packed points of pointclouds
+                in the source points, None if pointclouds is the source
+        """
+        source_clouds = kwargs.get("source_clouds", None)
+        source_idx = kwargs.get("source_idx", None)
+        if source_clouds is None or source_idx is None:
+            source_clouds, source_idx = pointclouds, None
+
+        points = source_clouds.points_packed().detach()
+        num_points_per_cloud = source_clouds.num_points_per_cloud()
+        if refresh or self._is_Vrk_h_stale(points, num_points_per_cloud, **kwargs):
+            # the cache outlives the iteration, it must not keep the graph of the points
+            with torch.autograd.no_grad():
+                self._Vrk_h = self._compute_Vrk_h(source_clouds)
+            self._Vrk_h_points = points.clone()
+            self._Vrk_h_num_points = num_points_per_cloud.clone()
+            self._Vrk_h_age = 0
+        return self._Vrk_h, source_clouds, source_idx
+
+    def _compute_global_Vrk(self, pointclouds, refresh=False, **kwargs):
         """
         determine variance scaler used in globally (see _compute_isotropic_Vrk)
         Args:
@@ -299,33 +506,17 @@ class SurfaceSplatting(PointsRasterizer):
             h_k: scaler
             S_k: local frame
         """
-        if not refresh and self._Vrk_h is not None:
-            h_k = self._Vrk_h
-        else:
-            # compute average density
-            with torch.autograd.enable_grad():
-                pts_world = pointclouds.points_padded()
-
-            num_points_per_cloud = pointclouds.num_points_per_cloud()
-            if self.frnn_radius <= 0:
-                # use knn here
-                # logger_py.info("vrk knn points")
-                sq_dist, _, _ = ops3d.knn_points(pts_world, pts_world,
-                                                 num_points_per_cloud, num_points_per_cloud,
-                                                 K=7)
-            else:
-                sq_dist, _, _, _ = frnn.frnn_grid_points(pts_world, pts_world,
-                                                         num_points_per_cloud, num_points_per_cloud,
-                                                         K=7, r=self.frnn_radius)
-            # logger_py.info("frnn and knn dist close: {}".format(torch.allclose(sq_dist, sq_dist2)))
-            sq_dist = sq_dist[:, :, 1:]
-            # knn search is unreliable, set sq_dist manually
-            sq_dist[num_points_per_cloud < 7] = 1e-3
-            h_k = 0.5 * sq_dist.max(dim=-1, keepdim=True)[0]
-            # prevent some outlier rendered be too large, or too small
-            h_k = h_k.mean(dim=1, keepdim=True).clamp(5e-5, 1e-3)
-            Vrk_h = gather_batch_to_packed(
-                h_k, pointclouds.packed_to_cloud_idx())
+        # compute average density
+        h_k, source_clouds, source_idx = self._get_Vrk_h(
+            pointclouds, refresh=refresh, **kwargs)
+        cloud_idx = source_clouds.packed_to_cloud_idx()
+        num_points_per_cloud = source_clouds.num_points_per_cloud()
+        h_k = h_k.new_zeros(len(source_clouds)).scatter_add_(
+            0, cloud_idx, h_k.view(-1)) / num_points_per_cloud.clamp(min=1)
+        # prevent some outlier rendered be too large, or too small
+        Vrk_h = h_k.clamp(5e-5, 1e-3)[cloud_idx]
+        if source_idx is not None:
+            Vrk_h = Vrk_h[source_idx]
 
         # Sk, a transformation from 2D local surface frame to 3D world frame
         # Because isometry, two axis are equivalent, we can simply
@@ -334,14 +525,11 @@ class SurfaceSplatting(PointsRasterizer):
         with torch.autograd.enable_grad():
             normals = pointclouds.normals_packed()
 
-        u0 = F.normalize(torch.cross(normals,
-                                     normals + torch.rand_like(normals)), dim=-1)
-        u1 = F.normalize(torch.cross(normals, u0), dim=-1)
-        Sk = torch.stack([u0, u1], dim=1)
+        Sk = orthonormal_basis(F.normalize(normals, dim=-1))
         Vrk = Vrk_h.view(-1, 1, 1) * Sk.transpose(1, 2) @ Sk
         return Vrk, Sk
 
-    def _compute_isotropic_Vrk(self, pointclouds, refresh=True, **kwargs):
+    def _compute_isotropic_Vrk(self, pointclouds, refresh=False, **kwargs):
         """
         determine the variance in the local surface frame h * Sk.T @ Sk,
         where Sk is 2x3 local surface coordinate to world coordinate.
@@ -356,36 +544,12 @@ class SurfaceSplatting(PointsRasterizer):
             h_k: [N,3,3] tensor for each point
             S_k: [N,2,3] local frame
         """
-        if not refresh and self._Vrk_h is not None and \
-                pointclouds.num_points_per_cloud().sum() == self._Vrk_h.shape[0]:
-            pass
-        else:
-            with torch.autograd.enable_grad():
-                pts_world = pointclouds.points_padded()
-
-            num_points_per_cloud = pointclouds.num_points_per_cloud()
-            if self.frnn_radius <= 0:
-                # logger_py.info("vrk knn points")
-                sq_dist, _, _ = ops3d.knn_points(pts_world, pts_world,
-                                                 num_points_per_cloud, num_points_per_cloud,
-                                                 K=7)
-            else:
-                sq_dist, _, _, _ = frnn.frnn_grid_points(pts_world, pts_world,
-                                                         num_points_per_cloud, num_points_per_cloud,
-                                                         K=7, r=self.frnn_radius)
-
-            sq_dist = sq_dist[:, :, 1:]
-            # knn search is unreliable, set sq_dist manually
-            sq_dist[num_points_per_cloud < 7] = 1e-3
-            # (totalP, knnK)
-            sq_dist = ops3d.padded_to_packed(sq_dist,
-                                             pointclouds.cloud_to_packed_first_idx(
-                                             ), num_points_per_cloud.sum().item())
-            # [totalP, ]
-            h_k = 0.5 * sq_dist.max(dim=-1, keepdim=True)[0]
-
-            # prevent some outlier rendered be too large, or too small
-            self._Vrk_h = h_k.clamp(5e-5, 0.01)
+        h_k, _, source_idx = self._get_Vrk_h(
+            pointclouds, refresh=refresh, **kwargs)
+        # prevent some outlier rendered be too large, or too small
+        Vrk_h = h_k.clamp(5e-5, 0.01)
+        if source_idx is not None:
+            Vrk_h = Vrk_h[source_idx]
 
         # Sk, a transformation from 2D local surface frame to 3D world frame
         # Because isometry, two axis are equivalent, we can simply
@@ -394,36 +558,55 @@ class SurfaceSplatting(PointsRasterizer):
         with torch.autograd.enable_grad():
             normals = pointclouds.normals_packed()
 
-        u0 = F.normalize(torch.cross(normals,
-                                     normals + torch.rand_like(normals)), dim=-1)
-        u1 = F.normalize(torch.cross(normals, u0), dim=-1)
-        Sk = torch.stack([u0, u1], dim=1)
-        Vrk = self._Vrk_h.view(-1, 1, 1) * Sk.transpose(1, 2) @ Sk
+        Sk = orthonormal_basis(F.normalize(normals, dim=-1))
+        Vrk = Vrk_h.view(-1, 1, 1) * Sk.transpose(1, 2) @ Sk
         return Vrk, Sk
 
+    def _compute_Vrk(self, pointclouds, **kwargs):
+        """
+        Compute the variance in the local surface frame according to
+        raster_settings.Vrk_invariant and Vrk_isotropic
+        Returns:
+            Vrk (totalP, 3, 3)
+            Sk (totalP, 2, 3)
+        """
+        raster_settings = kwargs.get("raster_settings", self.raster_settings)
+        if raster_settings.Vrk_invariant:
+            return self._compute_global_Vrk(pointclouds, **kwargs)
+        elif raster_settings.Vrk_isotropic:
+            return self._compute_isotropic_Vrk(pointclouds, **kwargs)
+        return self._compute_anisotropic_Vrk(pointclouds)
+
     def _compute_variance_and_detMk(self, pointclouds, **kwargs):
         """
         Compute the projected kernel variance Vk'+I Eq.(35) in [2],
         J V_k^r J^T + I Eq.(7) in [1]
         Args:
             pointclouds (PointClouds3D): point clouds in object coordinates
+            WJk (optional): (N, 3, 2) projection Jacobian of the points if
+                already computed (see filter_renderable)
         Returns:
             variance (tensor): (N, 2, 2)
             detMk (tensor): (N, 1) determinant of Mk
         """
         raster_settings = kwargs.get("raster_settings", self.raster_settings)
 
-        WJk = self._compute_WJk(pointclouds, **kwargs)
+        WJk = kwargs.get("WJk", None)
+        if WJk is None:
+            WJk = self._compute_WJk(pointclouds, **kwargs)
         totalP = WJk.shape[0]
 
-        if raster_settings.Vrk_invariant:
-            Vrk, Sk = self._compute_global_Vrk(pointclouds, **kwargs)
-        elif raster_settings.Vrk_isotropic:
-            # (N, 3, 3)
-            Vrk, Sk = self._compute_isotropic_Vrk(
-                pointclouds, **kwargs)
+        # Vrk and Sk are view-independent, if the source point clouds are
+        # broadcast to multiple cameras, compute them once for the source points
+        source_clouds = kwargs.get("source_clouds", None)
+        source_idx = kwargs.get("source_idx", None)
+        if source_clouds is not None and source_idx is not None and \
+                len(pointclouds) > len(source_clouds):
+            Vrk, Sk = self._compute_Vrk(
+                source_clouds, **dict(kwargs, source_clouds=None, source_idx=None))
+            Vrk, Sk = Vrk[source_idx], Sk[source_idx]
         else:
-            Vrk, Sk = self._compute_anisotropic_Vrk(pointclouds)
+            Vrk, Sk = self._compute_Vrk(pointclouds, **kwargs)
 
         Mk = Sk @ WJk
         Vk = WJk.transpose(1, 2) @ Vrk @ WJk
@@ -431,12 +614,12 @@ class SurfaceSplatting(PointsRasterizer):
         # low-pass filter +sigma*I
         # NOTE: [2] is in pixel space, but we are in NDC space, so the variance should be
         # scaled by pixel_size
-        pixel_size = 2.0 / raster_settings.image_size
+        pixel_size = 2.0 / min(_parse_image_size(raster_settings.image_size))
         variance = Vk + raster_settings.antialiasing_sigma * \
             ops3d.eyes(2, totalP, device=Vk.device,
                        dtype=Vk.dtype) * (pixel_size**2)
 
-        detMk = torch.det(Mk)
+        detMk = _det_2x2(Mk)
 
         return variance, detMk
 
@@ -495,33 +678,7 @@ class SurfaceSplatting(PointsRasterizer):
 
         return Mk
 
-    def _get_ellipse_axis_aligned_radius(self, cutoffC, ellipseParams,
-                                         min_radii=-float('inf'), max_radii=float('inf')):
-        """
-        Compute the axis-aligned radii around each points in screen space given the
-        elliptical parameters a, b, c in ax^2 + cy^2 + bxy <= cutoffC
-        Args:
-            cutoffC (scalar): cutoff threshold
-            ellipseParams (tensor): (N,3) coefficients a, b, c of the elliptical function
-        Returns:
-            radii (tensor): (N,2) splat radius in x and y direction (in NDC)
-        """
-        with torch.autograd.no_grad():
-            a = ellipseParams[..., 0]
-            b = ellipseParams[..., 1]
-            c = ellipseParams[..., 2]
-            # N,2
-            b2 = b**2
-            ac4 = 4 * a * c
-            denom = eps_denom(ac4 - b2)
-            y = torch.sqrt(eps_sqrt(4 * a * cutoffC / denom))
-            x = torch.sqrt(eps_sqrt(4 * c * cutoffC / denom))
-            radii = torch.stack([x, y], dim=-1)
-            # radii = radii.clamp(min=min_radii, max=max_radii)
-            # cutoffC = torch.max(x**2 * denom / 4 / c, y**2 * denom / 4 / a)
-            cutoffC = torch.full_like(a, cutoffC)
-        return radii, cutoffC
-
+    @profiled('per_point_info')
     def _get_per_point_info(self, pointclouds, **kwargs):
         """
         Compute necessary per-point information to rasterize
@@ -539,26 +696,9 @@ class SurfaceSplatting(PointsRasterizer):
         # GV = M_k V_k^T M_k^T + V^h
         GVs, detMk = self._compute_variance_and_detMk(pointclouds, **kwargs)
 
-        GVdets = torch.det(GVs)
-        GVinvs = torch.inverse(GVs)
-        totalP = detMk.shape[0]
-
-        # compute ellipse radii (N, 2) to prepare the rasterization
-        # ellipseParams (a,b,c) = ax^2+cxy+by^2
-        ellipseParams = GVs.new_empty(totalP, 3)
-        ellipseParams[..., 0] = GVinvs[..., 0, 0]
-        ellipseParams[..., 1] = GVinvs[..., 0, 1] + GVinvs[..., 1, 0]
-        ellipseParams[..., 2] = GVinvs[..., 1, 1]
-
-        # NOTE: make radii at least one pixel height/width
-        pixel_size = 2 / (raster_settings.image_size - 1)
-        radii, cutoff_thres = self._get_ellipse_axis_aligned_radius(
-            cutoff_thres, ellipseParams, min_radii=pixel_size, max_radii=20 * pixel_size)
-        # gaussian normalization term 2pi|V|^{1/2} (N,1)
-        scalerk = torch.sqrt(eps_sqrt(GVdets * 4 * np.pi * np.pi))
-        scalerk = detMk.abs() / eps_denom(scalerk)
-
-        # radii = radii.clamp(min=0.5*pixel_size, max=5*pixel_size)
+        radii, ellipseParams, cutoff_thres, scalerk = _ellipse_splat_params(
+            GVs, detMk, cutoff_thres)
+
         return {"radii": radii.detach(),
                 "ellipse_params": ellipseParams.detach(),
                 "cutoff_threshold": cutoff_thres.detach(),
@@ -569,17 +709,40 @@ class SurfaceSplatting(PointsRasterizer):
         Templates for an empty rasterization output
         """
         raster_settings = kwargs.get("raster_settings", self.raster_settings)
-        S = raster_settings.image_size
+        H, W = _parse_image_size(raster_settings.image_size)
         P = raster_settings.points_per_pixel
-        idx = torch.full((batch_size, S, S, P), -1,
+        idx = torch.full((batch_size, H, W, P), -1,
                          dtype=torch.long, device=self.device)
-        zbuf = torch.full((batch_size, S, S, P), -1.0,
+        zbuf = torch.full((batch_size, H, W, P), -1.0,
                           dtype=torch.float, device=self.device)
         qvalue_map = torch.full(
-            (batch_size, S, S, P), -1.0, dtype=torch.float, device=self.device)
-        occ_map = torch.full((batch_size, S, S), 0,
+            (batch_size, H, W, P), -1.0, dtype=torch.float, device=self.device)
+        scaler = torch.zeros((batch_size, H, W, P),
+                             dtype=torch.float, device=self.device)
+        occ_map = torch.full((batch_size, H, W), 0,
                              dtype=torch.float, device=self.device)
-        return PointFragments(idx=idx, zbuf=zbuf, qvalue=qvalue_map, occupancy=occ_map)
+        return PointFragments(idx=idx, zbuf=zbuf, qvalue=qvalue_map, scaler=scaler, occupancy=occ_map)
+
+    def _set_visibility_filter(self, point_clouds, point_clouds_filter,
+                               mask_filtered, visibility_mask):
+        """
+        Put the visibility of the filtered points into mask_filtered (P,) and
+        update the visibility filter of point_clouds_filter if given.
+        """
+        mask_filtered[mask_filtered] = visibility_mask
+
+        if point_clouds_filter is not None:
+            # update point_clouds visibility filter
+            # we use this information in projection loss
+            # put all_depth_visibility_mask (num_active) to original_visibility_mask (P,)
+            # transform to padded
+            # original_visibility_mask = ops3d.packed_to_padded(
+            #     valid_depth_mask.float(), first_idx, max_P).bool()
+            # lixin
+            max_P = point_clouds.points_padded().shape[1]
+            original_visibility_mask = ops3d.packed_to_padded(
+                mask_filtered.float(), point_clouds.cloud_to_packed_first_idx(), max_P).bool()
+            point_clouds_filter.set_filter(visibility=original_visibility_mask)
 
     def forward(self, point_clouds, point_clouds_filter=None, **kwargs) -> PointFragments:
         """
@@ -593,10 +756,9 @@ class SurfaceSplatting(PointsRasterizer):
         """
         raster_settings = kwargs.get("raster_settings", self.raster_settings)
         cameras = kwargs.get('cameras', self.cameras)
-        max_P = point_clouds.num_points_per_cloud().max().item()
-        total_P = point_clouds.num_points_per_cloud().sum().item()
+        total_P = point_clouds.points_packed().shape[0]
 
-        point_clouds_filtered, mask_filtered = self.filter_renderable(
+        point_clouds_filtered, mask_filtered, source_clouds, source_idx, WJk = self.filter_renderable(
             point_clouds, point_clouds_filter, **kwargs)
 
         if point_clouds_filtered.isempty():
@@ -605,13 +767,15 @@ class SurfaceSplatting(PointsRasterizer):
         # compute per-point features for elliptical gaussian weights
         with torch.autograd.no_grad():
             per_point_info = self._get_per_point_info(
-                point_clouds_filtered, **kwargs)
+                point_clouds_filtered, source_clouds=source_clouds,
+                source_idx=source_idx, WJk=WJk, **kwargs)
 
 
         _tmp = point_clouds_filtered.points_padded()
         if _tmp.requires_grad:
             _tmp.register_hook(lambda x: _check_grad(x, 'transform'))
-        pcls_screen = self.transform(point_clouds_filtered, **kwargs)
+        with profile_stage('transform'):
+            pcls_screen = self.transform(point_clouds_filtered, **kwargs)
 
         idx, zbuf, qvalue_map, occ_map = rasterize_elliptical_points(
             pcls_screen,
@@ -636,21 +800,11 @@ class SurfaceSplatting(PointsRasterizer):
             idx=idx, zbuf=zbuf, qvalue=qvalue_map, scaler=frag_scaler, occupancy=occ_map)
 
         # returns (P,) boolean mask for visibility
-        visibility_mask = get_per_point_visibility_mask(
-            point_clouds_filtered, fragments)
-        mask_filtered[mask_filtered] = visibility_mask
-
-        if point_clouds_filter is not None:
-            # update point_clouds visibility filter
-            # we use this information in projection loss
-            # put all_depth_visibility_mask (num_active) to original_visibility_mask (P,)
-            # transform to padded
-            # original_visibility_mask = ops3d.packed_to_padded(
-            #     valid_depth_mask.float(), first_idx, max_P).bool()
-            # lixin
-            original_visibility_mask = ops3d.packed_to_padded(
-                mask_filtered.float(), point_clouds.cloud_to_packed_first_idx(), max_P).bool()
-            point_clouds_filter.set_filter(visibility=original_visibility_mask)
+        with profile_stage('visibility_mask'):
+            visibility_mask = get_per_point_visibility_mask(
+                point_clouds_filtered, fragments)
+            self._set_visibility_filter(point_clouds, point_clouds_filter,
+                                        mask_filtered, visibility_mask)
 
         if kwargs.get('verbose', False):
             # use scatter to get per point info of the original
@@ -663,6 +817,75 @@ class SurfaceSplatting(PointsRasterizer):
             return fragments, point_clouds_filtered, original_per_point_info
         return fragments, point_clouds_filtered
 
+    def rasterize_and_composite(self, point_clouds, point_clouds_filter=None,
+                                normalize: bool = True, **kwargs):
+        """
+        Rasterize and composite the RGB features of the points in one pass
+        (CPU only). Unlike forward, the (N,H,W,K) fragments are never created,
+        only the composited images and what is needed for the backward pass.
+        Args:
+            point_clouds (Pointclouds3D): a set of point clouds with coordinates.
+            normalize (bool): normalize the weights of each pixel by their sum
+                as NormWeightedCompositor, otherwise composite with weighted sum
+        Returns:
+            images (N,H,W,4): RGBA images, alpha is the occupancy
+            point_clouds_filtered (Pointclouds3D)
+        """
+        raster_settings = kwargs.get("raster_settings", self.raster_settings)
+        cameras = kwargs.get('cameras', self.cameras)
+
+        point_clouds_filtered, mask_filtered, source_clouds, source_idx, WJk = self.filter_renderable(
+            point_clouds, point_clouds_filter, **kwargs)
+
+        if point_clouds_filtered.isempty():
+            H, W = _parse_image_size(raster_settings.image_size)
+            images = torch.zeros((cameras.R.shape[0], H, W, 4),
+                                 dtype=torch.float, device=self.device)
+            return images, point_clouds_filtered
+
+        # compute per-point features for elliptical gaussian weights
+        with torch.autograd.no_grad():
+            per_point_info = self._get_per_point_info(
+                point_clouds_filtered, source_clouds=source_clouds,
+                source_idx=source_idx, WJk=WJk, **kwargs)
+
+        with profile_stage('transform'):
+            pcls_screen = self.transform(point_clouds_filtered, **kwargs)
+        pts_rgb = point_clouds_filtered.features_packed()[:, :3]
+
+        images, occ_map, visibility_mask = rasterize_composite_elliptical_points(
+            pcls_screen,
+            pts_rgb,
+            per_point_info["ellipse_params"],
+            per_point_info['cutoff_threshold'],
+            per_point_info["radii"],
+            per_point_info["scaler"],
+            normalize=normalize,
+            depth_merging_threshold=raster_settings.depth_merging_threshold,
+            image_size=raster_settings.image_size,
+            points_per_pixel=raster_settings.points_per_pixel,
+            bin_size=raster_settings.bin_size,
+            radii_backward_scaler=raster_settings.radii_backward_scaler,
+            clip_pts_grad=raster_settings.clip_pts_grad
+        )
+        self._set_visibility_filter(point_clouds, point_clouds_filter,
+                                    mask_filtered, visibility_mask)
+
+        images = torch.cat([images, occ_map.unsqueeze(-1)], dim=-1)
+        return images, point_clouds_filtered
+
+
+def _transform_points_packed(points, matrices, packed_to_cloud_idx):
+    """
+    Transform packed points with the (N, 4, 4) row-major matrix of their
+    clouds, as pytorch3d Transform3d.transform_points
+    Returns:
+        points (P, 3)
+    """
+    matrices = gather_batch_to_packed(matrices, packed_to_cloud_idx)
+    points = (to_homogen(points, dim=-1)[:, None, :] @ matrices).squeeze(1)
+    return points[:, :3] / eps_denom(points[:, 3:])
+
 
 def _clip_grad(value=0.1):
     def func(grad):
@@ -678,10 +901,159 @@ def _check_grad(x, msg):
         print(msg)
     return x
 
+# Upper bound for the number of entries N*BH*BW*M of the bin tensor created by the
+# cuda coarse rasterization, above which naive rasterization is used instead.
+_kMaxBinEntries = 2 ** 27
+
+
+def _det_2x2(mats):
+    """
+    Closed-form determinant of (P, 2, 2) matrices
+    """
+    return mats[:, 0, 0] * mats[:, 1, 1] - mats[:, 0, 1] * mats[:, 1, 0]
+
+
+def _ellipse_splat_params(variance, detMk, cutoff_threshold):
+    """
+    Closed-form per-point splat parameters from the screen space variances,
+    avoids the batched torch.det and torch.inverse of tiny matrices.
+    Args:
+        variance (P, 2, 2): screen space variance GV of the elliptical gaussians
+        detMk (P,): determinant of Mk
+        cutoff_threshold (float): splat extent ax^2 + bxy + cy^2 <= cutoff_threshold
+    Returns:
+        radii (P, 2): axis-aligned splat radii in x and y (in NDC)
+        ellipse_params (P, 3): coefficients a, b, c of the inverse variance
+        cutoff_threshold (P,)
+        scaler (P,): gaussian normalization term |Mk| / (2pi|GV|^{1/2})
+    """
+    v00, v01, v10, v11 = variance.reshape(-1, 4).unbind(dim=-1)
+    det = v00 * v11 - v01 * v10
+    # inverse [[v11, -v01], [-v10, v00]] / det, b sums the off-diagonals
+    a = v11 / det
+    b = -(v01 + v10) / det
+    c = v00 / det
+    ellipse_params = torch.stack([a, b, c], dim=-1)
+
+    # the axis-aligned extent of the ellipse
+    denom = eps_denom(4 * a * c - b * b)
+    radii = torch.stack([torch.sqrt(eps_sqrt(4 * c * cutoff_threshold / denom)),
+                         torch.sqrt(eps_sqrt(4 * a * cutoff_threshold / denom))], dim=-1)
+
+    scaler = torch.sqrt(eps_sqrt(det * 4 * np.pi * np.pi))
+    scaler = detMk.abs() / eps_denom(scaler)
+    return radii, ellipse_params, torch.full_like(a, cutoff_threshold), scaler
+
+
+def _parse_image_size(image_size) -> Tuple[int, int]:
+    """
+    Image size as a (H, W) tuple from an int (square image) or a (H, W) pair.
+    """
+    if isinstance(image_size, (tuple, list)):
+        if len(image_size) != 2:
+            raise ValueError("image_size must be an int or a (H, W) tuple, got %s"
+                             % str(image_size))
+        return int(image_size[0]), int(image_size[1])
+    return int(image_size), int(image_size)
+
+
+def _ndc_range(S1, S2):
+    """
+    NDC range of an image axis with S1 pixels when the other axis has S2
+    pixels, the shorter side spans [-1, 1].
+    """
+    return 2.0 if S1 <= S2 else 2.0 * S1 / S2
+
+
+def _count_points_per_bin(points, radii, num_points_per_cloud, image_size, bin_size):
+    """
+    Count the points overlapping each bin of the coarse rasterization using
+    the axis-aligned radii, with a 2D difference array.
+    The count is slightly conservative at the bin boundaries.
+    Args:
+        points (P, 3) packed points in NDC
+        radii (P, 2) axis-aligned radii in NDC
+        num_points_per_cloud (N,)
+        image_size (H, W)
+    Returns:
+        points_per_bin (N, BH, BW) with BH = 1 + (H - 1) // bin_size
+            and BW = 1 + (W - 1) // bin_size
+    """
+    N = num_points_per_cloud.shape[0]
+    H, W = image_size
+    BH = 1 + (H - 1) // bin_size
+    BW = 1 + (W - 1) // bin_size
+    bin_width = 2.0 / min(H, W) * bin_size
+    packed_to_cloud_idx = torch.repeat_interleave(
+        torch.arange(N, device=points.device), num_points_per_cloud)
+    # bin b covers [-r + b * bin_width, -r + (b + 1) * bin_width], r being
+    # half of the NDC range of the axis
+    ndc_offset = points.new_tensor([_ndc_range(W, H), _ndc_range(H, W)]) / 2
+    box_min = (points[:, :2] - radii + ndc_offset - 1e-5) / bin_width
+    box_max = (points[:, :2] + radii + ndc_offset + 1e-5) / bin_width
+    bin_min = torch.ceil(box_min - 1).long().clamp_min(0)
+    bin_max = torch.min(torch.floor(box_max).long(), bin_min.new_tensor([BW - 1, BH - 1]))
+    valid = (bin_min <= bin_max).all(dim=-1) & (points[:, 2] >= 0)
+    n = packed_to_cloud_idx[valid]
+    bx0, by0 = bin_min[valid].unbind(-1)
+    bx1, by1 = (bin_max[valid] + 1).unbind(-1)
+    diff = torch.zeros((N, BH + 1, BW + 1), dtype=torch.long, device=points.device)
+    ones = torch.ones_like(n)
+    diff.index_put_((n, by0, bx0), ones, accumulate=True)
+    diff.index_put_((n, by0, bx1), -ones, accumulate=True)
+    diff.index_put_((n, by1, bx0), -ones, accumulate=True)
+    diff.index_put_((n, by1, bx1), ones, accumulate=True)
+    return diff.cumsum(1).cumsum(2)[:, :BH, :BW]
+
+
+def _select_bin_size(points, radii, num_points_per_cloud, image_size,
+                     max_points_per_bin=None):
+    """
+    Choose the coarse-to-fine configuration when bin_size is None.
+    As in pytorch3d the bin size starts from max(H, W)/16 (at least 16 pixels).
+    It is doubled until a median splat is at most half a bin wide, so that
+    a splat is copied into few bins, and, on cuda, until the number of bins
+    fits in the coarse kernel. max_points_per_bin is the maximum bin
+    occupancy computed from the radii. Falls back to naive rasterization
+    (bin_size=0) if a single bin covers the image or the cuda bin tensor would
+    be too large.
+    Args:
+        image_size (H, W)
+    Returns:
+        bin_size, max_points_per_bin
+    """
+    max_size = max(image_size)
+    bin_size = int(2 ** max(np.ceil(np.log2(max_size)) - 4, 4))
+    if radii.numel() > 0:
+        # one NDC unit is min(H, W) / 2 pixels
+        median_diameter = radii.median().item() * min(image_size)
+        while bin_size < max_size and bin_size < 2 * median_diameter:
+            bin_size *= 2
+    if points.is_cuda:
+        while 1 + (max_size - 1) // bin_size >= kMaxPointsPerBin:
+            bin_size *= 2
+    if bin_size >= max_size:
+        return 0, max_points_per_bin
+
+    # the cpu kernel stores variable-length bins
+    if not points.is_cuda or max_points_per_bin is not None:
+        return bin_size, max_points_per_bin
+
+    points_per_bin = _count_points_per_bin(
+        points, radii, num_points_per_cloud, image_size, bin_size)
+    max_points_per_bin = max(int(points_per_bin.max()), 1)
+    if points_per_bin.numel() * max_points_per_bin > _kMaxBinEntries:
+        logger_py.debug("Bins too dense (%d points per bin), use naive rasterization."
+                        % max_points_per_bin)
+        return 0, max_points_per_bin
+    return bin_size, max_points_per_bin
+
+
+@profiled('rasterize')
 def rasterize_elliptical_points(pcls_screen, ellipse_params,
                                 cutoff_threshold, radii,
                                 depth_merging_threshold: float = 0.05,
-                                image_size: int = 512,
+                                image_size: Union[int, Tuple[int, int]] = 512,
                                 points_per_pixel: int = 5,
                                 bin_size: Optional[int] = None,
                                 max_points_per_bin: Optional[int] = None,
@@ -698,6 +1070,7 @@ def rasterize_elliptical_points(pcls_screen, ellipse_params,
         ellipse_params (tensor): (N, 3) ellipse parameters per splat,
             the (a,b,c) in ax^2 + bxy + cy^2
         radii (tensor): (N, 2) axis-aligned radius
+        image_size (int or (H, W))
     Returns:
         PointFragments containing [B,C,H,W] maps of
             idx (C=1), f(x) (C=1), zbuf (C=1)
@@ -705,24 +1078,18 @@ def rasterize_elliptical_points(pcls_screen, ellipse_params,
     points_packed = pcls_screen.points_packed()
     cloud_to_packed_first_idx = pcls_screen.cloud_to_packed_first_idx()
     num_points_per_cloud = pcls_screen.num_points_per_cloud()
+    image_size = _parse_image_size(image_size)
 
     cutoff_threshold = cutoff_threshold.expand(points_packed.shape[0])
     # Binning part is from pytorch3d, it creates a local pixel-to-point search
     # list, so that when we iterate over the pixels in the bins, we don't need to iterate *all*
     # the points, but only those that are inside the bin.
     if bin_size is None:
-        # TODO: These heuristics are not well-thought out!
-        if image_size <= 64:
-            bin_size = 8
-        elif image_size <= 256:
-            bin_size = 16
-        elif image_size <= 512:
-            bin_size = 32
-        elif image_size <= 1024:
-            bin_size = 64
-    if bin_size != 0:
-        # There is a limit on the number of points per bin in the cuda kernel.
-        num_bins = 1 + (image_size - 1) // bin_size
+        bin_size, max_points_per_bin = _select_bin_size(
+            points_packed, radii, num_points_per_cloud, image_size, max_points_per_bin)
+    elif bin_size != 0 and points_packed.is_cuda:
+        # There is a limit on the number of bins in the cuda kernel.
+        num_bins = 1 + (max(image_size) - 1) // bin_size
         if num_bins >= kMaxPointsPerBin:
             raise ValueError(
                 "bin_size too small, number of bins must be less than %d; got %d"
@@ -744,6 +1111,247 @@ def rasterize_elliptical_points(pcls_screen, ellipse_params,
     return idx, zbuf, qvalue_map, occ_map
 
 
+@profiled('rasterize_composite')
+def rasterize_composite_elliptical_points(pcls_screen, features, ellipse_params,
+                                          cutoff_threshold, radii, scaler,
+                                          normalize: bool = True,
+                                          depth_merging_threshold: float = 0.05,
+                                          image_size: Union[int, Tuple[int, int]] = 512,
+                                          points_per_pixel: int = 5,
+                                          bin_size: Optional[int] = None,
+                                          radii_backward_scaler: float = 10.0,
+                                          clip_pts_grad: float = -1.0):
+    """
+    rasterize_elliptical_points fused with compositing the per-point features
+    with the weights scaler*exp(-0.5Q), so that the (N,H,W,K) fragments are
+    not materialized. Only implemented on CPU.
+    Args:
+        pcls_screen (tensor): (N, 3) pts in screen space (NDC) coordinates
+        features (tensor): (N, C) per-point features to composite
+        ellipse_params (tensor): (N, 3) ellipse parameters per splat,
+            the (a,b,c) in ax^2 + bxy + cy^2
+        radii (tensor): (N, 2) axis-aligned radius
+        scaler (tensor): (N,) gaussian normalization term per splat
+        normalize (bool): normalize the weights of each pixel by their sum
+        image_size (int or (H, W))
+    Returns:
+        images (B,H,W,C), occupancy (B,H,W) and the (N,) visibility mask
+    """
+    points_packed = pcls_screen.points_packed()
+    cloud_to_packed_first_idx = pcls_screen.cloud_to_packed_first_idx()
+    num_points_per_cloud = pcls_screen.num_points_per_cloud()
+    image_size = _parse_image_size(image_size)
+
+    cutoff_threshold = cutoff_threshold.expand(points_packed.shape[0])
+    if bin_size is None:
+        bin_size, _ = _select_bin_size(
+            points_packed, radii, num_points_per_cloud, image_size)
+
+    if points_packed.requires_grad and clip_pts_grad > 0:
+        points_packed.register_hook(_clip_grad(clip_pts_grad))
+
+    images, occ_map, visibility = EllipticalRasterizeComposite.apply(
+        points_packed, features.contiguous(), ellipse_params, cutoff_threshold, radii,
+        scaler.view(-1), cloud_to_packed_first_idx, num_points_per_cloud,
+        depth_merging_threshold, image_size, points_per_pixel, bin_size,
+        normalize, radii_backward_scaler)
+    return images, occ_map, visibility
+
+
+def _sort_per_cloud(values, cloud_idx):
+    """
+    Sort the values of each cloud along dim 0 without per-cloud loops, i.e.
+    sort by value then by cloud, with unique integer keys so that the sorts
+    need not be stable.
+    Args:
+        values (M, D)
+        cloud_idx (M,) cloud of each value, in ascending order
+    Returns:
+        order (M, D) such that values.gather(0, order) is sorted within each cloud
+    """
+    M = values.shape[0]
+    order = torch.sort(values, dim=0)[1]
+    key = cloud_idx[order] * M + torch.arange(M, device=values.device).unsqueeze(1)
+    return order.gather(0, torch.sort(key, dim=0)[1])
+
+
+def _median_per_cloud(radii, mask, packed_to_cloud_idx, cloud_to_packed_first_idx,
+                      num_masked_per_cloud):
+    """
+    Median of the radii of the masked points of each cloud, i.e.
+    [radii[first:first+num][mask[first:first+num]].median() for each cloud]
+    (the lower median as in torch.median), without per-cloud loops.
+    Args:
+        radii (P, 2) packed radii
+        mask (P,) bool
+        packed_to_cloud_idx (P,)
+        cloud_to_packed_first_idx (N,)
+        num_masked_per_cloud (N,) number of masked points per cloud
+    Returns:
+        (N,) median, 0 for the clouds without masked points
+    """
+    if radii.shape[0] == 0:
+        return radii.new_zeros(num_masked_per_cloud.shape)
+    values = radii.masked_fill(~mask.unsqueeze(1), float('inf')).view(-1)
+    cloud_idx = packed_to_cloud_idx.unsqueeze(1).expand(-1, radii.shape[1]).reshape(-1)
+    # the unmasked values end up at the end of each cloud
+    order = _sort_per_cloud(values.unsqueeze(1), cloud_idx).view(-1)
+    num_values = num_masked_per_cloud * radii.shape[1]
+    # empty clouds at the end start past the last value, their median is masked
+    median_idx = (cloud_to_packed_first_idx * radii.shape[1] + ((num_values - 1) // 2).clamp_min(0)
+                  ).clamp(max=values.shape[0] - 1)
+    return values[order[median_idx]].masked_fill(num_masked_per_cloud == 0, 0)
+
+
+def _splat_points_occ_grid_backward(pts_screen_visible, radii_visible, search_radius, occ_grad,
+                                    num_points_per_cloud, cloud_to_packed_first_idx):
+    """
+    Occlusion backward of the visible points using a uniform 2D grid with
+    cells of half the search radius as spatial index.
+    Args:
+        pts_screen_visible (P, 3) packed visible points
+        radii_visible (P, 2)
+        search_radius (N,)
+        occ_grad (N, H, W)
+        num_points_per_cloud (N,) number of visible points per cloud
+        cloud_to_packed_first_idx (N,)
+    Returns:
+        grad_visible (P, 2)
+    """
+    #####################################
+    #  2a. build the 2D grid
+    #####################################
+    device = pts_screen_visible.device
+    N = num_points_per_cloud.shape[0]
+    P = pts_screen_visible.shape[0]
+    GRID_2D_MAX_RES = 1024
+    GRID_2D_TOTAL = 5
+    RADIUS_CELL_RATIO = 2
+    # setup grid params: grid_min (2), 1/cell_size, grid_res (2), grid_total
+    packed_to_cloud_idx = num_points_2_packed_to_cloud_idx(num_points_per_cloud, P)
+    pts_2D = pts_screen_visible[:, :2]
+    empty_cloud = (num_points_per_cloud == 0).unsqueeze(1)
+    if P > 0:
+        # first and last sorted values of each cloud
+        pts_2D_sorted = pts_2D.gather(0, _sort_per_cloud(pts_2D, packed_to_cloud_idx))
+        grid_min = pts_2D_sorted[cloud_to_packed_first_idx.clamp(max=P - 1)].masked_fill_(empty_cloud, 0)
+        grid_max = pts_2D_sorted[(cloud_to_packed_first_idx + num_points_per_cloud - 1).clamp(0, P - 1)
+                                 ].masked_fill_(empty_cloud, 0)
+    else:
+        grid_min = grid_max = pts_2D.new_zeros((N, 2))
+    grid_size = grid_max - grid_min
+    cell_size = torch.max(search_radius / RADIUS_CELL_RATIO,
+                          grid_size.min(dim=1)[0] / GRID_2D_MAX_RES).clamp_min(1e-8)
+    grid_res = torch.floor(grid_size / cell_size.unsqueeze(1)) + 1
+    grid_params = torch.cat([grid_min, 1 / cell_size.unsqueeze(1), grid_res,
+                             grid_res.prod(dim=1, keepdim=True)], dim=1)
+    # the grid and padded sizes are the only values needed on the host
+    G, max_P = [int(x) for x in torch.stack(
+        [grid_params[:, GRID_2D_TOTAL].max(), num_points_per_cloud.max().to(grid_params)]).tolist()]
+
+    if device.type == "cuda":
+        # insert points into the grid
+        pts_padded = ops3d.packed_to_padded(pts_screen_visible, cloud_to_packed_first_idx, max_P)
+        pts_padded_2D = pts_padded[:, :, :2].contiguous()
+        pc_grid_cnt = torch.zeros((N, G), dtype=torch.int, device=device)
+        pc_grid_cell = torch.full((N, max_P), -1, dtype=torch.int, device=device)
+        pc_grid_idx = torch.full((N, max_P), -1, dtype=torch.int, device=device)
+        frnn._C.insert_points_cuda(pts_padded_2D, num_points_per_cloud, grid_params, pc_grid_cnt, pc_grid_cell, pc_grid_idx, G)
+
+        # exclusive prefix sum of the cell counts of all grids at once
+        pc_grid_off = (torch.cumsum(pc_grid_cnt, dim=1) - pc_grid_cnt).int()
+
+        # sort points according to their grid positions and insertion orders
+        # sort based on x, y first. Then we will use points_sorted_idxs to recover the points_sorted with Z
+        points_sorted = torch.zeros((N, max_P, 2), dtype=torch.float, device=device)
+        points_sorted_idxs = torch.full((N, max_P), -1, dtype=torch.int, device=device)
+        frnn._C.counting_sort_cuda(
+            pts_padded_2D,
+            num_points_per_cloud,
+            pc_grid_cell,
+            pc_grid_idx,
+            pc_grid_off,
+            points_sorted,      # (N,P,2)
+            points_sorted_idxs  # (N,P)
+        )
+        # padded entries of points_sorted_idxs are -1
+        new_points_sorted = torch.gather(
+            pts_padded, 1, points_sorted_idxs.long().clamp_min(0).unsqueeze(2).expand(-1, -1, 3))
+
+        # convert sorted_points and sorted_points_idxs to packed (P, )
+        points_sorted = ops3d.padded_to_packed(new_points_sorted, cloud_to_packed_first_idx, P)
+        # padded_to_packed only supports torch.float32...
+        shifted_points_sorted_idxs = points_sorted_idxs+cloud_to_packed_first_idx.float().unsqueeze(1)
+        points_sorted_idxs = ops3d.padded_to_packed(shifted_points_sorted_idxs, cloud_to_packed_first_idx, P)
+        points_sorted_idxs_2D = points_sorted_idxs.long().unsqueeze(1).expand(-1, 2)
+        radii_sorted = torch.gather(radii_visible, 0, points_sorted_idxs_2D)
+        pc_grid_off += cloud_to_packed_first_idx.unsqueeze(1)
+        grad_sorted = _C._splat_points_occ_fast_backward(points_sorted, radii_sorted, search_radius, occ_grad,
+            num_points_per_cloud, cloud_to_packed_first_idx, pc_grid_off, grid_params)
+        return torch.zeros_like(grad_sorted).scatter_(0, points_sorted_idxs_2D, grad_sorted)
+
+    # The CPU kernel buckets the active pixels into the grid and every point
+    # visits the cells around it, so the points need not be sorted by cell and
+    # the cell offsets are not used, only their number of cells G.
+    pc_grid_off = torch.empty((N, G), dtype=torch.int, device=device)
+    return _C._splat_points_occ_fast_backward(pts_screen_visible, radii_visible, search_radius, occ_grad,
+        num_points_per_cloud, cloud_to_packed_first_idx, pc_grid_off, grid_params)
+
+
+def _bins_to_csr(bin_points):
+    """
+    Convert (N, BH, BW, M) bins padded with -1 to CSR layout.
+    Returns:
+        bin_points (T,) int32 packed point indices of all bins
+        bin_offsets (N*BH*BW+1,) int64 the points of bin i are
+            bin_points[bin_offsets[i]:bin_offsets[i+1]]
+    """
+    bin_mask = bin_points >= 0
+    bin_offsets = F.pad(torch.cumsum(bin_mask.sum(dim=-1).view(-1), 0), (1, 0))
+    return bin_points[bin_mask].int(), bin_offsets
+
+
+def _splat_points_occ_fast_backward(pts_screen, radii, pts_visibility, occ_grad,
+                                    cloud_to_packed_first_idx, num_points_per_cloud,
+                                    radii_s, bin_points=None, bin_offsets=None, bin_size=0):
+    """
+    Gradients of the occupancy w.r.t. the screen space xy of the visible points,
+    the search radius is the median radius of the visible points times radii_s.
+    Args:
+        pts_screen (P, 3), radii (P, 2), pts_visibility (P,) bool
+        occ_grad (N, H, W)
+        bin_points, bin_offsets: the bins of the forward pass, used as
+            spatial index if given, otherwise a uniform 2D grid is built
+    Returns:
+        grads_input_xy (P, 2), zero for invisible points
+    """
+    P = pts_screen.shape[0]
+    packed_to_cloud_idx = num_points_2_packed_to_cloud_idx(num_points_per_cloud, P)
+    num_visible_per_cloud = torch.zeros_like(num_points_per_cloud).scatter_add_(
+        0, packed_to_cloud_idx, pts_visibility.to(num_points_per_cloud.dtype))
+
+    # determine search radius as median(radii)*radii_s
+    search_radius = _median_per_cloud(
+        radii, pts_visibility, packed_to_cloud_idx,
+        cloud_to_packed_first_idx, num_visible_per_cloud) * radii_s
+    if bin_points is not None:
+        # reuse the bins of the forward pass as spatial index
+        if bin_offsets is None:
+            bin_points, bin_offsets = _bins_to_csr(bin_points)
+        return _C._splat_points_occ_binned_backward(
+            pts_screen, radii, pts_visibility, search_radius, occ_grad,
+            bin_points, bin_offsets, bin_size)
+
+    grad_visible = _splat_points_occ_grid_backward(
+        pts_screen[pts_visibility], radii[pts_visibility], search_radius, occ_grad,
+        num_visible_per_cloud, num_points_2_cloud_to_packed_first_idx(num_visible_per_cloud))
+    if get_debugging_mode() and not torch.isfinite(grad_visible).all():
+        print('invalid grad_visible')
+    grads_input_xy = pts_screen.new_zeros(P, 2)
+    grads_input_xy[pts_visibility] = grad_visible
+    return grads_input_xy
+
+
 class EllipticalRasterizer(autograd.Function):
     @staticmethod
     def forward(ctx, pts_screen, ellipse_param, cutoff_threshold, radii,
@@ -756,35 +1364,52 @@ class EllipticalRasterizer(autograd.Function):
                 radii_backward_scaler: float = 10.0,
                 ):
         """
-        TODO: save if bin_points if bin_size is not 0, and reuse in the backward pass
+        If bin_size is not 0, the bins of the coarse rasterization are saved
+        and reused as spatial index in the backward pass.
+        image_size is a (H, W) tuple.
         """
-        args = (
-            pts_screen,
-            ellipse_param,
-            cutoff_threshold,
-            radii,
-            cloud_to_packed_first_idx,
-            num_points_per_cloud,
-            depth_merging_threshold,
-            image_size,
-            points_per_pixel,
-            bin_size,
-            max_points_per_bin,
-        )
-        idx, zbuf, qvalue_map, occ_map = _C.splat_points(*args)
+        bin_points, bin_offsets = None, None
+        if bin_size == 0:
+            idx, zbuf, qvalue_map, occ_map = _C.splat_points(
+                pts_screen, ellipse_param, cutoff_threshold, radii,
+                cloud_to_packed_first_idx, num_points_per_cloud,
+                depth_merging_threshold, image_size, points_per_pixel,
+                bin_size, max_points_per_bin)
+        elif pts_screen.is_cuda:
+            # (N, BH, BW, M) bins padded with -1
+            bin_points = _C._rasterize_coarse(
+                pts_screen, radii, cloud_to_packed_first_idx, num_points_per_cloud,
+                image_size, bin_size, max_points_per_bin)
+            idx, zbuf, qvalue_map, occ_map = _C._rasterize_fine(
+                pts_screen, ellipse_param, cutoff_threshold, radii, bin_points,
+                depth_merging_threshold, image_size, bin_size, points_per_pixel)
+        else:
+            # variable-length bins in CSR layout
+            bin_points, bin_offsets = _C._rasterize_coarse_csr(
+                pts_screen, radii, cloud_to_packed_first_idx, num_points_per_cloud,
+                image_size, bin_size)
+            idx, zbuf, qvalue_map, occ_map = _C._rasterize_fine_csr(
+                pts_screen, ellipse_param, cutoff_threshold, radii, bin_points, bin_offsets,
+                depth_merging_threshold, image_size, bin_size, points_per_pixel)
 
         ctx.radii_backward_scaler = radii_backward_scaler
         ctx.depth_merging_threshold = depth_merging_threshold
+        ctx.bin_size = bin_size
+        # the backward pass ignores the gradients w.r.t. the qvalues, so the
+        # compositors can skip the gradients w.r.t. the weights
+        ctx.mark_non_differentiable(qvalue_map)
         if radii_backward_scaler == 0:
             ctx.save_for_backward(
                 pts_screen, idx, ellipse_param, cutoff_threshold)
         else:
             zbuf0 = zbuf[..., 0].clone()
             ctx.save_for_backward(pts_screen, ellipse_param, cutoff_threshold, radii, idx, zbuf0,
-                                  cloud_to_packed_first_idx, num_points_per_cloud)
+                                  cloud_to_packed_first_idx, num_points_per_cloud,
+                                  bin_points, bin_offsets)
         return idx, zbuf, qvalue_map, occ_map
 
     @staticmethod
+    @profiled('rasterize_backward')
     def backward(ctx, idx_grad, zbuf_grad, qvalue_grad, occ_grad):
         # idx_grad and zbuf_grad are None (unless maybe we make weights depend on z? i.e. volumetric splatting)
 
@@ -810,7 +1435,7 @@ class EllipticalRasterizer(autograd.Function):
         # either use OccRBFBackward or use OccBackward
         pts_screen, ellipse_param, cutoff_threshold, radii, idx, zbuf0, \
             cloud_to_packed_first_idx, num_points_per_cloud, \
-            = ctx.saved_tensors
+            bin_points, bin_offsets = ctx.saved_tensors
         depth_merging_threshold = ctx.depth_merging_threshold
 
         backward_occ_fast = True
@@ -846,135 +1471,95 @@ class EllipticalRasterizer(autograd.Function):
             """
             We only care about rasterized points (visible points)
             1. Filter [P,*] data to [P_visible,*] data
-            2. Fast backward cuda
-                2a. call FRNN insertion
-                2b. count_sort
+            2. Fast backward (cuda or cpu) using a spatial index of the points:
+                the bins of the forward pass if available, otherwise
+                2a. insert points into a uniform 2D grid (FRNN on cuda)
+                2b. count_sort (cuda only, the cpu kernel takes the points unsorted)
             """
-            device = pts_screen.device
-            mask = (idx[..., 0] >= 0).bool()  # float
-            pts_visibility = torch.full(
-                (pts_screen.shape[0],), False, dtype=torch.bool, device=pts_screen.device)
-            # all rendered points (indices in packed points)
-            visible_idx = idx[mask].unique().long().view(-1)
-            visible_idx = visible_idx[visible_idx >= 0]
-            pts_visibility[visible_idx] = True
-            num_points_per_cloud = torch.stack([x.sum() for x in torch.split(
-                pts_visibility, num_points_per_cloud.tolist(), dim=0)])
-            cloud_to_packed_first_idx = num_points_2_cloud_to_packed_first_idx(
-                num_points_per_cloud)
-
-            pts_screen_visible = pts_screen[pts_visibility]
-            radii_visible = radii[pts_visibility]
-
-            #####################################
-            #  2a. call FRNN insertion
-            #####################################
-            N = num_points_per_cloud.shape[0]
-            P = pts_screen_visible.shape[0]
-            assert(num_points_per_cloud.sum().item()==P)
-            # from frnn.frnn import GRID_PARAMS_SIZE, MAX_RES, prefix_sum_cuda
-            # imported from
-            from prefix_sum import prefix_sum_cuda
-            GRID_2D_PARAMS_SIZE = 6
-            GRID_2D_MAX_RES = 1024
-            GRID_2D_DELTA = 2
-            GRID_2D_TOTAL = 5
-            RADIUS_CELL_RATIO = 2
-            # first convert to padded
-            max_P = num_points_per_cloud.max().item()
-            pts_padded = ops3d.packed_to_padded(pts_screen_visible, cloud_to_packed_first_idx, max_P)
-            radii_padded = ops3d.packed_to_padded(radii_visible, cloud_to_packed_first_idx, max_P)
-            # determine search radius as max(radii)*radii_s
-            search_radius = torch.tensor([radii_padded[i, :num_points_per_cloud[i]].median() * radii_s for i in range(N)], dtype=torch.float, device=device)
-            # create grid from scratch
-            # setup grid params
-            grid_params_cuda = torch.zeros((N, GRID_2D_PARAMS_SIZE), dtype=torch.float, device=pts_padded.device)
-            G = -1
-            pts_padded_2D = pts_padded[:, :, :2].clone().contiguous()
-            for i in range(N):
-                # 0-2 grid_min; 3 grid_delta; 4-6 grid_res; 7 grid_total
-                grid_min = pts_padded_2D[i, :num_points_per_cloud[i]].min(dim=0)[0]
-                grid_max = pts_padded_2D[i, :num_points_per_cloud[i]].max(dim=0)[0]
-                grid_params_cuda[i, :GRID_2D_DELTA] = grid_min
-                grid_size = grid_max - grid_min
-                cell_size = search_radius[i].item() / RADIUS_CELL_RATIO
-                if cell_size < grid_size.min()/GRID_2D_MAX_RES:
-                    cell_size = grid_size.min() / GRID_2D_MAX_RES
-                grid_params_cuda[i, GRID_2D_DELTA] = 1 / cell_size
-                grid_params_cuda[i, GRID_2D_DELTA+1:GRID_2D_TOTAL] = torch.floor(grid_size / cell_size) + 1
-                grid_params_cuda[i, GRID_2D_TOTAL] = torch.prod(grid_params_cuda[i, GRID_2D_DELTA+1:GRID_2D_TOTAL])
-                if G < grid_params_cuda[i, GRID_2D_TOTAL]:
-                    G = int(grid_params_cuda[i, GRID_2D_TOTAL].item())
-
-            # insert points into the grid
-            pc_grid_cnt = torch.zeros((N, G), dtype=torch.int, device=device)
-            pc_grid_cell = torch.full((N, max_P), -1, dtype=torch.int, device=device)
-            pc_grid_idx = torch.full((N, max_P), -1, dtype=torch.int, device=device)
-            frnn._C.insert_points_cuda(pts_padded_2D, num_points_per_cloud, grid_params_cuda, pc_grid_cnt, pc_grid_cell, pc_grid_idx, G)
-
-            # use prefix_sum from Matt Dean
-            grid_params = grid_params_cuda.cpu()
-            pc_grid_off = torch.full((N, G), 0, dtype=torch.int, device=device)
-            for i in range(N):
-                prefix_sum_cuda(pc_grid_cnt[i], grid_params[i, GRID_2D_TOTAL], pc_grid_off[i])
-
-            # sort points according to their grid positions and insertion orders
-            # sort based on x, y first. Then we will use points_sorted_idxs to recover the points_sorted with Z
-            points_sorted = torch.zeros((N, max_P, 2), dtype=torch.float, device=device)
-            points_sorted_idxs = torch.full((N, max_P), -1, dtype=torch.int, device=device)
-            frnn._C.counting_sort_cuda(
-                pts_padded_2D,
-                num_points_per_cloud,
-                pc_grid_cell,
-                pc_grid_idx,
-                pc_grid_off,
-                points_sorted,      # (N,P,2)
-                points_sorted_idxs  # (N,P)
-            )
-            new_points_sorted = torch.zeros_like(pts_padded)
-            for i in range(N):
-                points_sorted_idxs_i = points_sorted_idxs[i, :num_points_per_cloud[i]].long().unsqueeze(1).expand(-1, 3)
-                new_points_sorted[i, :num_points_per_cloud[i]] = torch.gather(pts_padded[i], 0, points_sorted_idxs_i)
-                # print(points_sorted[i, :10])
-                # print(new_points_sorted[i, :10])
-            # new_points_sorted = torch.gather(pts_padded, 1, points_sorted_idxs.long().unsqueeze(2).expand(-1, -1, 3))
-
-            assert(new_points_sorted is not None and pc_grid_off is not None and points_sorted_idxs is not None and grid_params_cuda is not None)
-            # convert sorted_points and sorted_points_idxs to packed (P, )
-            points_sorted = ops3d.padded_to_packed(new_points_sorted, cloud_to_packed_first_idx, P)
-            # padded_to_packed only supports torch.float32...
-            shifted_points_sorted_idxs = points_sorted_idxs+cloud_to_packed_first_idx.float().unsqueeze(1)
-            points_sorted_idxs = ops3d.padded_to_packed(shifted_points_sorted_idxs, cloud_to_packed_first_idx, P)
-            points_sorted_idxs_2D = points_sorted_idxs.long().unsqueeze(1).expand(-1, 2)
-            radii_sorted = torch.gather(radii_visible, 0, points_sorted_idxs_2D)
-            pc_grid_off += cloud_to_packed_first_idx.unsqueeze(1)
-            grad_sorted = _C._splat_points_occ_fast_cuda_backward(points_sorted, radii_sorted, search_radius, occ_grad,
-                num_points_per_cloud, cloud_to_packed_first_idx, pc_grid_off, grid_params_cuda)
-            # grad_sorted_slow = _C._splat_points_occ_backward(points_sorted, radii_sorted,
-            #                                             occ_grad, cloud_to_packed_first_idx, num_points_per_cloud,
-            #                                             radii_s, depth_merging_threshold)
-            # breakpoint()
-            # points_sorted_idxs_3D = points_sorted_idxs.long().unsqueeze(1).expand(-1, 3)
-            # print(points_sorted_idxs_3D.max(), grad_sorted.shape[0])
-            grad_visible = torch.zeros_like(grad_sorted).scatter_(0, points_sorted_idxs_2D, grad_sorted)
-            # grad_visible_slow = _C._splat_points_occ_backward(pts_screen[pts_visibility], radii[pts_visibility],
-            #                                             occ_grad, cloud_to_packed_first_idx, num_points_per_cloud,
-            #                                             radii_s, depth_merging_threshold)
-            # breakpoint()
-            if torch.isnan(grad_visible).any() or not torch.isfinite(grad_visible).all():
-                print('invalid grad_visible')
-            assert(pts_visibility.sum() == grad_visible.shape[0])
-            grads_input_xy = pts_screen.new_zeros(pts_screen.shape[0], 2)
+            P = pts_screen.shape[0]
+            # all rendered points (indices in packed points), the -1 entries
+            # are scattered to an extra first element
+            pts_visibility = pts_screen.new_zeros(P + 1, dtype=torch.bool).index_fill_(
+                0, idx.view(-1).long() + 1, True)[1:]
+            grads_input_xy = _splat_points_occ_fast_backward(
+                pts_screen, radii, pts_visibility, occ_grad,
+                cloud_to_packed_first_idx, num_points_per_cloud, radii_s,
+                bin_points, bin_offsets, ctx.bin_size)
             grads_input_z = pts_screen.new_zeros(pts_screen.shape[0], 1)
-            # print("1")
-            grads_input_xy[pts_visibility] = grad_visible
             _C._backward_zbuf(idx, zbuf_grad, grads_input_z)
             grads_input = torch.cat([grads_input_xy, grads_input_z], dim=-1)
-            # print("2")
 
         pts_grad = grads_input
 
         return (pts_grad, None) + grads
 
 
+class EllipticalRasterizeComposite(autograd.Function):
+    @staticmethod
+    def forward(ctx, pts_screen, features, ellipse_param, cutoff_threshold, radii, scaler,
+                cloud_to_packed_first_idx, num_points_per_cloud,
+                depth_merging_threshold,
+                image_size,
+                points_per_pixel,
+                bin_size: int = 0,
+                normalize: bool = True,
+                radii_backward_scaler: float = 10.0,
+                ):
+        """
+        Fused rasterization and compositing on CSR bins, bin_size 0 uses a
+        single bin per cloud. Only the composited points and their weights of
+        each pixel (if the features require gradients), the per-point
+        visibility and the bins (unless bin_size is 0, then the backward pass
+        builds a grid) are kept for the backward pass.
+        image_size is a (H, W) tuple.
+        """
+        if pts_screen.is_cuda:
+            raise NotImplementedError(
+                "Fused rasterization and compositing is only implemented on CPU")
+        # a single bin per cloud
+        single_bin = bin_size == 0
+        if single_bin:
+            bin_size = max(image_size)
+        bin_points, bin_offsets = _C._rasterize_coarse_csr(
+            pts_screen, radii, cloud_to_packed_first_idx, num_points_per_cloud,
+            image_size, bin_size)
+        images, occ_map, visibility, idx, weights = _C._splat_composite_points(
+            pts_screen, ellipse_param, cutoff_threshold, radii, scaler, features,
+            bin_points, bin_offsets, depth_merging_threshold, image_size, bin_size,
+            points_per_pixel, normalize, ctx.needs_input_grad[1])
+
+        ctx.radii_backward_scaler = radii_backward_scaler
+        ctx.bin_size = bin_size
+        ctx.mark_non_differentiable(visibility)
+        if single_bin:
+            # the binned backward would run one task per cloud, use the grid
+            # backward as the unfused rasterizer does
+            bin_points, bin_offsets = None, None
+        ctx.save_for_backward(pts_screen, radii, visibility,
+                              cloud_to_packed_first_idx, num_points_per_cloud,
+                              bin_points, bin_offsets, idx, weights)
+        return images, occ_map, visibility
+
+    @staticmethod
+    @profiled('rasterize_composite_backward')
+    def backward(ctx, images_grad, occ_grad, visibility_grad):
+        pts_screen, radii, visibility, cloud_to_packed_first_idx, num_points_per_cloud, \
+            bin_points, bin_offsets, idx, weights = ctx.saved_tensors
+
+        pts_grad = None
+        features_grad = None
+        if ctx.needs_input_grad[0]:
+            grads_input_xy = _splat_points_occ_fast_backward(
+                pts_screen, radii, visibility, occ_grad,
+                cloud_to_packed_first_idx, num_points_per_cloud, ctx.radii_backward_scaler,
+                bin_points, bin_offsets, ctx.bin_size)
+            # the zbuf is not an output, hence no gradients w.r.t. z
+            pts_grad = torch.cat([grads_input_xy, pts_screen.new_zeros(pts_screen.shape[0], 1)], dim=-1)
+        if ctx.needs_input_grad[1]:
+            features_grad = _C._splat_composite_points_backward(
+                images_grad, idx, weights, pts_screen.shape[0])
+
+        return (pts_grad, features_grad) + (None,) * 12
+
+
 __all__ = [k for k in globals().keys() if not k.startswith("_")]
@@ -1,6 +1,8 @@
 import torch
-from pytorch3d.renderer import PointsRenderer, NormWeightedCompositor
-from pytorch3d.renderer.compositing import weighted_sum
+from pytorch3d.renderer import PointsRenderer
+from pytorch3d.renderer import NormWeightedCompositor as _Pytorch3dNormWeightedCompositor
+from .compositing import weighted_sum, WeightedCompositor
+from ..utils.profiling import profile_stage, profiled
 from .. import logger_py
 
 
@@ -14,7 +16,14 @@ Returns a 4-Channel image for RGBA
 class SurfaceSplattingRenderer(PointsRenderer):
 
     def __init__(self, rasterizer, compositor, antialiasing_sigma: float = 1.0,
-                 density: float = 1e-4, frnn_radius=-1):
+                 density: float = 1e-4, frnn_radius=-1, fused: bool = False):
+        """
+        compositor: NormWeightedCompositor or WeightedCompositor, None
+            composites with weighted sum
+        fused: rasterize and composite in one pass on CPU without creating the
+            fragments, only supported with (Norm)WeightedCompositor or weighted sum
+            (compositor is None)
+        """
         super().__init__(rasterizer, compositor)
 
         self.cameras = self.rasterizer.cameras
@@ -26,13 +35,22 @@ class SurfaceSplattingRenderer(PointsRenderer):
 
         if self.compositor is None:
             logger_py.info('Composite with weighted sum.')
-        elif not isinstance(self.compositor, NormWeightedCompositor):
+        elif not isinstance(self.compositor, (WeightedCompositor, _Pytorch3dNormWeightedCompositor)):
             logger_py.warning('Expect a NormWeightedCompositor, but initialized with {}'.format(
                 self.compositor.__class__.__name__))
 
         self.frnn_radius = frnn_radius
+
+        self.fused = fused
+        if self.fused and not (self.compositor is None or
+                               isinstance(self.compositor, (WeightedCompositor,
+                                                            _Pytorch3dNormWeightedCompositor))):
+            logger_py.warning('Fused compositing is not supported with {}, disabled.'.format(
+                self.compositor.__class__.__name__))
+            self.fused = False
         # logger_py.error("frnn_radius: {}".format(frnn_radius))
 
+    @profiled('render')
     def forward(self, point_clouds, **kwargs) -> torch.Tensor:
         """
         point_clouds_filter: used to get activation mask and update visibility mask
@@ -43,33 +61,45 @@ class SurfaceSplattingRenderer(PointsRenderer):
 
         # rasterize
         fragments = kwargs.get('fragments', None)
+        if (self.fused and fragments is None and not kwargs.get('verbose', False)
+                and not point_clouds.points_packed().is_cuda):
+            normalize = self.compositor is not None and getattr(self.compositor, 'normalize', True)
+            images, _ = self.rasterizer.rasterize_and_composite(
+                point_clouds, normalize=normalize, **kwargs)
+            # as the compositors, set the pixels without points to the background
+            background_color = kwargs.get(
+                'background_color', getattr(self.compositor, 'background_color', None))
+            if background_color is not None:
+                rgb, occ = images[..., :-1], images[..., -1:]
+                background_color = images.new_tensor(background_color).view(1, 1, 1, -1)
+                images = torch.cat([torch.where(occ > 0, rgb, background_color), occ], dim=-1)
+            return images
+
         if fragments is None:
             if kwargs.get('verbose', False):
                 fragments, point_clouds, per_point_info = self.rasterizer(point_clouds, **kwargs)
             else:
                 fragments, point_clouds = self.rasterizer(point_clouds, **kwargs)
 
-        # compute weight: scalar*exp(-0.5Q)
-        weights = torch.exp(-0.5 * fragments.qvalue) * fragments.scaler
-        weights = weights.permute(0, 3, 1, 2)
+        with profile_stage('composite'):
+            # compute weight: scalar*exp(-0.5Q)
+            weights = torch.exp(-0.5 * fragments.qvalue) * fragments.scaler
+            weights = weights.permute(0, 3, 1, 2)
 
-        # from fragments to rgba
-        pts_rgb = point_clouds.features_packed()[:, :3]
+            # from fragments to rgba
+            pts_rgb = point_clouds.features_packed()[:, :3]
 
-        if self.compositor is None:
-            # NOTE: weight _splat_points_weights_backward, weighted sum will return
-            # zero gradient for the weights.
-            images = weighted_sum(fragments.idx.long().permute(0, 3, 1, 2),
-                                  weights,
-                                  pts_rgb.permute(1, 0),
-                                  **kwargs)
-        else:
-            images = self.compositor(
-                fragments.idx.long().permute(0, 3, 1, 2),
-                weights,
-                pts_rgb.permute(1, 0),
-                **kwargs
-            )
+            if self.compositor is None:
+                images = weighted_sum(fragments.idx.long().permute(0, 3, 1, 2),
+                                      weights,
+                                      pts_rgb.permute(1, 0))
+            else:
+                images = self.compositor(
+                    fragments.idx.long().permute(0, 3, 1, 2),
+                    weights,
+                    pts_rgb.permute(1, 0),
+                    **kwargs
+                )
 
         # permute so image comes at the end
         images = images.permute(0, 2, 3, 1)
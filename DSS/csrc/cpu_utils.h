@@ -0,0 +1,34 @@
+#ifndef _CPU_UTILS_H
+#define _CPU_UTILS_H
+#include <cstdint>
+#include <numeric>
+#include <vector>
+
+// Groups the entries of a flat buffer of point indices by the point they
+// refer to in CSR layout: the entries e with idx[e] == p are
+//   entries[offsets[p]:offsets[p + 1]]
+// in increasing order. Negative indices (no point) are skipped. The backward
+// passes then sum the gradients of every point in the task visiting it
+// instead of scattering them into per-thread copies of the gradients.
+template <typename index_t>
+inline void GroupEntriesByPoint(
+    const index_t *idx, const int64_t num_entries, const int64_t P,
+    std::vector<int64_t> &offsets, std::vector<int64_t> &entries)
+{
+  offsets.assign(P + 1, 0);
+  for (int64_t e = 0; e < num_entries; ++e)
+  {
+    if (idx[e] >= 0)
+      offsets[idx[e] + 1]++;
+  }
+  std::partial_sum(offsets.begin(), offsets.end(), offsets.begin());
+  std::vector<int64_t> fill(offsets.begin(), offsets.end() - 1);
+  entries.resize(offsets[P]);
+  for (int64_t e = 0; e < num_entries; ++e)
+  {
+    if (idx[e] >= 0)
+      entries[fill[idx[e]]++] = e;
+  }
+}
+
+#endif
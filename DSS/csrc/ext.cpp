@@ -1,5 +1,7 @@
 #include <torch/extension.h>
 #include "rasterize_points.h"
+#include "weighted_sum.h"
+#include "projection_loss.h"
 
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
@@ -10,9 +12,19 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("_splat_points_occ_backward", &RasterizePointsOccBackward);
   m.def("_rasterize_coarse", &RasterizePointsCoarse);
   m.def("_rasterize_fine", &RasterizePointsFine);
+  m.def("_rasterize_coarse_csr", &RasterizePointsCoarseCsr);
+  m.def("_rasterize_fine_csr", &RasterizePointsFineCsr);
+  m.def("_splat_composite_points", &RasterizeCompositePointsCsr);
+  m.def("_splat_composite_points_backward", &RasterizeCompositePointsBackward);
 #ifdef WITH_CUDA
   m.def("_splat_points_occ_fast_cuda_backward", &RasterizePointsBackwardCudaFast);
 #endif
+  m.def("_splat_points_occ_fast_backward", &RasterizePointsOccBackwardFast);
+  m.def("_splat_points_occ_binned_backward", &RasterizePointsOccBackwardBinned);
   m.def("_splat_points_occ_backward", &RasterizePointsOccBackward);
   m.def("_backward_zbuf", &RasterizeZbufBackward);
+  m.def("_weighted_sum", &weightedSumForward);
+  m.def("_weighted_sum_backward", &weightedSumBackward);
+  m.def("_projection_loss", &ProjectionLossForward);
+  m.def("_projection_loss_backward", &ProjectionLossBackward);
 }
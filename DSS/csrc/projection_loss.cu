@@ -0,0 +1,236 @@
+#include <ATen/ATen.h>
+#include <ATen/core/TensorAccessor.h>
+#include <ATen/cuda/CUDAContext.h>
+#include <c10/cuda/CUDAGuard.h>
+
+#include <cuda.h>
+#include <cuda_runtime.h>
+
+// See projection_loss.h for the definition of the loss. One thread computes
+// the loss (and the gradient) of one point, reading its K neighbors.
+
+// Lower bound of the sum of the weights of a point, as eps_denom.
+__constant__ const float kWeightSumEpsilon = 1e-17;
+// Lower bound of the norm of the normals, as torch.nn.functional.normalize.
+__constant__ const float kNormalEpsilon = 1e-12;
+
+__device__ inline void NormalizedNormal(
+    const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits>& normals,
+    const int64_t p,
+    float* n) {
+  const float norm = fmaxf(
+      sqrtf(normals[p][0] * normals[p][0] + normals[p][1] * normals[p][1] +
+            normals[p][2] * normals[p][2]),
+      kNormalEpsilon);
+  for (int d = 0; d < 3; ++d)
+    n[d] = normals[p][d] / norm;
+}
+
+// Weight w_ik and signed distance sdf_ik of the k-th neighbor of point i,
+// ni being the normalized normal of point i. Returns the (unnormalized)
+// normal of the neighbor in nj, zero for an invalid neighbor.
+__device__ inline void NeighborWeightAndSdf(
+    // clang-format off
+    const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits>& points,
+    const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits>& normals,
+    const at::PackedTensorAccessor64<int64_t, 2, at::RestrictPtrTraits>& knn_idx,
+    const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits>& phi,
+    const at::PackedTensorAccessor64<bool, 1, at::RestrictPtrTraits>& visibility,
+    // clang-format on
+    const float inv_sigma2,
+    const float invisible_weight,
+    const int64_t i,
+    const int k,
+    const float* ni,
+    float* nj,
+    float& w,
+    float& sdf) {
+  const int64_t j = knn_idx[i][k];
+  float xj[3] = {0.0f, 0.0f, 0.0f};
+  float nj_normalized[3] = {0.0f, 0.0f, 0.0f};
+  nj[0] = nj[1] = nj[2] = 0.0f;
+  if (j >= 0) {
+    for (int d = 0; d < 3; ++d) {
+      xj[d] = points[j][d];
+      nj[d] = normals[j][d];
+    }
+    NormalizedNormal(normals, j, nj_normalized);
+  }
+  float normal_diff2 = 0.0f;
+  sdf = 0.0f;
+  for (int d = 0; d < 3; ++d) {
+    const float diff = nj_normalized[d] - ni[d];
+    normal_diff2 += diff * diff;
+    sdf += (xj[d] - points[i][d]) * nj[d];
+  }
+  const float visibility_w =
+      (j >= 0 && visibility[j]) ? 1.0f : invisible_weight;
+  w = phi[i][k] * __expf(-normal_diff2 * inv_sigma2) * visibility_w;
+}
+
+__global__ void ProjectionLossCudaForwardKernel(
+    // clang-format off
+    at::PackedTensorAccessor64<float, 1, at::RestrictPtrTraits> loss,
+    const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits> points,
+    const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits> normals,
+    const at::PackedTensorAccessor64<int64_t, 2, at::RestrictPtrTraits> knn_idx,
+    const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits> phi,
+    const at::PackedTensorAccessor64<bool, 1, at::RestrictPtrTraits> visibility,
+    // clang-format on
+    const float inv_sigma2,
+    const float invisible_weight) {
+  const int64_t P = points.size(0);
+  const int K = knn_idx.size(1);
+  const int64_t num_threads = gridDim.x * blockDim.x;
+  const int64_t tid = blockIdx.x * blockDim.x + threadIdx.x;
+
+  for (int64_t i = tid; i < P; i += num_threads) {
+    float ni[3], nj[3];
+    NormalizedNormal(normals, i, ni);
+    float sum_w = 0.0f;
+    float sum_wd = 0.0f;
+    for (int k = 0; k < K; ++k) {
+      float w, sdf;
+      NeighborWeightAndSdf(
+          points, normals, knn_idx, phi, visibility, inv_sigma2,
+          invisible_weight, i, k, ni, nj, w, sdf);
+      sum_w += w;
+      sum_wd += w * sdf * sdf;
+    }
+    loss[i] = sum_wd / fmaxf(sum_w, kWeightSumEpsilon);
+  }
+}
+
+__global__ void ProjectionLossCudaBackwardKernel(
+    // clang-format off
+    at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits> grad_points,
+    const at::PackedTensorAccessor64<float, 1, at::RestrictPtrTraits> grad_loss,
+    const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits> points,
+    const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits> normals,
+    const at::PackedTensorAccessor64<int64_t, 2, at::RestrictPtrTraits> knn_idx,
+    const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits> phi,
+    const at::PackedTensorAccessor64<bool, 1, at::RestrictPtrTraits> visibility,
+    // clang-format on
+    const float inv_sigma2,
+    const float invisible_weight) {
+  const int64_t P = points.size(0);
+  const int K = knn_idx.size(1);
+  const int64_t num_threads = gridDim.x * blockDim.x;
+  const int64_t tid = blockIdx.x * blockDim.x + threadIdx.x;
+
+  // d loss[i] / d points[i] = -2 * sum_k w_ik * sdf_ik * normals[j] / sum_k w_ik,
+  // only the query point gets a gradient, so no atomics are needed
+  for (int64_t i = tid; i < P; i += num_threads) {
+    const float grad_i = grad_loss[i];
+    if (grad_i == 0.0f) {
+      continue;
+    }
+    float ni[3], nj[3];
+    NormalizedNormal(normals, i, ni);
+    float sum_w = 0.0f;
+    float grad[3] = {0.0f, 0.0f, 0.0f};
+    for (int k = 0; k < K; ++k) {
+      float w, sdf;
+      NeighborWeightAndSdf(
+          points, normals, knn_idx, phi, visibility, inv_sigma2,
+          invisible_weight, i, k, ni, nj, w, sdf);
+      sum_w += w;
+      for (int d = 0; d < 3; ++d)
+        grad[d] += w * sdf * nj[d];
+    }
+    const float scale = -2.0f * grad_i / fmaxf(sum_w, kWeightSumEpsilon);
+    for (int d = 0; d < 3; ++d)
+      grad_points[i][d] = grad[d] * scale;
+  }
+}
+
+at::Tensor ProjectionLossCudaForward(
+    const at::Tensor& points,
+    const at::Tensor& normals,
+    const at::Tensor& knn_idx,
+    const at::Tensor& phi,
+    const at::Tensor& visibility,
+    const float sharpness_sigma,
+    const float invisible_weight) {
+  // Check inputs are on the same device
+  at::TensorArg points_t{points, "points", 1}, normals_t{normals, "normals", 2},
+      knn_idx_t{knn_idx, "knn_idx", 3}, phi_t{phi, "phi", 4},
+      visibility_t{visibility, "visibility", 5};
+  at::CheckedFrom c = "ProjectionLossCudaForward";
+  at::checkAllSameGPU(
+      c, {points_t, normals_t, knn_idx_t, phi_t, visibility_t});
+  at::checkAllSameType(c, {points_t, normals_t, phi_t});
+
+  // Set the device for the kernel launch based on the device of the input
+  at::cuda::CUDAGuard device_guard(points.device());
+  cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+  auto loss = at::zeros({points.size(0)}, points.options());
+
+  if (loss.numel() == 0) {
+    AT_CUDA_CHECK(cudaGetLastError());
+    return loss;
+  }
+
+  const size_t threads = 256;
+  const size_t blocks = (points.size(0) + threads - 1) / threads;
+  ProjectionLossCudaForwardKernel<<<blocks, threads, 0, stream>>>(
+      loss.packed_accessor64<float, 1, at::RestrictPtrTraits>(),
+      points.packed_accessor64<float, 2, at::RestrictPtrTraits>(),
+      normals.packed_accessor64<float, 2, at::RestrictPtrTraits>(),
+      knn_idx.packed_accessor64<int64_t, 2, at::RestrictPtrTraits>(),
+      phi.packed_accessor64<float, 2, at::RestrictPtrTraits>(),
+      visibility.packed_accessor64<bool, 1, at::RestrictPtrTraits>(),
+      1.0f / (sharpness_sigma * sharpness_sigma),
+      invisible_weight);
+
+  AT_CUDA_CHECK(cudaGetLastError());
+  return loss;
+}
+
+at::Tensor ProjectionLossCudaBackward(
+    const at::Tensor& grad_loss,
+    const at::Tensor& points,
+    const at::Tensor& normals,
+    const at::Tensor& knn_idx,
+    const at::Tensor& phi,
+    const at::Tensor& visibility,
+    const float sharpness_sigma,
+    const float invisible_weight) {
+  // Check inputs are on the same device
+  at::TensorArg grad_loss_t{grad_loss, "grad_loss", 1},
+      points_t{points, "points", 2}, normals_t{normals, "normals", 3},
+      knn_idx_t{knn_idx, "knn_idx", 4}, phi_t{phi, "phi", 5},
+      visibility_t{visibility, "visibility", 6};
+  at::CheckedFrom c = "ProjectionLossCudaBackward";
+  at::checkAllSameGPU(
+      c, {grad_loss_t, points_t, normals_t, knn_idx_t, phi_t, visibility_t});
+  at::checkAllSameType(c, {grad_loss_t, points_t, normals_t, phi_t});
+
+  // Set the device for the kernel launch based on the device of the input
+  at::cuda::CUDAGuard device_guard(points.device());
+  cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+  auto grad_points = at::zeros({points.size(0), 3}, points.options());
+
+  if (grad_points.numel() == 0) {
+    AT_CUDA_CHECK(cudaGetLastError());
+    return grad_points;
+  }
+
+  const size_t threads = 256;
+  const size_t blocks = (points.size(0) + threads - 1) / threads;
+  ProjectionLossCudaBackwardKernel<<<blocks, threads, 0, stream>>>(
+      grad_points.packed_accessor64<float, 2, at::RestrictPtrTraits>(),
+      grad_loss.packed_accessor64<float, 1, at::RestrictPtrTraits>(),
+      points.packed_accessor64<float, 2, at::RestrictPtrTraits>(),
+      normals.packed_accessor64<float, 2, at::RestrictPtrTraits>(),
+      knn_idx.packed_accessor64<int64_t, 2, at::RestrictPtrTraits>(),
+      phi.packed_accessor64<float, 2, at::RestrictPtrTraits>(),
+      visibility.packed_accessor64<bool, 1, at::RestrictPtrTraits>(),
+      1.0f / (sharpness_sigma * sharpness_sigma),
+      invisible_weight);
+
+  AT_CUDA_CHECK(cudaGetLastError());
+  return grad_points;
+}
@@ -0,0 +1,157 @@
+#pragma once
+#include <torch/extension.h>
+
+#ifndef CHECK_CUDA
+#define CHECK_CUDA(x) TORCH_CHECK(x.is_cuda(), #x "must be a CUDA tensor.")
+#endif
+
+// Fused projection loss of ProjectionLoss: the weighted squared distance of
+// the points to the tangent planes of their neighbors, computed per point
+// without creating the (P, K) weight and distance tensors.
+//
+// Inputs:
+//    points: FloatTensor of shape (P, 3), packed points.
+//    normals: FloatTensor of shape (P, 3), packed (mollified) normals.
+//    knn_idx: LongTensor of shape (P, K), packed indices of the neighbors of
+//            each point, -1 for the invalid neighbors which have a zero
+//            position and normal (as the zeros gathered by knn_gather).
+//    phi: FloatTensor of shape (P, K), spatial weights of the neighbors.
+//    visibility: BoolTensor of shape (P,), visibility of the points.
+//    sharpness_sigma: sigma of the normal weights.
+//    invisible_weight: weight of the invisible (and invalid) neighbors.
+// Returns:
+//    loss: FloatTensor of shape (P,). Concretely, with j = knn_idx[i, k],
+//                 w_ik = phi[i, k] * exp(-|n_j - n_i|^2 / sharpness_sigma^2)
+//                        * (visibility[j] ? 1 : invisible_weight)
+//                 sdf_ik = dot(points[j] - points[i], normals[j])
+//                 loss[i] = sum_k w_ik * sdf_ik^2 / max(sum_k w_ik, eps)
+//            where n are the normalized normals.
+//
+// The backward function returns the gradient w.r.t. the points as query
+// points, the neighbors and the weights are constants.
+
+// CUDA declarations
+#ifdef WITH_CUDA
+torch::Tensor ProjectionLossCudaForward(
+    const torch::Tensor& points,
+    const torch::Tensor& normals,
+    const torch::Tensor& knn_idx,
+    const torch::Tensor& phi,
+    const torch::Tensor& visibility,
+    const float sharpness_sigma,
+    const float invisible_weight);
+
+torch::Tensor ProjectionLossCudaBackward(
+    const torch::Tensor& grad_loss,
+    const torch::Tensor& points,
+    const torch::Tensor& normals,
+    const torch::Tensor& knn_idx,
+    const torch::Tensor& phi,
+    const torch::Tensor& visibility,
+    const float sharpness_sigma,
+    const float invisible_weight);
+#endif
+
+// C++ declarations
+torch::Tensor ProjectionLossCpuForward(
+    const torch::Tensor& points,
+    const torch::Tensor& normals,
+    const torch::Tensor& knn_idx,
+    const torch::Tensor& phi,
+    const torch::Tensor& visibility,
+    const float sharpness_sigma,
+    const float invisible_weight);
+
+torch::Tensor ProjectionLossCpuBackward(
+    const torch::Tensor& grad_loss,
+    const torch::Tensor& points,
+    const torch::Tensor& normals,
+    const torch::Tensor& knn_idx,
+    const torch::Tensor& phi,
+    const torch::Tensor& visibility,
+    const float sharpness_sigma,
+    const float invisible_weight);
+
+inline void ProjectionLossCheckInputs(
+    const torch::Tensor& points,
+    const torch::Tensor& normals,
+    const torch::Tensor& knn_idx,
+    const torch::Tensor& phi,
+    const torch::Tensor& visibility) {
+  TORCH_CHECK(points.dim() == 2 && points.size(1) == 3, "points must be (P, 3)");
+  TORCH_CHECK(normals.sizes() == points.sizes(), "normals must be (P, 3)");
+  TORCH_CHECK(knn_idx.dim() == 2 && knn_idx.size(0) == points.size(0), "knn_idx must be (P, K)");
+  TORCH_CHECK(phi.sizes() == knn_idx.sizes(), "phi must be (P, K)");
+  TORCH_CHECK(visibility.dim() == 1 && visibility.size(0) == points.size(0), "visibility must be (P,)");
+  TORCH_CHECK(knn_idx.scalar_type() == torch::kInt64, "knn_idx must be int64");
+  TORCH_CHECK(visibility.scalar_type() == torch::kBool, "visibility must be bool");
+}
+
+torch::Tensor ProjectionLossForward(
+    torch::Tensor& points,
+    torch::Tensor& normals,
+    torch::Tensor& knn_idx,
+    torch::Tensor& phi,
+    torch::Tensor& visibility,
+    const float sharpness_sigma,
+    const float invisible_weight) {
+  points = points.contiguous();
+  normals = normals.contiguous();
+  knn_idx = knn_idx.contiguous();
+  phi = phi.contiguous();
+  visibility = visibility.contiguous();
+  ProjectionLossCheckInputs(points, normals, knn_idx, phi, visibility);
+
+  if (points.is_cuda()) {
+#ifdef WITH_CUDA
+    CHECK_CUDA(points);
+    CHECK_CUDA(normals);
+    CHECK_CUDA(knn_idx);
+    CHECK_CUDA(phi);
+    CHECK_CUDA(visibility);
+    return ProjectionLossCudaForward(
+        points, normals, knn_idx, phi, visibility, sharpness_sigma, invisible_weight);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  } else {
+    return ProjectionLossCpuForward(
+        points, normals, knn_idx, phi, visibility, sharpness_sigma, invisible_weight);
+  }
+}
+
+torch::Tensor ProjectionLossBackward(
+    torch::Tensor& grad_loss,
+    torch::Tensor& points,
+    torch::Tensor& normals,
+    torch::Tensor& knn_idx,
+    torch::Tensor& phi,
+    torch::Tensor& visibility,
+    const float sharpness_sigma,
+    const float invisible_weight) {
+  grad_loss = grad_loss.contiguous();
+  points = points.contiguous();
+  normals = normals.contiguous();
+  knn_idx = knn_idx.contiguous();
+  phi = phi.contiguous();
+  visibility = visibility.contiguous();
+  ProjectionLossCheckInputs(points, normals, knn_idx, phi, visibility);
+
+  if (points.is_cuda()) {
+#ifdef WITH_CUDA
+    CHECK_CUDA(grad_loss);
+    CHECK_CUDA(points);
+    CHECK_CUDA(normals);
+    CHECK_CUDA(knn_idx);
+    CHECK_CUDA(phi);
+    CHECK_CUDA(visibility);
+    return ProjectionLossCudaBackward(
+        grad_loss, points, normals, knn_idx, phi, visibility, sharpness_sigma, invisible_weight);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  } else {
+    return ProjectionLossCpuBackward(
+        grad_loss, points, normals, knn_idx, phi, visibility, sharpness_sigma, invisible_weight);
+  }
+}
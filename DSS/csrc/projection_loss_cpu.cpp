@@ -0,0 +1,164 @@
+#include <torch/extension.h>
+#include <ATen/Parallel.h>
+#include <algorithm>
+#include <cmath>
+
+// Lower bound of the sum of the weights of a point, as eps_denom.
+static const float kWeightSumEpsilon = 1e-17f;
+// Lower bound of the norm of the normals, as torch.nn.functional.normalize.
+static const float kNormalEpsilon = 1e-12f;
+// Number of points per task of the intra-op thread pool.
+static const int64_t kPointsGrainSize = 256;
+
+static void NormalizedNormal(
+    const torch::TensorAccessor<float, 2> &normals_a,
+    const int64_t p,
+    float *n)
+{
+  const float norm = std::max(std::sqrt(normals_a[p][0] * normals_a[p][0] +
+                                        normals_a[p][1] * normals_a[p][1] +
+                                        normals_a[p][2] * normals_a[p][2]),
+                              kNormalEpsilon);
+  for (int d = 0; d < 3; ++d)
+    n[d] = normals_a[p][d] / norm;
+}
+
+// Weight w_ik and signed distance sdf_ik of the k-th neighbor of point i,
+// ni being the normalized normal of point i. Returns the (unnormalized)
+// normal of the neighbor in nj, zero for an invalid neighbor.
+static void NeighborWeightAndSdf(
+    const torch::TensorAccessor<float, 2> &points_a,
+    const torch::TensorAccessor<float, 2> &normals_a,
+    const torch::TensorAccessor<int64_t, 2> &knn_idx_a,
+    const torch::TensorAccessor<float, 2> &phi_a,
+    const torch::TensorAccessor<bool, 1> &visibility_a,
+    const float inv_sigma2,
+    const float invisible_weight,
+    const int64_t i,
+    const int k,
+    const float *ni,
+    float *nj,
+    float &w,
+    float &sdf)
+{
+  const int64_t j = knn_idx_a[i][k];
+  float xj[3] = {0.0f, 0.0f, 0.0f};
+  float nj_normalized[3] = {0.0f, 0.0f, 0.0f};
+  nj[0] = nj[1] = nj[2] = 0.0f;
+  if (j >= 0)
+  {
+    for (int d = 0; d < 3; ++d)
+    {
+      xj[d] = points_a[j][d];
+      nj[d] = normals_a[j][d];
+    }
+    NormalizedNormal(normals_a, j, nj_normalized);
+  }
+  float normal_diff2 = 0.0f;
+  sdf = 0.0f;
+  for (int d = 0; d < 3; ++d)
+  {
+    const float diff = nj_normalized[d] - ni[d];
+    normal_diff2 += diff * diff;
+    sdf += (xj[d] - points_a[i][d]) * nj[d];
+  }
+  const float visibility_w = (j >= 0 && visibility_a[j]) ? 1.0f : invisible_weight;
+  w = phi_a[i][k] * std::exp(-normal_diff2 * inv_sigma2) * visibility_w;
+}
+
+torch::Tensor ProjectionLossCpuForward(
+    const torch::Tensor &points,     // (P, 3)
+    const torch::Tensor &normals,    // (P, 3)
+    const torch::Tensor &knn_idx,    // (P, K)
+    const torch::Tensor &phi,        // (P, K)
+    const torch::Tensor &visibility, // (P,)
+    const float sharpness_sigma,
+    const float invisible_weight)
+{
+  const int64_t P = points.size(0);
+  const int K = knn_idx.size(1);
+  const float inv_sigma2 = 1.0f / (sharpness_sigma * sharpness_sigma);
+
+  torch::Tensor loss = torch::zeros({P}, points.options());
+
+  auto points_a = points.accessor<float, 2>();
+  auto normals_a = normals.accessor<float, 2>();
+  auto knn_idx_a = knn_idx.accessor<int64_t, 2>();
+  auto phi_a = phi.accessor<float, 2>();
+  auto visibility_a = visibility.accessor<bool, 1>();
+  auto loss_a = loss.accessor<float, 1>();
+
+  // every point only writes its own loss
+  at::parallel_for(0, P, kPointsGrainSize, [&](int64_t start, int64_t end) {
+    for (int64_t i = start; i < end; ++i)
+    {
+      float ni[3], nj[3];
+      NormalizedNormal(normals_a, i, ni);
+      float sum_w = 0.0f;
+      float sum_wd = 0.0f;
+      for (int k = 0; k < K; ++k)
+      {
+        float w, sdf;
+        NeighborWeightAndSdf(points_a, normals_a, knn_idx_a, phi_a, visibility_a,
+                             inv_sigma2, invisible_weight, i, k, ni, nj, w, sdf);
+        sum_w += w;
+        sum_wd += w * sdf * sdf;
+      }
+      loss_a[i] = sum_wd / std::max(sum_w, kWeightSumEpsilon);
+    }
+  });
+  return loss;
+}
+
+torch::Tensor ProjectionLossCpuBackward(
+    const torch::Tensor &grad_loss,  // (P,)
+    const torch::Tensor &points,     // (P, 3)
+    const torch::Tensor &normals,    // (P, 3)
+    const torch::Tensor &knn_idx,    // (P, K)
+    const torch::Tensor &phi,        // (P, K)
+    const torch::Tensor &visibility, // (P,)
+    const float sharpness_sigma,
+    const float invisible_weight)
+{
+  const int64_t P = points.size(0);
+  const int K = knn_idx.size(1);
+  const float inv_sigma2 = 1.0f / (sharpness_sigma * sharpness_sigma);
+
+  torch::Tensor grad_points = torch::zeros({P, 3}, points.options());
+
+  auto grad_loss_a = grad_loss.accessor<float, 1>();
+  auto points_a = points.accessor<float, 2>();
+  auto normals_a = normals.accessor<float, 2>();
+  auto knn_idx_a = knn_idx.accessor<int64_t, 2>();
+  auto phi_a = phi.accessor<float, 2>();
+  auto visibility_a = visibility.accessor<bool, 1>();
+  auto grad_points_a = grad_points.accessor<float, 2>();
+
+  // d loss[i] / d points[i] = -2 * sum_k w_ik * sdf_ik * normals[j] / sum_k w_ik,
+  // only the query point gets a gradient, so there is no race
+  at::parallel_for(0, P, kPointsGrainSize, [&](int64_t start, int64_t end) {
+    for (int64_t i = start; i < end; ++i)
+    {
+      const float grad_i = grad_loss_a[i];
+      if (grad_i == 0.0f)
+        continue;
+      float ni[3], nj[3];
+      NormalizedNormal(normals_a, i, ni);
+      float sum_w = 0.0f;
+      float grad[3] = {0.0f, 0.0f, 0.0f};
+      for (int k = 0; k < K; ++k)
+      {
+        float w, sdf;
+        NeighborWeightAndSdf(points_a, normals_a, knn_idx_a, phi_a, visibility_a,
+                             inv_sigma2, invisible_weight, i, k, ni, nj, w, sdf);
+        sum_w += w;
+        for (int d = 0; d < 3; ++d)
+          grad[d] += w * sdf * nj[d];
+      }
+      const float scale = -2.0f * grad_i / std::max(sum_w, kWeightSumEpsilon);
+      for (int d = 0; d < 3; ++d)
+        grad_points_a[i][d] = grad[d] * scale;
+    }
+  });
+  return grad_points;
+}
@@ -2,12 +2,27 @@
 
 #pragma once
 
-// Given a pixel coordinate 0 <= i < S, convert it to a normalized device
-// coordinate in the range [-1, 1]. We divide the NDC range into S evenly-sized
+// The NDC range of an image axis with S1 pixels where the other axis has S2
+// pixels. The shorter side spans [-1, 1] and the longer side is extended
+// so that pixels stay square, e.g. an image with H=64, W=128 covers
+// [-1, 1] in y and [-2, 2] in x.
+__device__ inline float NonSquareNdcRange(int S1, int S2) {
+  float range = 2.0f;
+  if (S1 > S2) {
+    range = (S1 * range) / S2;
+  }
+  return range;
+}
+
+// Given a pixel coordinate 0 <= i < S1, convert it to a normalized device
+// coordinate. We divide the NDC range of the axis into S1 evenly-sized
 // pixels, and assume that each pixel falls in the *center* of its range.
-__device__ inline float PixToNdc(int i, int S) {
+// For square images (S1 == S2) this is the range [-1, 1].
+__device__ inline float PixToNdc(int i, int S1, int S2) {
+  const float range = NonSquareNdcRange(S1, S2);
   // NDC x-offset + (i * pixel_width + half_pixel_width)
-  return -1 + (2 * i + 1.0f) / S;
+  const float offset = range / 2.0f;
+  return -offset + (range * i + offset) / S1;
 }
 
 // The maximum number of points per pixel that we can return. Since we use
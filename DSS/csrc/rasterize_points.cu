@@ -137,31 +137,33 @@ __global__ void RasterizePointsNaiveCudaKernel(
     const int64_t *num_points_per_cloud,      // (N)
     const float depth_merging_thres,
     const int N,
-    const int S,
+    const int H,
+    const int W,
     const int K,
-    int32_t *point_idxs, // (N, S, S, K)
-    float *zbuf,         // (N, S, S, K)
-    float *qvalues,      // (N, S, S, K)
-    float *occupancies)  // (N, S, S)
+    int32_t *point_idxs, // (N, H, W, K)
+    float *zbuf,         // (N, H, W, K)
+    float *qvalues,      // (N, H, W, K)
+    float *occupancies)  // (N, H, W)
 {
 
-    // (N, S, S, K)
+    // (N, H, W, K)
     // Simple version: One thread per output pixel
     const int num_threads = gridDim.x * blockDim.x;
     const int tid = blockDim.x * blockIdx.x + threadIdx.x;
-    for (int i = tid; i < N * S * S; i += num_threads)
+    for (int i = tid; i < N * H * W; i += num_threads)
     {
         // Convert linear index to 3D index
-        const int n = i / (S * S); // Batch index
-        const int pix_idx = i % (S * S);
+        const int n = i / (H * W); // Batch index
+        const int pix_idx = i % (H * W);
 
         // Reverse ordering of the X and Y axis as the camera coordinates
         // assume that +Y is pointing up and +X is pointing left.
-        const int yi = S - 1 - pix_idx / S;
-        const int xi = S - 1 - pix_idx % S;
+        const int yi = H - 1 - pix_idx / W;
+        const int xi = W - 1 - pix_idx % W;
 
-        const float xf = PixToNdc(xi, S);
-        const float yf = PixToNdc(yi, S);
+        // Pixels are square, the shorter side of the image spans [-1, 1]
+        const float xf = PixToNdc(xi, W, H);
+        const float yf = PixToNdc(yi, H, W);
 
         // For keeping track of the K closest points we want a data structure
         // that (1) gives O(1) access to the closest point for easy comparisons,
@@ -192,7 +194,7 @@ __global__ void RasterizePointsNaiveCudaKernel(
 
         BubbleSort(q, q_size);
 
-        int idx = n * S * S * K + pix_idx * K;
+        int idx = n * H * W * K + pix_idx * K;
         if (q_max_z >= 0)
         {
             // there is a point located at this pixel
@@ -220,7 +222,7 @@ RasterizePointsNaiveCuda(
     const at::Tensor &cloud_to_packed_first_idx,
     const at::Tensor &num_points_per_cloud,
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int points_per_pixel)
 {
     // Check inputs are on the same device
@@ -240,7 +242,8 @@ RasterizePointsNaiveCuda(
     cudaStream_t stream = at::cuda::getCurrentCUDAStream();
 
     const int N = num_points_per_cloud.size(0); // batch size.
-    const int S = image_size;
+    const int H = std::get<0>(image_size);
+    const int W = std::get<1>(image_size);
     const int K = points_per_pixel;
 
     if (K > kMaxPointsPerPixel)
@@ -251,10 +254,10 @@ RasterizePointsNaiveCuda(
     }
     auto int_opts = points.options().dtype(at::kInt);
     auto float_opts = points.options().dtype(at::kFloat);
-    at::Tensor point_idxs = at::full({N, S, S, K}, -1, int_opts);
-    at::Tensor zbuf = at::full({N, S, S, K}, -1, float_opts);
-    at::Tensor qvalues = at::full({N, S, S, K}, -1, float_opts);
-    at::Tensor occupancies = at::full({N, S, S}, 0, float_opts);
+    at::Tensor point_idxs = at::full({N, H, W, K}, -1, int_opts);
+    at::Tensor zbuf = at::full({N, H, W, K}, -1, float_opts);
+    at::Tensor qvalues = at::full({N, H, W, K}, -1, float_opts);
+    at::Tensor occupancies = at::full({N, H, W}, 0, float_opts);
 
     if (point_idxs.numel() == 0)
     {
@@ -273,7 +276,8 @@ RasterizePointsNaiveCuda(
         num_points_per_cloud.contiguous().data_ptr<int64_t>(),
         depth_merging_thres,
         N,
-        S,
+        H,
+        W,
         K,
         point_idxs.contiguous().data_ptr<int32_t>(),
         zbuf.contiguous().data_ptr<float>(),
@@ -297,7 +301,8 @@ __global__ void RasterizePointsCoarseCudaKernel(
     const int64_t *num_points_per_cloud,      // (N)
     const int N,
     const int P,
-    const int S,
+    const int H,
+    const int W,
     const int bin_size,
     const int chunk_size,
     const int max_points_per_bin,
@@ -306,13 +311,16 @@ __global__ void RasterizePointsCoarseCudaKernel(
 {
     extern __shared__ char sbuf[];
     const int M = max_points_per_bin;
-    const int num_bins = 1 + (S - 1) / bin_size; // Integer divide round up
-    const float half_pix = 1.0f / S;             // Size of half a pixel in NDC units
+    const int num_bins_y = 1 + (H - 1) / bin_size; // Integer divide round up
+    const int num_bins_x = 1 + (W - 1) / bin_size; // Integer divide round up
+    // Size of half a pixel in NDC units, pixels are square so this is the
+    // same for both axes.
+    const float half_pix = 1.0f / min(H, W);
 
-    // This is a boolean array of shape (num_bins, num_bins, chunk_size)
+    // This is a boolean array of shape (num_bins_y, num_bins_x, chunk_size)
     // stored in shared memory that will track whether each point in the chunk
     // falls into each bin of the image.
-    BitMask binmask((unsigned int *)sbuf, num_bins, num_bins, chunk_size);
+    BitMask binmask((unsigned int *)sbuf, num_bins_y, num_bins_x, chunk_size);
 
     // Have each block handle a chunk of points and build a 3D bitmask in
     // shared memory to mark which points hit which bins.  In this first phase,
@@ -361,25 +369,25 @@ __global__ void RasterizePointsCoarseCudaKernel(
             // For example we could compute the exact bin where the point falls,
             // then check neighboring bins. This way we wouldn't have to check
             // all bins (however then we might have more warp divergence?)
-            for (int by = 0; by < num_bins; ++by)
+            for (int by = 0; by < num_bins_y; ++by)
             {
                 // Get y extent for the bin. PixToNdc gives us the location of
                 // the center of each pixel, so we need to add/subtract a half
                 // pixel to get the true extent of the bin.
-                const float by0 = PixToNdc(by * bin_size, S) - half_pix;
-                const float by1 = PixToNdc((by + 1) * bin_size - 1, S) + half_pix;
+                const float by0 = PixToNdc(by * bin_size, H, W) - half_pix;
+                const float by1 = PixToNdc((by + 1) * bin_size - 1, H, W) + half_pix;
                 const bool y_overlap = ((py0 <= by1) && (by0 <= py1));
 
                 if (!y_overlap)
                 {
                     continue;
                 }
-                for (int bx = 0; bx < num_bins; ++bx)
+                for (int bx = 0; bx < num_bins_x; ++bx)
                 {
                     // Get x extent for the bin; again we need to adjust the
                     // output of PixToNdc by half a pixel.
-                    const float bx0 = PixToNdc(bx * bin_size, S) - half_pix;
-                    const float bx1 = PixToNdc((bx + 1) * bin_size - 1, S) + half_pix;
+                    const float bx0 = PixToNdc(bx * bin_size, W, H) - half_pix;
+                    const float bx1 = PixToNdc((bx + 1) * bin_size - 1, W, H) + half_pix;
                     const bool x_overlap = (px0 <= bx1) && (bx0 <= px1);
 
                     if (x_overlap)
@@ -393,13 +401,13 @@ __global__ void RasterizePointsCoarseCudaKernel(
         // Now we have processed every point in the current chunk. We need to
         // count the number of points in each bin so we can write the indices
         // out to global memory. We have each thread handle a different bin.
-        for (int byx = threadIdx.x; byx < num_bins * num_bins; byx += blockDim.x)
+        for (int byx = threadIdx.x; byx < num_bins_y * num_bins_x; byx += blockDim.x)
         {
-            const int by = byx / num_bins;
-            const int bx = byx % num_bins;
+            const int by = byx / num_bins_x;
+            const int bx = byx % num_bins_x;
             const int count = binmask.count(by, bx);
             const int points_per_bin_idx =
-                batch_idx * num_bins * num_bins + by * num_bins + bx;
+                batch_idx * num_bins_y * num_bins_x + by * num_bins_x + bx;
 
             // This atomically increments the (global) number of points found
             // in the current bin, and gets the previous value of the counter;
@@ -413,7 +421,7 @@ __global__ void RasterizePointsCoarseCudaKernel(
 
             // Now loop over the binmask and write the active bits for this bin
             // out to bin_points.
-            int next_idx = batch_idx * num_bins * num_bins * M + by * num_bins * M +
+            int next_idx = batch_idx * num_bins_y * num_bins_x * M + by * num_bins_x * M +
                            bx * M + start;
             for (int p = 0; p < chunk_size; ++p)
             {
@@ -436,7 +444,7 @@ at::Tensor RasterizePointsCoarseCuda(
     const at::Tensor &radii,                     // (P, 2)
     const at::Tensor &cloud_to_packed_first_idx, // (N)
     const at::Tensor &num_points_per_cloud,      // (N)
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int bin_size,
     const int max_points_per_bin)
 {
@@ -456,19 +464,22 @@ at::Tensor RasterizePointsCoarseCuda(
 
     const int P = points.size(0);
     const int N = num_points_per_cloud.size(0);
-    const int num_bins = 1 + (image_size - 1) / bin_size; // divide round up
+    const int H = std::get<0>(image_size);
+    const int W = std::get<1>(image_size);
+    const int num_bins_y = 1 + (H - 1) / bin_size; // divide round up
+    const int num_bins_x = 1 + (W - 1) / bin_size; // divide round up
     const int M = max_points_per_bin;
 
-    if (num_bins >= 22)
+    if (num_bins_y >= 22 || num_bins_x >= 22)
     {
         // Make sure we do not use too much shared memory.
         std::stringstream ss;
-        ss << "Got " << num_bins << "; that's too many!";
+        ss << "Got " << std::max(num_bins_y, num_bins_x) << "; that's too many!";
         AT_ERROR(ss.str());
     }
     auto opts = points.options().dtype(at::kInt);
-    at::Tensor points_per_bin = at::zeros({N, num_bins, num_bins}, opts);
-    at::Tensor bin_points = at::full({N, num_bins, num_bins, M}, -1, opts);
+    at::Tensor points_per_bin = at::zeros({N, num_bins_y, num_bins_x}, opts);
+    at::Tensor bin_points = at::full({N, num_bins_y, num_bins_x, M}, -1, opts);
 
     if (bin_points.numel() == 0)
     {
@@ -477,7 +488,7 @@ at::Tensor RasterizePointsCoarseCuda(
     }
 
     const int chunk_size = 512;
-    const size_t shared_size = num_bins * num_bins * chunk_size / 8;
+    const size_t shared_size = num_bins_y * num_bins_x * chunk_size / 8;
     const size_t blocks = 64;
     const size_t threads = 512;
 
@@ -488,7 +499,8 @@ at::Tensor RasterizePointsCoarseCuda(
         num_points_per_cloud.contiguous().data_ptr<int64_t>(),
         N,
         P,
-        image_size,
+        H,
+        W,
         bin_size,
         chunk_size,
         M,
@@ -508,21 +520,23 @@ __global__ void RasterizePointsFineCudaKernel(
     const float *ellipse_params, // (P, 3), the parabolic parameters
     const float *cutoff_thres,   // (P,)
     const float *radii,          // (P, 2)
-    const int32_t *bin_points,   // (N, B, B, T)
+    const int32_t *bin_points,   // (N, BH, BW, T)
     const float depth_merging_thres,
     const int bin_size,
     const int N,
-    const int B, // num_bins
+    const int BH, // num_bins y
+    const int BW, // num_bins x
     const int M,
-    const int S,
+    const int H,
+    const int W,
     const int K,
-    int32_t *point_idxs,  // (N, S, S, K)
-    float *zbuf,          // (N, S, S, K)
-    float *qvalue_map,    // (N, S, S, K)
-    float *occupancy_map) // (N, S, S)
+    int32_t *point_idxs,  // (N, H, W, K)
+    float *zbuf,          // (N, H, W, K)
+    float *qvalue_map,    // (N, H, W, K)
+    float *occupancy_map) // (N, H, W)
 {
-    // This can be more than S^2 if S is not dividable by bin_size.
-    const int num_pixels = N * B * B * bin_size * bin_size;
+    // This can be more than H * W if H or W are not dividable by bin_size.
+    const int num_pixels = N * BH * BW * bin_size * bin_size;
     const int num_threads = gridDim.x * blockDim.x;
     const int tid = blockIdx.x * blockDim.x + threadIdx.x;
 
@@ -533,21 +547,21 @@ __global__ void RasterizePointsFineCudaKernel(
         // into the same bin; this should give them coalesced memory reads when
         // they read from points and bin_points.
         int i = pid;
-        const int n = i / (B * B * bin_size * bin_size); // batch
-        i %= B * B * bin_size * bin_size;                // index of the batch
-        const int by = i / (B * bin_size * bin_size);    // bin_y
-        i %= B * bin_size * bin_size;
+        const int n = i / (BH * BW * bin_size * bin_size); // batch
+        i %= BH * BW * bin_size * bin_size;                // index of the batch
+        const int by = i / (BW * bin_size * bin_size);     // bin_y
+        i %= BW * bin_size * bin_size;
         const int bx = i / (bin_size * bin_size); // bin_x
         i %= bin_size * bin_size;                 // index inside the bin
 
         const int yi = i / bin_size + by * bin_size;
         const int xi = i % bin_size + bx * bin_size;
 
-        if (yi >= S || xi >= S)
+        if (yi >= H || xi >= W)
             continue;
 
-        const float xf = PixToNdc(xi, S);
-        const float yf = PixToNdc(yi, S);
+        const float xf = PixToNdc(xi, W, H);
+        const float yf = PixToNdc(yi, H, W);
 
         // This part looks like the naive rasterization kernel, except we use
         // bin_points to only look at a subset of points already known to fall
@@ -559,7 +573,7 @@ __global__ void RasterizePointsFineCudaKernel(
         int q_max_idx = -1;
         for (int m = 0; m < M; ++m)
         {
-            const int p = bin_points[n * B * B * M + by * B * M + bx * M + m];
+            const int p = bin_points[n * BH * BW * M + by * BW * M + bx * M + m];
             if (p < 0)
             {
                 // bin_points uses -1 as a sentinal value
@@ -574,14 +588,14 @@ __global__ void RasterizePointsFineCudaKernel(
 
         // Reverse ordering of the X and Y axis as the camera coordinates
         // assume that +Y is pointing up and +X is pointing left.
-        const int yidx = S - 1 - yi;
-        const int xidx = S - 1 - xi;
+        const int yidx = H - 1 - yi;
+        const int xidx = W - 1 - xi;
 
-        const int pix_idx = n * S * S * K + yidx * S * K + xidx * K;
+        const int pix_idx = n * H * W * K + yidx * W * K + xidx * K;
         if (q_max_z > 0)
         {
             // there is a point located at this pixel
-            occupancy_map[n * S * S + yidx * S + xidx] = 1;
+            occupancy_map[n * H * W + yidx * W + xidx] = 1;
         }
         for (int k = 0; k < q_size; ++k)
         {
@@ -601,9 +615,9 @@ std::tuple<at::Tensor, at::Tensor, at::Tensor, at::Tensor> RasterizePointsFineCu
     const at::Tensor &ellipse_params, // (P, 3)
     const at::Tensor &cutoff,         // (P,) or (1,)
     const at::Tensor &radii,          // (P, 2)
-    const at::Tensor &bin_points,     // (N, B, B, M)
+    const at::Tensor &bin_points,     // (N, BH, BW, M)
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int bin_size,
     const int points_per_pixel)
 {
@@ -621,9 +635,11 @@ std::tuple<at::Tensor, at::Tensor, at::Tensor, at::Tensor> RasterizePointsFineCu
     cudaStream_t stream = at::cuda::getCurrentCUDAStream();
 
     const int N = bin_points.size(0);
-    const int B = bin_points.size(1); // num_bins
+    const int BH = bin_points.size(1); // num_bins y
+    const int BW = bin_points.size(2); // num_bins x
     const int M = bin_points.size(3);
-    const int S = image_size;
+    const int H = std::get<0>(image_size);
+    const int W = std::get<1>(image_size);
     const int K = points_per_pixel;
     if (K > kMaxPointsPerPixel)
     {
@@ -631,10 +647,10 @@ std::tuple<at::Tensor, at::Tensor, at::Tensor, at::Tensor> RasterizePointsFineCu
     }
     auto int_opts = bin_points.options().dtype(at::kInt);
     auto float_opts = points.options().dtype(at::kFloat);
-    at::Tensor point_idxs = at::full({N, S, S, K}, -1, int_opts);
-    at::Tensor zbuf = at::full({N, S, S, K}, -1, float_opts);
-    at::Tensor qvalue_map = at::full({N, S, S, K}, -1, float_opts);
-    at::Tensor occupancy_map = at::zeros({N, S, S}, float_opts);
+    at::Tensor point_idxs = at::full({N, H, W, K}, -1, int_opts);
+    at::Tensor zbuf = at::full({N, H, W, K}, -1, float_opts);
+    at::Tensor qvalue_map = at::full({N, H, W, K}, -1, float_opts);
+    at::Tensor occupancy_map = at::zeros({N, H, W}, float_opts);
 
     if (point_idxs.numel() == 0)
     {
@@ -653,9 +669,11 @@ std::tuple<at::Tensor, at::Tensor, at::Tensor, at::Tensor> RasterizePointsFineCu
         depth_merging_thres,
         bin_size,
         N,
-        B,
+        BH,
+        BW,
         M,
-        S,
+        H,
+        W,
         K,
         point_idxs.contiguous().data_ptr<int32_t>(),
         zbuf.contiguous().data_ptr<float>(),
@@ -682,7 +700,7 @@ __global__ void RasterizePointsOccBackwardCudaKernel(
     float *grad_points     //  (P,2)
 )
 {
-    // (N, S, S, K)
+    // (N, H, W, K)
     // Simple version: One thread per output pixel
     const int num_threads = gridDim.x * blockDim.x;
     const int tid = blockDim.x * blockIdx.x + threadIdx.x;
@@ -699,8 +717,11 @@ __global__ void RasterizePointsOccBackwardCudaKernel(
         const int xi = W - 1 - pix_idx % W;
 
         const float grad_occ_pix = grad_occ[i];
-        const float xf = PixToNdc(xi, W);
-        const float yf = PixToNdc(yi, H);
+        // NDC extent of the image
+        const float x_max = NonSquareNdcRange(W, H) / 2.0f;
+        const float y_max = NonSquareNdcRange(H, W) / 2.0f;
+        const float xf = PixToNdc(xi, W, H);
+        const float yf = PixToNdc(yi, H, W);
 
         if (grad_occ_pix != 0.0f)
         {
@@ -717,7 +738,7 @@ __global__ void RasterizePointsOccBackwardCudaKernel(
                 // const float cutoff_thres_scaled = cutoff_thres[p_idx] * radii_s * radii_s;
 
                 // outside renderable area
-                if (pz < 0 || abs(py) > 1.0 || abs(px) > 1.0)
+                if (pz < 0 || abs(py) > y_max || abs(px) > x_max)
                     continue;
 
                 const float dx = xf - px;
@@ -789,8 +810,6 @@ at::Tensor RasterizePointsOccBackwardCuda(
     const int H = grad_occ.size(1);
     const int W = grad_occ.size(2);
 
-    // TODO: fetch the new pytorch3d to allow unequal H and W
-    const int S = H;
     at::Tensor grad_points = at::zeros({P, 2}, points.options());
 
     if (grad_points.numel() == 0)
@@ -24,7 +24,7 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
     const torch::Tensor &cloud_to_packed_first_idx,
     const torch::Tensor &num_points_per_cloud,
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int points_per_pixel);
 
 #ifdef WITH_CUDA
@@ -37,7 +37,7 @@ RasterizePointsNaiveCuda(
     const torch::Tensor &cloud_to_packed_first_idx,
     const torch::Tensor &num_points_per_cloud,
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int points_per_pixel);
 #endif
 // Naive (forward) pointcloud rasterization: For each pixel, for each point,
@@ -59,21 +59,21 @@ RasterizePointsNaiveCuda(
 //  num_points_per_cloud: LongTensor of shape (N) giving the number of points
 //                        for each pointcloud in the batch.
 //  depth_merging_thres: the threshold for merging multiple splats if the difference of depth is below this threshold
-//  image_size: (S) Size of the image to return (in pixels)
+//  image_size: (H, W) Size of the image to return (in pixels)
 //  points_per_pixel: (K) The number closest of points to return for each pixel
 //
 // Returns:
 //  A 4 element tuple of:
-//  idxs: int32 Tensor of shape (N, S, S, K) giving the indices of the
+//  idxs: int32 Tensor of shape (N, H, W, K) giving the indices of the
 //        closest K points along the z-axis for each pixel, padded with -1 for
 //        pixels hit by fewer than K points. The indices refer to points in
 //        points packed i.e a tensor of shape (P, 3) representing the flattened
 //        points for all pointclouds in the batch.
-//  zbuf: float32 Tensor of shape (N, S, S, K) giving the depth of each
+//  zbuf: float32 Tensor of shape (N, H, W, K) giving the depth of each
 //        closest point for each pixel.
-//  qvalue: float32 Tensor of shape (N, S, S, K) giving the exponent to
+//  qvalue: float32 Tensor of shape (N, H, W, K) giving the exponent to
 //          compute the composition weight exp(-Qvalue)
-//  occupancy: float32  (N, S, S) giving the occupancy 0/1 at the pixel
+//  occupancy: float32  (N, H, W) giving the occupancy 0/1 at the pixel
 std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizePointsNaive(
     const torch::Tensor &points,
     const torch::Tensor &ellipse_params,
@@ -82,7 +82,7 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
     const torch::Tensor &cloud_to_packed_first_idx,
     const torch::Tensor &num_points_per_cloud,
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int points_per_pixel)
 {
   if (points.is_cuda())
@@ -132,17 +132,27 @@ torch::Tensor RasterizePointsCoarseCpu(
     const torch::Tensor &radii,                     // (P, 2)
     const torch::Tensor &cloud_to_packed_first_idx, // (N)
     const torch::Tensor &num_points_per_cloud,      // (N)
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int bin_size,
     const int max_points_per_bin);
+std::tuple<torch::Tensor, torch::Tensor> RasterizePointsCoarseCsrCpu(
+    const torch::Tensor &points,                    // (P, 3)
+    const torch::Tensor &radii,                     // (P, 2)
+    const torch::Tensor &cloud_to_packed_first_idx, // (N)
+    const torch::Tensor &num_points_per_cloud,      // (N)
+    const std::tuple<int, int> image_size,
+    const int bin_size);
+
+#ifdef WITH_CUDA
 torch::Tensor RasterizePointsCoarseCuda(
     const torch::Tensor &points,
     const torch::Tensor &radii,
     const torch::Tensor &cloud_to_packed_first_idx,
     const torch::Tensor &num_points_per_cloud,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int bin_size,
     const int max_points_per_bin);
+#endif
 // Args:
 //  points: Tensor of shape (P, 3) giving (packed) positions for
 //          points in all N pointclouds in the batch where P is the total
@@ -154,27 +164,28 @@ torch::Tensor RasterizePointsCoarseCuda(
 //                          in the batch where N is the batch size.
 //  num_points_per_cloud: LongTensor of shape (N) giving the number of points
 //                        for each pointcloud in the batch.
-//  image_size: Size of the image to generate (in pixels)
+//  image_size: (H, W) Size of the image to generate (in pixels)
 //  bin_size: Size of each bin within the image (in pixels)
 //  max_points_per_bin: Max number of points in a single bin (M)
 //
 // Returns:
 //  TODO(lixin): remove this points_per_bin as this is useless / not returned for now
-//  points_per_bin: IntTensor of shape (N, num_bins, num_bins) giving the number
+//  points_per_bin: IntTensor of shape (N, num_bins_y, num_bins_x) giving the number
 //                  of points that fall in each bin
-//  bin_points: IntTensor of shape (N, num_bins, num_bins, M) giving the indices
+//  bin_points: IntTensor of shape (N, num_bins_y, num_bins_x, M) giving the indices
 //              of points that fall into each bin.
 torch::Tensor RasterizePointsCoarse(
     const torch::Tensor &points,
     const torch::Tensor &radii,
     const torch::Tensor &cloud_to_packed_first_idx,
     const torch::Tensor &num_points_per_cloud,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int bin_size,
     const int max_points_per_bin)
 {
   if (points.is_cuda())
   {
+#ifdef WITH_CUDA
     CHECK_CUDA(points);
     CHECK_CUDA(radii);
     CHECK_CUDA(cloud_to_packed_first_idx);
@@ -187,6 +198,9 @@ torch::Tensor RasterizePointsCoarse(
         image_size,
         bin_size,
         max_points_per_bin);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
   }
   else
   {
@@ -211,11 +225,24 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
     const torch::Tensor &ellipse_params,    // (P, 3)
     const torch::Tensor &cutoff_thres,      // (P,)
     const torch::Tensor &radii,             // (P,2)
-    const torch::Tensor &bin_points,        // (N, B, B, M)
+    const torch::Tensor &bin_points,        // (N, BH, BW, M)
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int bin_size,
     const int points_per_pixel);
+std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizePointsFineCsrCpu(
+    const torch::Tensor &points,            // (P, 3)
+    const torch::Tensor &ellipse_params,    // (P, 3)
+    const torch::Tensor &cutoff_thres,      // (P,)
+    const torch::Tensor &radii,             // (P,2)
+    const torch::Tensor &bin_points,        // (T,)
+    const torch::Tensor &bin_offsets,       // (N * BH * BW + 1,)
+    const float depth_merging_thres,
+    const std::tuple<int, int> image_size,
+    const int bin_size,
+    const int points_per_pixel);
+
+#ifdef WITH_CUDA
 std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizePointsFineCuda(
     const torch::Tensor &points,
     const torch::Tensor &ellipse_params,
@@ -223,9 +250,10 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
     const torch::Tensor &radii,
     const torch::Tensor &bin_points,
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int bin_size,
     const int points_per_pixel);
+#endif
 // Args:
 //  points: Tensor of shape (P, 3) giving (packed) positions for
 //          points in all N pointclouds in the batch where P is the total
@@ -235,22 +263,22 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
 //  cutoff_thres: define the region of each ellipse by cutting it off
 //                once its qvalue is larger than this threshold
 //  radii: (N, 2) the axis-aligned radii for each splat
-//  bin_points: int32 Tensor of shape (N, B, B, M) giving the indices of points
+//  bin_points: int32 Tensor of shape (N, BH, BW, M) giving the indices of points
 //              that fall into each bin (output from coarse rasterization)
 //  depth_merging_thres: only points that are near enough will be blended
-//  image_size: Size of image to generate (in pixels)
+//  image_size: (H, W) Size of image to generate (in pixels)
 //  bin_size: Size of each bin (in pixels)
 //  points_per_pixel: How many points to rasterize for each pixel
 //
 // Returns (same as rasterize_points):
-//  idxs: int32 Tensor of shape (N, S, S, K) giving the indices of the
+//  idxs: int32 Tensor of shape (N, H, W, K) giving the indices of the
 //        closest K points along the z-axis for each pixel, padded with -1 for
 //        pixels hit by fewer than K points. The indices refer to points in
 //        points packed i.e a tensor of shape (P, 3) representing the flattened
 //        points for all pointclouds in the batch.
-//  zbuf: float32 Tensor of shape (N, S, S, K) giving the depth of each of each
+//  zbuf: float32 Tensor of shape (N, H, W, K) giving the depth of each of each
 //        closest point for each pixel
-//  qvalue_map: float32 Tensor of shape (N, S, S, K) giving  the value of
+//  qvalue_map: float32 Tensor of shape (N, H, W, K) giving  the value of
 //              the ellipse_function Q=(a dx^2+b dxdy+c dy^2) of the points
 //              corresponding to idx map. EWA ~ exp(-0.5Q)
 //  occupance_map: a map indicating whether this pixel is occupied or not
@@ -261,12 +289,13 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
     const torch::Tensor &radii,
     const torch::Tensor &bin_points,
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int bin_size,
     const int points_per_pixel)
 {
   if (points.is_cuda())
   {
+#ifdef WITH_CUDA
     CHECK_CUDA(points);
     CHECK_CUDA(radii);
     CHECK_CUDA(cutoff_thres);
@@ -275,6 +304,9 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
     CHECK_CUDA(bin_points);
     return RasterizePointsFineCuda(
         points, ellipse_params, cutoff_thres, radii, bin_points, depth_merging_thres, image_size, bin_size, points_per_pixel);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
   }
   else
   {
@@ -285,6 +317,150 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
 }
 
 
+// Coarse rasterization into variable-length bins in CSR layout, the points
+// of bin i = (n * BH + by) * BW + bx being
+// bin_points[bin_offsets[i]:bin_offsets[i + 1]]. Unlike RasterizePointsCoarse
+// there is no limit on the number of points per bin.
+//
+// Returns:
+//  bin_points: int32 Tensor of shape (T,) with the packed point indices
+//  bin_offsets: int64 Tensor of shape (N * BH * BW + 1,)
+std::tuple<torch::Tensor, torch::Tensor> RasterizePointsCoarseCsr(
+    const torch::Tensor &points,
+    const torch::Tensor &radii,
+    const torch::Tensor &cloud_to_packed_first_idx,
+    const torch::Tensor &num_points_per_cloud,
+    const std::tuple<int, int> image_size,
+    const int bin_size)
+{
+  if (points.is_cuda())
+  {
+    AT_ERROR("RasterizePointsCoarseCsr is only implemented on CPU");
+  }
+  return RasterizePointsCoarseCsrCpu(
+      points,
+      radii,
+      cloud_to_packed_first_idx,
+      num_points_per_cloud,
+      image_size,
+      bin_size);
+}
+
+std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizePointsFineCsr(
+    const torch::Tensor &points,
+    const torch::Tensor &ellipse_params,
+    const torch::Tensor &cutoff_thres,
+    const torch::Tensor &radii,
+    const torch::Tensor &bin_points,
+    const torch::Tensor &bin_offsets,
+    const float depth_merging_thres,
+    const std::tuple<int, int> image_size,
+    const int bin_size,
+    const int points_per_pixel)
+{
+  if (points.is_cuda())
+  {
+    AT_ERROR("RasterizePointsFineCsr is only implemented on CPU");
+  }
+  return RasterizePointsFineCsrCpu(
+      points, ellipse_params, cutoff_thres, radii, bin_points, bin_offsets,
+      depth_merging_thres, image_size, bin_size, points_per_pixel);
+}
+
+// Fine rasterization over CSR bins fused with weighted sum compositing of the
+// per-point features, without materializing the (N, H, W, K) fragments.
+//
+// Args:
+//  points, ellipse_params, cutoff_thres, radii, bin_points, bin_offsets,
+//  depth_merging_thres, image_size, bin_size, points_per_pixel: same as
+//                        RasterizePointsFineCsr
+//  scaler: Tensor of shape (P,) the gaussian normalization term of each splat
+//  features: Tensor of shape (P, C) the per-point features to composite
+//  normalize: normalize the weights scaler * exp(-0.5 * qvalue) of each pixel
+//             by their sum (NormWeightedCompositor), otherwise use a plain
+//             weighted sum
+//  return_weights: return the composited points and their weights of each
+//                  pixel, which are needed for the backward pass
+//
+// Returns:
+//  images: float32 Tensor of shape (N, H, W, C)
+//  occupancy: float32 Tensor of shape (N, H, W)
+//  visibility: bool Tensor of shape (P,) whether the point is composited in
+//              any pixel
+//  idx: int32 Tensor of shape (N, H, W, K) the composited points padded with
+//       -1, or (0, H, W, K) if return_weights is false
+//  weights: float32 Tensor of shape (N, H, W, K) the (normalized) weights of
+//           the composited points, or (0, H, W, K) if return_weights is false
+std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizeCompositePointsCsrCpu(
+    const torch::Tensor &points,
+    const torch::Tensor &ellipse_params,
+    const torch::Tensor &cutoff_thres,
+    const torch::Tensor &radii,
+    const torch::Tensor &scaler,
+    const torch::Tensor &features,
+    const torch::Tensor &bin_points,
+    const torch::Tensor &bin_offsets,
+    const float depth_merging_thres,
+    const std::tuple<int, int> image_size,
+    const int bin_size,
+    const int points_per_pixel,
+    const bool normalize,
+    const bool return_weights);
+
+std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizeCompositePointsCsr(
+    const torch::Tensor &points,
+    const torch::Tensor &ellipse_params,
+    const torch::Tensor &cutoff_thres,
+    const torch::Tensor &radii,
+    const torch::Tensor &scaler,
+    const torch::Tensor &features,
+    const torch::Tensor &bin_points,
+    const torch::Tensor &bin_offsets,
+    const float depth_merging_thres,
+    const std::tuple<int, int> image_size,
+    const int bin_size,
+    const int points_per_pixel,
+    const bool normalize,
+    const bool return_weights)
+{
+  if (points.is_cuda())
+  {
+    AT_ERROR("RasterizeCompositePointsCsr is only implemented on CPU");
+  }
+  return RasterizeCompositePointsCsrCpu(
+      points, ellipse_params, cutoff_thres, radii, scaler, features, bin_points, bin_offsets,
+      depth_merging_thres, image_size, bin_size, points_per_pixel, normalize, return_weights);
+}
+
+// Gradients of RasterizeCompositePointsCsr w.r.t. the features.
+//
+// Args:
+//  grad_images: (N, H, W, C) upstream gradients of the images
+//  idx: (N, H, W, K) composited points of each pixel
+//  weights: (N, H, W, K) weights of the composited points
+//  num_points: the number of points P
+//
+// Returns:
+//  grad_features: (P, C)
+torch::Tensor RasterizeCompositePointsBackwardCpu(
+    const torch::Tensor &grad_images,
+    const torch::Tensor &idx,
+    const torch::Tensor &weights,
+    const int num_points);
+
+torch::Tensor RasterizeCompositePointsBackward(
+    const torch::Tensor &grad_images,
+    const torch::Tensor &idx,
+    const torch::Tensor &weights,
+    const int num_points)
+{
+  if (grad_images.is_cuda())
+  {
+    AT_ERROR("RasterizeCompositePointsBackward is only implemented on CPU");
+  }
+  return RasterizeCompositePointsBackwardCpu(grad_images, idx, weights, num_points);
+}
+
 // ****************************************************************************
 // *                            BACKWARD PASS                                 *
 // ****************************************************************************
@@ -312,6 +488,26 @@ torch::Tensor RasterizePointsOccBackwardCpu(
     const float radii_s,
     const float depth_merging_thres);
 
+torch::Tensor RasterizePointsBackwardCpuFast(
+    const torch::Tensor &points_sorted,             // (P, 3)
+    const torch::Tensor &radii_sorted,              // (P, 2)
+    const torch::Tensor &rs,                        // (N,)
+    const torch::Tensor &grad_occ,                  // (N, H, W)
+    const torch::Tensor &num_points_per_cloud,      // (N,)
+    const torch::Tensor &cloud_to_packed_first_idx, // (N,)
+    const torch::Tensor &points_grid_off,           // (N, G)
+    const torch::Tensor &grid_params);              // (N, GRID_2D_PARAMS_SIZE)
+
+torch::Tensor RasterizePointsOccBackwardBinnedCpu(
+    const torch::Tensor &points,      // (P, 3)
+    const torch::Tensor &radii,       // (P, 2)
+    const torch::Tensor &points_mask, // (P,)
+    const torch::Tensor &rs,          // (N,)
+    const torch::Tensor &grad_occ,    // (N, H, W)
+    const torch::Tensor &bin_points,  // (T,)
+    const torch::Tensor &bin_offsets, // (N * BH * BW + 1,)
+    const int bin_size);
+
 void RasterizeZbufBackwardCpu(const at::Tensor& idx, const at::Tensor& zbuf_grad, at::Tensor& point_z_grad);
 
 #ifdef WITH_CUDA
@@ -335,6 +531,17 @@ at::Tensor RasterizePointsBackwardCudaFast(
   const at::Tensor &grid_params // (N, GRID_2D_PARAMS_SIZE)
 );
 
+at::Tensor RasterizePointsOccBackwardBinnedCuda(
+  const at::Tensor &points,      // (P, 3)
+  const at::Tensor &radii,       // (P, 2)
+  const at::Tensor &points_mask, // (P,)
+  const at::Tensor &rs,          // (N,)
+  const at::Tensor &grad_occ,    // (N, H, W)
+  const at::Tensor &bin_points,  // (T,)
+  const at::Tensor &bin_offsets, // (N * BH * BW + 1,)
+  const int bin_size
+);
+
 void RasterizeZbufBackwardCuda(const at::Tensor& idx, const at::Tensor& zbuf_grad, at::Tensor& point_z_grad);
 #endif
 
@@ -385,6 +592,140 @@ torch::Tensor RasterizePointsOccBackward(
   }
 }
 
+/*
+Args:
+ points_sorted: (P, 3) packed points sorted by their cell in a uniform 2D grid
+ radii_sorted:  (P, 2) radii of the sorted points
+ rs:            (N,) search radius of each cloud
+ grad_occ:      (N, H, W) gradients from occupancy loss
+ num_points_per_cloud: (N,)
+ cloud_to_packed_first_idx: (N,)
+ points_grid_off: (N, G) packed index of the first point in each grid cell
+ grid_params:   (N, 6) grid_min_x, grid_min_y, 1/cell_size, res_x, res_y, res_x*res_y
+Returns:
+  grad_points: (P, 2) gradients of the sorted points
+ */
+torch::Tensor RasterizePointsOccBackwardFast(
+    const torch::Tensor &points_sorted,
+    const torch::Tensor &radii_sorted,
+    const torch::Tensor &rs,
+    const torch::Tensor &grad_occ,
+    const torch::Tensor &num_points_per_cloud,
+    const torch::Tensor &cloud_to_packed_first_idx,
+    const torch::Tensor &points_grid_off,
+    const torch::Tensor &grid_params)
+{
+  // Check inputs are on the same device
+  torch::TensorArg points_t{points_sorted, "points_sorted", 1},
+      radii_t{radii_sorted, "radii_sorted", 2},
+      rs_t{rs, "rs", 3},
+      grad_occ_t{grad_occ, "grad_occ", 4},
+      num_points_per_cloud_t{num_points_per_cloud, "num_points_per_cloud", 5},
+      cloud_to_packed_first_idx_t{
+          cloud_to_packed_first_idx, "cloud_to_packed_first_idx", 6},
+      points_grid_off_t{points_grid_off, "points_grid_off", 7},
+      grid_params_t{grid_params, "grid_params", 8};
+  torch::CheckedFrom c = "RasterizePointsOccBackwardFast";
+  torch::checkDim(c, points_t, 2);
+  torch::checkSize(c, points_t, 1, 3);
+  torch::checkSize(c, radii_t, {points_t->size(0), 2});
+  torch::checkDim(c, grad_occ_t, 3);
+  torch::checkDim(c, points_grid_off_t, 2);
+  torch::checkDim(c, grid_params_t, 2);
+  torch::checkSize(c, grid_params_t, 1, 6);
+  torch::checkSameSize(c, rs_t, num_points_per_cloud_t);
+  torch::checkSameSize(c, cloud_to_packed_first_idx_t, num_points_per_cloud_t);
+  torch::checkAllSameType(c, {points_t, radii_t, rs_t, grad_occ_t, grid_params_t});
+  if (points_sorted.is_cuda())
+  {
+#ifdef WITH_CUDA
+    CHECK_CUDA(points_sorted);
+    CHECK_CUDA(radii_sorted);
+    CHECK_CUDA(rs);
+    CHECK_CUDA(grad_occ);
+    CHECK_CUDA(points_grid_off);
+    CHECK_CUDA(grid_params);
+    return RasterizePointsBackwardCudaFast(points_sorted, radii_sorted, rs, grad_occ,
+                                           num_points_per_cloud, cloud_to_packed_first_idx,
+                                           points_grid_off, grid_params);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  else
+  {
+    return RasterizePointsBackwardCpuFast(points_sorted, radii_sorted, rs, grad_occ,
+                                          num_points_per_cloud, cloud_to_packed_first_idx,
+                                          points_grid_off, grid_params);
+  }
+}
+
+/*
+Occlusion backward reusing the bins of the forward coarse rasterization as
+spatial index, with the same semantics as RasterizePointsOccBackwardFast.
+Args:
+ points:      (P, 3) packed points
+ radii:       (P, 2)
+ points_mask: (P,) only the points where it is true receive gradients
+ rs:          (N,) search radius of each cloud
+ grad_occ:    (N, H, W) gradients from occupancy loss
+ bin_points:  (T,) bins in CSR layout as returned by RasterizePointsCoarseCsr
+ bin_offsets: (N * BH * BW + 1,)
+ bin_size:    bin size (in pixels) of the coarse rasterization
+Returns:
+  grad_points: (P, 2)
+ */
+torch::Tensor RasterizePointsOccBackwardBinned(
+    const torch::Tensor &points,
+    const torch::Tensor &radii,
+    const torch::Tensor &points_mask,
+    const torch::Tensor &rs,
+    const torch::Tensor &grad_occ,
+    const torch::Tensor &bin_points,
+    const torch::Tensor &bin_offsets,
+    const int bin_size)
+{
+  // Check inputs are on the same device
+  torch::TensorArg points_t{points, "points", 1},
+      radii_t{radii, "radii", 2},
+      points_mask_t{points_mask, "points_mask", 3},
+      rs_t{rs, "rs", 4},
+      grad_occ_t{grad_occ, "grad_occ", 5},
+      bin_points_t{bin_points, "bin_points", 6},
+      bin_offsets_t{bin_offsets, "bin_offsets", 7};
+  torch::CheckedFrom c = "RasterizePointsOccBackwardBinned";
+  torch::checkDim(c, points_t, 2);
+  torch::checkSize(c, points_t, 1, 3);
+  torch::checkSize(c, radii_t, {points_t->size(0), 2});
+  torch::checkSize(c, points_mask_t, {points_t->size(0)});
+  torch::checkDim(c, grad_occ_t, 3);
+  torch::checkSize(c, rs_t, {grad_occ_t->size(0)});
+  torch::checkDim(c, bin_points_t, 1);
+  torch::checkDim(c, bin_offsets_t, 1);
+  torch::checkAllSameType(c, {points_t, radii_t, rs_t, grad_occ_t});
+  if (points.is_cuda())
+  {
+#ifdef WITH_CUDA
+    CHECK_CUDA(points);
+    CHECK_CUDA(radii);
+    CHECK_CUDA(points_mask);
+    CHECK_CUDA(rs);
+    CHECK_CUDA(grad_occ);
+    CHECK_CUDA(bin_points);
+    CHECK_CUDA(bin_offsets);
+    return RasterizePointsOccBackwardBinnedCuda(
+        points, radii, points_mask, rs, grad_occ, bin_points, bin_offsets, bin_size);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  else
+  {
+    return RasterizePointsOccBackwardBinnedCpu(
+        points, radii, points_mask, rs, grad_occ, bin_points, bin_offsets, bin_size);
+  }
+}
+
 void RasterizeZbufBackward(
     const torch::Tensor &idx,       //  (N, H, W, K)
     const torch::Tensor &grad_zbuf, // (N, H, W, K)
@@ -439,22 +780,25 @@ void RasterizeZbufBackward(
 //  cutoff_thres: define the region of each ellipse by cutting it off
 //                once its qvalue is larger than this threshold
 //  depth_merging_thres: only points that are near enough will be blended
-//  image_size:  (S) Size of the image to return (in pixels)
+//  image_size:  (H, W) Size of the image to return (in pixels)
+//               For non-square images the shorter side spans [-1, 1] in NDC
+//               and the longer side is extended so that pixels stay square.
 //  points_per_pixel: (K) The number of points to return for each pixel
 //  bin_size: Bin size (in pixels) for coarse-to-fine rasterization. Setting
 //            bin_size=0 uses naive rasterization instead.
 //  max_points_per_bin: The maximum number of points allowed to fall into each
-//                      bin when using coarse-to-fine rasterization.
+//                      bin when using coarse-to-fine rasterization. Ignored
+//                      on CPU, where the bins have variable length.
 //
 // Returns:
-//  idxs: int32 Tensor of shape (N, S, S, K) giving the indices of the
+//  idxs: int32 Tensor of shape (N, H, W, K) giving the indices of the
 //        closest K points along the z-axis for each pixel, padded with -1 for
 //        pixels hit by fewer than K points. The indices refer to points in
 //        points packed i.e a tensor of shape (P, 3) representing the flattened
 //        points for all pointclouds in the batch.
-//  zbuf: float32 Tensor of shape (N, S, S, K) giving the depth of each of each
+//  zbuf: float32 Tensor of shape (N, H, W, K) giving the depth of each of each
 //        closest point for each pixel
-//  qvalue_map: float32 Tensor of shape (N, S, S, K) giving  the value of
+//  qvalue_map: float32 Tensor of shape (N, H, W, K) giving  the value of
 //              the ellipse_function Q=(a dx^2+b dxdy+c dy^2) of the points
 //              corresponding to idx map. EWA ~ exp(-0.5Q)
 //  occupance_map: a map indicating whether this pixel is occupied or not
@@ -466,7 +810,7 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
     const torch::Tensor &cloud_to_packed_first_idx,
     const torch::Tensor &num_points_per_cloud,
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int points_per_pixel,
     const int bin_size,
     const int max_points_per_bin)
@@ -500,6 +844,30 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
         image_size,
         points_per_pixel);
   }
+  else if (!points.is_cuda())
+  {
+    // Use coarse-to-fine rasterization with variable-length bins, so
+    // max_points_per_bin is not needed.
+    torch::Tensor bin_points, bin_offsets;
+    std::tie(bin_points, bin_offsets) = RasterizePointsCoarseCsr(
+        points,
+        radii,
+        cloud_to_packed_first_idx,
+        num_points_per_cloud,
+        image_size,
+        bin_size);
+    return RasterizePointsFineCsr(
+        points,
+        ellipse_params,
+        cutoff_thres,
+        radii,
+        bin_points,
+        bin_offsets,
+        depth_merging_thres,
+        image_size,
+        bin_size,
+        points_per_pixel);
+  }
   else
   {
     // Use coarse-to-fine rasterization
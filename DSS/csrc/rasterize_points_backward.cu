@@ -91,9 +91,11 @@ __global__ void RasterizePointsBackwardCudaFastKernel(
       assert(yi >= 0 && yi < H);
 
       // Pixel in NDC coordinates
-      const float xf = PixToNdc(xi, W);
-      const float yf = PixToNdc(yi, H);
-      assert(abs(xf) <= 1.0 && abs(yf) <= 1.0);
+      const float x_max = NonSquareNdcRange(W, H) / 2.0f;
+      const float y_max = NonSquareNdcRange(H, W) / 2.0f;
+      const float xf = PixToNdc(xi, W, H);
+      const float yf = PixToNdc(yi, H, W);
+      assert(abs(xf) <= x_max && abs(yf) <= y_max);
 
       const long cur_first_idx = cloud_to_packed_first_idx[n];
       const float cur_r = rs[n];  // search radius
@@ -122,7 +124,7 @@ __global__ void RasterizePointsBackwardCudaFastKernel(
           const int64_t p2_start = points_grid_off[n*G + cell_idx];
           int p2_end;
           if (cell_idx+1 == grid_total) {
-            p2_end = num_points_per_cloud[n];
+            p2_end = cur_first_idx + num_points_per_cloud[n];
           }
           else {
             p2_end = points_grid_off[n*G+cell_idx+1];
@@ -142,7 +144,7 @@ __global__ void RasterizePointsBackwardCudaFastKernel(
             const float py = points_sorted[p_idx * 3 + 1];
             const float pz = points_sorted[p_idx * 3 + 2];
             // outside renderable area
-            if (pz < 0 || abs(py) > 1.0 || abs(px) > 1.0)
+            if (pz < 0 || abs(py) > y_max || abs(px) > x_max)
               continue;
             const float dx = xf - px;
             const float dy = yf - py;
@@ -319,4 +321,197 @@ at::Tensor RasterizePointsBackwardCudaFast(
   AT_CUDA_CHECK(cudaGetLastError());
 
   return grad_points_sorted;
-}
\ No newline at end of file
+}
+// NDC start of the first bin and extent of the bins along an axis of S1
+// pixels (the other axis has S2 pixels), as the bins of the coarse
+// rasterization kernel. PixToNdc gives the center of each pixel, so we need
+// to subtract a half pixel to get the start of the first bin.
+__device__ inline void BinAxis(const int bin_size, const int S1, const int S2, float &ndc_min, float &bin_extent)
+{
+  const float half_pix = 1.0f / min(S1, S2);
+  ndc_min = PixToNdc(0, S1, S2) - half_pix;
+  bin_extent = PixToNdc(bin_size, S1, S2) - PixToNdc(0, S1, S2);
+}
+
+// The last bin starting before v, i.e. the bin whose list contains all the
+// points centered at v, clamped to [0, B-1]. Monotonic in v.
+__device__ inline int CenterBin(const float v, const float ndc_min, const float bin_extent, const int B)
+{
+  const float b = floorf((v - ndc_min) / bin_extent);
+  return (int)fminf(fmaxf(b, 0.0f), B - 1.0f);
+}
+
+// Range [b0, b1] of the center bins of the points in [v0, v1], empty if
+// b0 > b1, i.e. if [v0, v1] does not overlap any bin.
+__device__ inline void BinRange(const float v0, const float v1, const float ndc_min, const float bin_extent, const int B, int &b0, int &b1)
+{
+  if (v1 < ndc_min || v0 > ndc_min + B * bin_extent)
+  {
+    b0 = B;
+    b1 = -1;
+    return;
+  }
+  b0 = CenterBin(v0, ndc_min, bin_extent, B);
+  b1 = CenterBin(v1, ndc_min, bin_extent, B);
+}
+
+__global__ void RasterizePointsOccBackwardBinnedCudaKernel(
+    const float* __restrict__ points,           // (P,3)
+    const float* __restrict__ radii,            // (P,2)
+    const bool* __restrict__ points_mask,       // (P,)
+    const float* __restrict__ rs,               // (N,)
+    const float* __restrict__ grad_occ,         // (N,H,W)
+    const int32_t* __restrict__ bin_points,     // (T,)
+    const int64_t* __restrict__ bin_offsets,    // (N*BH*BW+1,)
+    const int N,
+    const int H,
+    const int W,
+    const int BH,
+    const int BW,
+    const int bin_size,
+    float* grad_points                          // (P,2)
+) {
+  const int num_pixels = N * H * W;
+  // NDC extent of the image
+  const float x_max = NonSquareNdcRange(W, H) / 2.0f;
+  const float y_max = NonSquareNdcRange(H, W) / 2.0f;
+  // bins in closed form, so that looking up a bin is O(1)
+  float bin_min_x, bin_extent_x, bin_min_y, bin_extent_y;
+  BinAxis(bin_size, W, H, bin_min_x, bin_extent_x);
+  BinAxis(bin_size, H, W, bin_min_y, bin_extent_y);
+  const int num_threads = gridDim.x * blockDim.x;
+  const int tid = blockIdx.x * blockDim.x + threadIdx.x;
+
+  for (int pid = tid; pid < num_pixels; pid += num_threads) {
+    const float grad_occ_pix = grad_occ[pid];
+    if (grad_occ_pix == 0.0f)
+      continue;
+    const int n = pid / (H * W);
+    const int yidx = (pid % (H * W)) / W;
+    const int xidx = pid % W;
+    // reverse because NDC assuming +y is up and +x is left
+    const float yf = PixToNdc(H - 1 - yidx, H, W);
+    const float xf = PixToNdc(W - 1 - xidx, W, H);
+
+    const float cur_r = rs[n];  // search radius
+    const float cur_r2 = cur_r * cur_r;
+
+    int bx0, bx1, by0, by1;
+    BinRange(xf - cur_r, xf + cur_r, bin_min_x, bin_extent_x, BW, bx0, bx1);
+    BinRange(yf - cur_r, yf + cur_r, bin_min_y, bin_extent_y, BH, by0, by1);
+
+    for (int by = by0; by <= by1; ++by) {
+      for (int bx = bx0; bx <= bx1; ++bx) {
+        const int64_t bin = ((int64_t)n * BH + by) * BW + bx;
+        for (int64_t i = bin_offsets[bin]; i < bin_offsets[bin + 1]; ++i) {
+          const int p_idx = bin_points[i];
+          if (!points_mask[p_idx])
+            continue;
+          const float px = points[p_idx * 3 + 0];
+          const float py = points[p_idx * 3 + 1];
+          const float pz = points[p_idx * 3 + 2];
+          // outside renderable area
+          if (pz < 0 || abs(py) > y_max || abs(px) > x_max)
+            continue;
+          // a point is listed in all the bins overlapped by its splat,
+          // only count it in the bin of its center
+          if (CenterBin(px, bin_min_x, bin_extent_x, BW) != bx ||
+              CenterBin(py, bin_min_y, bin_extent_y, BH) != by)
+            continue;
+          const float dx = xf - px;
+          const float dy = yf - py;
+          const float dist2 = dx * dx + dy * dy;
+
+          // inside backpropagation radius?
+          if (dist2 > cur_r2)
+            continue;
+
+          // if grad_occ_pix > 0, it means that this pixel shouldn't be occluded
+          // but if it's outside the splat, it doesn't generate meaninigful information
+          // for in which direction the point should move.
+          const bool pix_outside_splat = (abs(dx) > radii[p_idx * 2 + 0]) || (abs(dy) > radii[p_idx * 2 + 1]);
+          if (grad_occ_pix > 0.0f && pix_outside_splat)
+            continue;
+
+          const float denom = max(dist2, 1e-10f);
+          gpuAtomicAdd(grad_points + p_idx * 2 + 0, dx / denom * grad_occ_pix);
+          gpuAtomicAdd(grad_points + p_idx * 2 + 1, dy / denom * grad_occ_pix);
+        }
+      }
+    }
+  }
+}
+
+/*
+Same as RasterizePointsBackwardCudaFast, but the points are looked up in the
+bins of the forward coarse rasterization (in CSR layout) instead of a
+dedicated grid.
+Args:
+  points,       // (P, 3)
+  radii,        // (P, 2)
+  points_mask,  // (P,) only the points where it is true receive gradients
+  rs,           // (N, )
+  grad_occ,     // (N, H, W)
+  bin_points,   // (T,)
+  bin_offsets,  // (N*BH*BW+1,)
+  bin_size
+Returns:
+  grad_points: (P, 2)
+ */
+at::Tensor RasterizePointsOccBackwardBinnedCuda(
+  const at::Tensor &points,
+  const at::Tensor &radii,
+  const at::Tensor &points_mask,
+  const at::Tensor &rs,
+  const at::Tensor &grad_occ,
+  const at::Tensor &bin_points,
+  const at::Tensor &bin_offsets,
+  const int bin_size
+) {
+  // Check inputs are on the same device
+  at::TensorArg points_t{points, "points", 1},
+      radii_t{radii, "radii", 2},
+      points_mask_t{points_mask, "points_mask", 3},
+      rs_t{rs, "rs", 4},
+      grad_occ_t{grad_occ, "grad_occ", 5},
+      bin_points_t{bin_points, "bin_points", 6},
+      bin_offsets_t{bin_offsets, "bin_offsets", 7};
+  at::CheckedFrom c = "RasterizePointsOccBackwardBinnedCuda";
+  at::checkAllSameGPU(
+      c, {points_t, radii_t, points_mask_t, rs_t, grad_occ_t, bin_points_t, bin_offsets_t});
+
+  // Set the device for the kernel launch based on the device of the input
+  at::cuda::CUDAGuard device_guard(points.device());
+  cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+  const int P = points.size(0);
+  const int N = grad_occ.size(0);
+  const int H = grad_occ.size(1);
+  const int W = grad_occ.size(2);
+  const int BH = 1 + (H - 1) / bin_size;
+  const int BW = 1 + (W - 1) / bin_size;
+
+  const size_t blocks = 1024;
+  const size_t threads = 64;
+  at::Tensor grad_points = at::zeros({P, 2}, points.options());
+  RasterizePointsOccBackwardBinnedCudaKernel<<<blocks, threads, 0, stream>>>(
+      points.contiguous().data_ptr<float>(),
+      radii.contiguous().data_ptr<float>(),
+      points_mask.to(at::kBool).contiguous().data_ptr<bool>(),
+      rs.contiguous().data_ptr<float>(),
+      grad_occ.contiguous().data_ptr<float>(),
+      bin_points.to(at::kInt).contiguous().data_ptr<int32_t>(),
+      bin_offsets.to(at::kLong).contiguous().data_ptr<int64_t>(),
+      N,
+      H,
+      W,
+      BH,
+      BW,
+      bin_size,
+      grad_points.data_ptr<float>()
+  );
+
+  AT_CUDA_CHECK(cudaGetLastError());
+
+  return grad_points;
+}
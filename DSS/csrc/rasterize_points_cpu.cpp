@@ -1,16 +1,44 @@
 // TODO(lixin)
 #include <torch/extension.h>
-#include <queue>
+#include <ATen/Parallel.h>
 #include <tuple>
 #include <algorithm>
+#include <functional>
+#include <numeric>
+#include <vector>
+#include "cpu_utils.h"
 
-// Given a pixel coordinate 0 <= i < S, convert it to a normalized device
-// coordinate in the range [-1, 1]. The NDC range is divided into S evenly-sized
-// pixels, and assume that each pixel falls in the *center* of its range.
-static float PixToNdc(const int i, const int S)
+#define GRID_2D_MIN_X 0
+#define GRID_2D_MIN_Y 1
+#define GRID_2D_DELTA 2
+#define GRID_2D_RES_X 3
+#define GRID_2D_RES_Y 4
+#define GRID_2D_TOTAL 5
+#define GRID_2D_PARAMS_SIZE 6
+
+// Length of the NDC range along an image axis of S1 pixels, S2 being the
+// number of pixels along the other axis. As in pytorch3d, the shorter side
+// spans [-1, 1] and the longer side is extended so that pixels are square.
+static float NonSquareNdcRange(const int S1, const int S2)
+{
+  float range = 2.0f;
+  if (S1 > S2)
+  {
+    range = (S1 * range) / S2;
+  }
+  return range;
+}
+
+// Given a pixel coordinate 0 <= i < S1, convert it to a normalized device
+// coordinate. The NDC range is divided into S1 evenly-sized pixels, and assume
+// that each pixel falls in the *center* of its range. S2 is the number of
+// pixels along the other axis, for square images the range is [-1, 1].
+static float PixToNdc(const int i, const int S1, const int S2)
 {
+  const float range = NonSquareNdcRange(S1, S2);
+  const float offset = range / 2.0f;
   // NDC x-offset + (i * pixel_width + half_pixel_width)
-  return -1 + (2 * i + 1.0f) / S;
+  return -offset + (range * i + offset) / S1;
 }
 
 template <typename T>
@@ -24,6 +52,57 @@ inline float Qvalue(const float dx, const float dy, const float a, const float b
   return a * dx * dx + b * dx * dy + c * dy * dy;
 }
 
+// Holds the K closest points of a pixel sorted by increasing (z, idx), i.e.
+// the same entries and order as popping a
+// std::priority_queue<std::tuple<float, int, float>> capped at K elements,
+// without the per-pixel heap allocation. The storage is reused across pixels.
+class PointBuffer
+{
+public:
+  explicit PointBuffer(const int K) : K(K), size(0), z(K), idx(K), qvalue(K) {}
+
+  void Clear() { size = 0; }
+
+  void Insert(const float pz, const int p, const float qvalue_p)
+  {
+    int i = size;
+    if (size < K)
+    {
+      size++;
+    }
+    else if (K > 0 && Closer(pz, p, z[K - 1], idx[K - 1]))
+    {
+      i = K - 1;
+    }
+    else
+    {
+      return;
+    }
+    // shift the farther entries back by one
+    for (; i > 0 && Closer(pz, p, z[i - 1], idx[i - 1]); --i)
+    {
+      z[i] = z[i - 1];
+      idx[i] = idx[i - 1];
+      qvalue[i] = qvalue[i - 1];
+    }
+    z[i] = pz;
+    idx[i] = p;
+    qvalue[i] = qvalue_p;
+  }
+
+  const int K;
+  int size;
+  std::vector<float> z;
+  std::vector<int> idx;
+  std::vector<float> qvalue;
+
+private:
+  static bool Closer(const float z0, const int idx0, const float z1, const int idx1)
+  {
+    return z0 < z1 || (z0 == z1 && idx0 < idx1);
+  }
+};
+
 std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizePointsNaiveCpu(
     const torch::Tensor &points,
     const torch::Tensor &ellipse_params,
@@ -32,57 +111,64 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
     const torch::Tensor &cloud_to_packed_first_idx,
     const torch::Tensor &num_points_per_cloud,
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int points_per_pixel)
 {
   const int32_t N = cloud_to_packed_first_idx.size(0); // batch_size.
 
-  const int S = image_size;
+  const int H = std::get<0>(image_size);
+  const int W = std::get<1>(image_size);
   const int K = points_per_pixel;
 
   // Initialize output tensors.
   auto int_opts = num_points_per_cloud.options().dtype(torch::kInt32);
   auto float_opts = points.options().dtype(torch::kFloat32);
-  torch::Tensor point_idxs = torch::full({N, S, S, K}, -1, int_opts);
-  torch::Tensor zbuf = torch::full({N, S, S, K}, -1, float_opts);
-  torch::Tensor qvalue = torch::full({N, S, S, K}, -1, float_opts);
-  torch::Tensor occupancy = torch::full({N, S, S}, 0, float_opts);
+  torch::Tensor point_idxs = torch::full({N, H, W, K}, -1, int_opts);
+  torch::Tensor zbuf = torch::full({N, H, W, K}, -1, float_opts);
+  torch::Tensor qvalue = torch::full({N, H, W, K}, -1, float_opts);
+  torch::Tensor occupancy = torch::full({N, H, W}, 0, float_opts);
+
+  const torch::Tensor first_idxs = cloud_to_packed_first_idx.to(torch::kInt64);
+  const torch::Tensor num_points = num_points_per_cloud.to(torch::kInt64);
 
   auto points_a = points.accessor<float, 2>();
   auto radii_a = radii.accessor<float, 2>();
   auto ellipse_params_a = ellipse_params.accessor<float, 2>();
   auto cutoff_a = cutoff_thres.accessor<float, 1>();
+  auto first_idxs_a = first_idxs.accessor<int64_t, 1>();
+  auto num_points_a = num_points.accessor<int64_t, 1>();
 
   auto point_idxs_a = point_idxs.accessor<int32_t, 4>();
   auto zbuf_a = zbuf.accessor<float, 4>();
   auto qvalue_a = qvalue.accessor<float, 4>();
   auto occupancy_a = occupancy.accessor<float, 3>();
 
-  for (int n = 0; n < N; ++n)
-  {
-    // Loop through each pointcloud in the batch.
-    // Get the start index of the points in points_packed and the num points
-    // in the point cloud.
-    const int point_start_idx =
-        cloud_to_packed_first_idx[n].item().to<int32_t>();
-    const int point_stop_idx =
-        (point_start_idx + num_points_per_cloud[n].item().to<int32_t>());
-
-    for (int yi = 0; yi < S; ++yi)
+  // Each (n, yi) image row only writes to its own output row, so the rows of
+  // all images in the batch are distributed over the intra-op thread pool.
+  at::parallel_for(0, N * H, 1, [&](int64_t row_start, int64_t row_end) {
+    // (z, idx, qvalue) of the K closest points of the current pixel
+    PointBuffer q(K);
+    for (int64_t row = row_start; row < row_end; ++row)
     {
+      const int n = row / H;
+      const int yi = row % H;
+      // Get the start index of the points in points_packed and the num points
+      // in the point cloud.
+      const int point_start_idx = first_idxs_a[n];
+      const int point_stop_idx = point_start_idx + num_points_a[n];
+
       // Reverse the order of yi so that +Y is pointing upwards in the image.
-      const int yidx = S - 1 - yi;
-      const float yf = PixToNdc(yidx, S);
+      const int yidx = H - 1 - yi;
+      const float yf = PixToNdc(yidx, H, W);
 
-      for (int xi = 0; xi < S; ++xi)
+      for (int xi = 0; xi < W; ++xi)
       {
         // Reverse the order of xi so that +X is pointing to the left in the
         // image.
-        const int xidx = S - 1 - xi;
-        const float xf = PixToNdc(xidx, S);
+        const int xidx = W - 1 - xi;
+        const float xf = PixToNdc(xidx, W, H);
 
-        // Use a priority queue to hold (z, idx, qvalue)
-        std::priority_queue<std::tuple<float, int, float>> q;
+        q.Clear();
         for (int p = point_start_idx; p < point_stop_idx; ++p)
         {
           const float px = points_a[p][0];
@@ -102,24 +188,15 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
           float qvalue_p = Qvalue(dx, dy, ellipse_params_a[p][0], ellipse_params_a[p][1], ellipse_params_a[p][2]);
           if (qvalue_p > cutoff_a[p])
             continue;
-          q.emplace(pz, p, qvalue_p);
-          // printf("dx dy = (%g, %g), radii = (%g, %g), qsize = %lu, queue top = (%g, %d, %g)\n", dx, dy, radiix, radiiy,
-          //        q.size(), std::get<0>(q.top()), std::get<1>(q.top()), std::get<2>(q.top()));
-          if ((int)q.size() > K)
-          {
-            q.pop();
-          }
+          q.Insert(pz, p, qvalue_p);
         }
-        // Now all the points have been seen, so pop elements off the queue
-        // one by one and write them into the output tensors.
-        while (!q.empty())
+        // Now all the points have been seen, write the sorted buffer into the
+        // output tensors.
+        for (int i = 0; i < q.size; ++i)
         {
-          auto t = q.top();
-          q.pop();
-          int i = q.size();
-          zbuf_a[n][yi][xi][i] = std::get<0>(t);
-          point_idxs_a[n][yi][xi][i] = std::get<1>(t);
-          qvalue_a[n][yi][xi][i] = std::get<2>(t);
+          zbuf_a[n][yi][xi][i] = q.z[i];
+          point_idxs_a[n][yi][xi][i] = q.idx[i];
+          qvalue_a[n][yi][xi][i] = q.qvalue[i];
         }
         // traverse zbuf again to remove elements according to depth_merging_thres
         if (point_idxs_a[n][yi][xi][0] >= 0 && zbuf_a[n][yi][xi][0] >= 0)
@@ -139,240 +216,630 @@ std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> Rasterize
         }
       }
     }
-  }
+  });
   return std::make_tuple(point_idxs, zbuf, qvalue, occupancy);
 }
 
-// TODO(lixin)
+// Extents [bin_min[b], bin_max[b]] in NDC of the B bins along one axis of the
+// coarse rasterization, S1 being the number of pixels along this axis and S2
+// along the other one. They are accumulated in the same order as a
+// left-to-right sweep so the boundaries do not depend on how the bins are
+// visited.
+static void BinEdges(const int S1, const int S2, const int bin_size, std::vector<float> &bin_min, std::vector<float> &bin_max)
+{
+  const int B = 1 + (S1 - 1) / bin_size; // Integer division round up
+  const float range = NonSquareNdcRange(S1, S2);
+  const float pixel_width = range / S1;
+  const float bin_width = pixel_width * bin_size;
+  bin_min.resize(B);
+  bin_max.resize(B);
+  float bin_lo = -range / 2.0f;
+  float bin_hi = bin_lo + bin_width;
+  for (int b = 0; b < B; ++b)
+  {
+    bin_min[b] = bin_lo;
+    bin_max[b] = bin_hi;
+    bin_lo = bin_hi;
+    bin_hi = bin_lo + bin_width;
+  }
+}
+
+// Range [b0, b1] of the bins that overlap [p_min, p_max]. Use a closed
+// interval test, so points exactly on the boundary between bins will fall
+// into both of them. Returns false if no bin overlaps.
+static bool BinRange(
+    const std::vector<float> &bin_min, const std::vector<float> &bin_max,
+    const float p_min, const float p_max, int &b0, int &b1)
+{
+  b0 = std::lower_bound(bin_max.begin(), bin_max.end(), p_min) - bin_max.begin();
+  b1 = std::upper_bound(bin_min.begin(), bin_min.end(), p_max) - bin_min.begin() - 1;
+  return b0 <= b1;
+}
+
+// Point-driven coarse rasterization. Instead of testing every point against
+// every bin, each point walks the bins overlapped by its axis-aligned radius
+// box. Bins are stored as variable-length lists in CSR layout:
+// the points of bin (n, by, bx) are
+//   bin_points[bin_offsets[i]:bin_offsets[i + 1]], i = (n * BH + by) * BW + bx
+// and are sorted by their packed index.
+// Returns:
+//  bin_points: int32 Tensor of shape (T,), T being the total number of
+//              (point, bin) overlaps
+//  bin_offsets: int64 Tensor of shape (N * BH * BW + 1,)
+std::tuple<torch::Tensor, torch::Tensor> RasterizePointsCoarseCsrCpu(
+    const torch::Tensor &points,                    // (P, 3)
+    const torch::Tensor &radii,                     // (P, 2)
+    const torch::Tensor &cloud_to_packed_first_idx, // (N)
+    const torch::Tensor &num_points_per_cloud,      // (N)
+    const std::tuple<int, int> image_size,
+    const int bin_size)
+{
+  const int32_t N = cloud_to_packed_first_idx.size(0); // batch_size.
+  const int64_t P = points.size(0);
+
+  const int H = std::get<0>(image_size);
+  const int W = std::get<1>(image_size);
+  // Integer division round up
+  const int BH = 1 + (H - 1) / bin_size;
+  const int BW = 1 + (W - 1) / bin_size;
+  const int64_t num_bins = (int64_t)N * BH * BW;
+
+  std::vector<float> bin_min_x, bin_max_x, bin_min_y, bin_max_y;
+  BinEdges(W, H, bin_size, bin_min_x, bin_max_x);
+  BinEdges(H, W, bin_size, bin_min_y, bin_max_y);
+
+  // Map every packed point to its cloud, -1 for the points of no cloud.
+  const torch::Tensor first_idxs = cloud_to_packed_first_idx.to(torch::kInt64);
+  const torch::Tensor num_points = num_points_per_cloud.to(torch::kInt64);
+  auto first_idxs_a = first_idxs.accessor<int64_t, 1>();
+  auto num_points_a = num_points.accessor<int64_t, 1>();
+  std::vector<int32_t> point_cloud(P, -1);
+  for (int n = 0; n < N; ++n)
+  {
+    std::fill(point_cloud.begin() + first_idxs_a[n],
+              point_cloud.begin() + first_idxs_a[n] + num_points_a[n], n);
+  }
+
+  auto points_a = points.accessor<float, 2>();
+  auto radii_a = radii.accessor<float, 2>();
+
+  // The points are split in contiguous chunks, one per task. Each task counts
+  // its points per bin, the counts are turned into write offsets with a
+  // prefix sum over (bin, task), and each task scatters its points. Since the
+  // chunks are contiguous, the points in every bin keep their packed order.
+  const int64_t num_tasks = std::max<int64_t>(1, std::min<int64_t>(at::get_num_threads(), P));
+  const int64_t chunk_size = (P + num_tasks - 1) / num_tasks;
+  std::vector<int64_t> task_bin_offsets(num_tasks * num_bins, 0);
+
+  auto for_each_point_bin = [&](const int64_t task, const std::function<void(int64_t, int64_t)> &fn) {
+    const int64_t p_stop = std::min(P, (task + 1) * chunk_size);
+    for (int64_t p = task * chunk_size; p < p_stop; ++p)
+    {
+      const int n = point_cloud[p];
+      if (n < 0 || points_a[p][2] < 0)
+      {
+        continue;
+      }
+      int bx0, bx1, by0, by1;
+      if (!BinRange(bin_min_x, bin_max_x, points_a[p][0] - radii_a[p][0], points_a[p][0] + radii_a[p][0], bx0, bx1) ||
+          !BinRange(bin_min_y, bin_max_y, points_a[p][1] - radii_a[p][1], points_a[p][1] + radii_a[p][1], by0, by1))
+      {
+        continue;
+      }
+      for (int by = by0; by <= by1; ++by)
+      {
+        for (int bx = bx0; bx <= bx1; ++bx)
+        {
+          fn(p, ((int64_t)n * BH + by) * BW + bx);
+        }
+      }
+    }
+  };
+
+  // 1. count
+  at::parallel_for(0, num_tasks, 1, [&](int64_t task_start, int64_t task_end) {
+    for (int64_t task = task_start; task < task_end; ++task)
+    {
+      int64_t *counts = task_bin_offsets.data() + task * num_bins;
+      for_each_point_bin(task, [&](int64_t p, int64_t bin) { counts[bin]++; });
+    }
+  });
+
+  // 2. exclusive prefix sum in (bin, task) order
+  torch::Tensor bin_offsets = torch::empty({num_bins + 1}, torch::kInt64);
+  auto bin_offsets_a = bin_offsets.accessor<int64_t, 1>();
+  int64_t total = 0;
+  for (int64_t bin = 0; bin < num_bins; ++bin)
+  {
+    bin_offsets_a[bin] = total;
+    for (int64_t task = 0; task < num_tasks; ++task)
+    {
+      const int64_t count = task_bin_offsets[task * num_bins + bin];
+      task_bin_offsets[task * num_bins + bin] = total;
+      total += count;
+    }
+  }
+  bin_offsets_a[num_bins] = total;
+
+  // 3. scatter
+  torch::Tensor bin_points = torch::empty({total}, num_points_per_cloud.options().dtype(torch::kInt32));
+  int32_t *bin_points_ptr = bin_points.data_ptr<int32_t>();
+  at::parallel_for(0, num_tasks, 1, [&](int64_t task_start, int64_t task_end) {
+    for (int64_t task = task_start; task < task_end; ++task)
+    {
+      int64_t *offsets = task_bin_offsets.data() + task * num_bins;
+      for_each_point_bin(task, [&](int64_t p, int64_t bin) { bin_points_ptr[offsets[bin]++] = p; });
+    }
+  });
+  return std::make_tuple(bin_points, bin_offsets);
+}
+
+// Coarse rasterization into a fixed size (N, BH, BW, M) tensor padded with -1,
+// the layout of the CUDA kernel.
 torch::Tensor RasterizePointsCoarseCpu(
     const torch::Tensor &points,                    // (P, 3)
     const torch::Tensor &radii,                     // (P, 2)
     const torch::Tensor &cloud_to_packed_first_idx, // (N)
     const torch::Tensor &num_points_per_cloud,      // (N)
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int bin_size,
     const int max_points_per_bin)
 {
   const int32_t N = cloud_to_packed_first_idx.size(0); // batch_size.
 
-  const int B = 1 + (image_size - 1) / bin_size; // Integer division round up
+  // Integer division round up
+  const int BH = 1 + (std::get<0>(image_size) - 1) / bin_size;
+  const int BW = 1 + (std::get<1>(image_size) - 1) / bin_size;
   const int M = max_points_per_bin;
   auto opts = num_points_per_cloud.options().dtype(torch::kInt32);
-  torch::Tensor points_per_bin = torch::zeros({N, B, B}, opts);
-  torch::Tensor bin_points = torch::full({N, B, B, M}, -1, opts);
+  torch::Tensor bin_points = torch::full({N, BH, BW, M}, -1, opts);
 
-  auto points_a = points.accessor<float, 2>();
-  auto radii_a = radii.accessor<float, 2>();
-  auto points_per_bin_a = points_per_bin.accessor<int32_t, 3>();
+  torch::Tensor bin_points_csr, bin_offsets;
+  std::tie(bin_points_csr, bin_offsets) = RasterizePointsCoarseCsrCpu(
+      points, radii, cloud_to_packed_first_idx, num_points_per_cloud, image_size, bin_size);
+  auto bin_offsets_a = bin_offsets.accessor<int64_t, 1>();
+  auto bin_points_csr_a = bin_points_csr.accessor<int32_t, 1>();
   auto bin_points_a = bin_points.accessor<int32_t, 4>();
-
-  const float pixel_width = 2.0f / image_size;
-  const float bin_width = pixel_width * bin_size;
-
   for (int n = 0; n < N; ++n)
   {
-    // Loop through each pointcloud in the batch.
-    // Get the start index of the points in points_packed and the num points
-    // in the point cloud.
-    const int point_start_idx =
-        cloud_to_packed_first_idx[n].item().to<int32_t>();
-    const int point_stop_idx =
-        (point_start_idx + num_points_per_cloud[n].item().to<int32_t>());
-
-    float bin_y_min = -1.0f;
-    float bin_y_max = bin_y_min + bin_width;
-
-    // Iterate through the horizontal bins from top to bottom.
-    for (int by = 0; by < B; by++)
+    for (int by = 0; by < BH; ++by)
     {
-      float bin_x_min = -1.0f;
-      float bin_x_max = bin_x_min + bin_width;
-
-      // Iterate through bins on this horizontal line, left to right.
-      for (int bx = 0; bx < B; bx++)
+      for (int bx = 0; bx < BW; ++bx)
       {
-        int32_t points_hit = 0;
-        for (int p = point_start_idx; p < point_stop_idx; ++p)
+        const int64_t bin = ((int64_t)n * BH + by) * BW + bx;
+        const int64_t bin_start = bin_offsets_a[bin];
+        const int64_t points_hit = bin_offsets_a[bin + 1] - bin_start;
+        // Got too many points for this bin, so throw an error.
+        if (points_hit > max_points_per_bin)
         {
-          float px = points_a[p][0];
-          float py = points_a[p][1];
-          float pz = points_a[p][2];
-          if (pz < 0)
-          {
-            continue;
-          }
-          float point_x_min = px - radii_a[p][0];
-          float point_x_max = px + radii_a[p][0];
-          float point_y_min = py - radii_a[p][1];
-          float point_y_max = py + radii_a[p][1];
-
-          // Use a half-open interval so that points exactly on the
-          // boundary between bins will fall into exactly one bin.
-          bool x_hit = (point_x_min <= bin_x_max) && (bin_x_min <= point_x_max);
-          bool y_hit = (point_y_min <= bin_y_max) && (bin_y_min <= point_y_max);
-          if (x_hit && y_hit)
-          {
-            // Got too many points for this bin, so throw an error.
-            if (points_hit >= max_points_per_bin)
-            {
-              AT_ERROR("Got too many points per bin");
-            }
-            // The current point falls in the current bin, so
-            // record it.
-            bin_points_a[n][by][bx][points_hit] = p;
-            points_hit++;
-          }
+          AT_ERROR("Got too many points per bin");
+        }
+        for (int i = 0; i < points_hit; ++i)
+        {
+          bin_points_a[n][by][bx][i] = bin_points_csr_a[bin_start + i];
         }
-        // Record the number of points found in this bin
-        points_per_bin_a[n][by][bx] = points_hit;
-
-        // Shift the bin to the right for the next loop iteration
-        bin_x_min = bin_x_max;
-        bin_x_max = bin_x_min + bin_width;
       }
-      // Shift the bin down for the next loop iteration
-      bin_y_min = bin_y_max;
-      bin_y_max = bin_y_min + bin_width;
     }
   }
   return bin_points;
 }
 
-std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizePointsFineCpu(
+// Collects the K closest points among bin_points[begin:end] whose splat
+// covers the pixel at (xf, yf) (in NDC) into the buffer q.
+static void SplatPixel(
+    const float xf,
+    const float yf,
+    const torch::TensorAccessor<int32_t, 1> &bin_points_a,
+    const int64_t begin,
+    const int64_t end,
+    const torch::TensorAccessor<float, 2> &points_a,
+    const torch::TensorAccessor<float, 2> &ellipse_params_a,
+    const torch::TensorAccessor<float, 1> &cutoff_a,
+    const torch::TensorAccessor<float, 2> &radii_a,
+    PointBuffer &q)
+{
+  q.Clear();
+  for (int64_t i = begin; i < end; ++i)
+  {
+    const int p = bin_points_a[i];
+    const float px = points_a[p][0];
+    const float py = points_a[p][1];
+    const float pz = points_a[p][2];
+    if (pz < 0)
+    {
+      continue;
+    }
+    const float dx = xf - px;
+    const float dy = yf - py;
+    const float radiix = radii_a[p][0];
+    const float radiiy = radii_a[p][1];
+    if (abs(dx) > radiix || abs(dy) > radiiy)
+      continue;
+    // The current point hit the current pixel
+    float qvalue_p = Qvalue(dx, dy, ellipse_params_a[p][0], ellipse_params_a[p][1], ellipse_params_a[p][2]);
+    if (qvalue_p > cutoff_a[p])
+      continue;
+    q.Insert(pz, p, qvalue_p);
+  }
+}
+
+// Fine rasterization over the CSR bins of RasterizePointsCoarseCsrCpu.
+std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizePointsFineCsrCpu(
     const torch::Tensor &points,         // (P, 3)
     const torch::Tensor &ellipse_params, // (P, 3)
     const torch::Tensor &cutoff_thres,   // (P,)
     const torch::Tensor &radii,          // (P,2)
-    const torch::Tensor &bin_points,     // (N, B, B, M)
+    const torch::Tensor &bin_points,     // (T,)
+    const torch::Tensor &bin_offsets,    // (N * BH * BW + 1,)
     const float depth_merging_thres,
-    const int image_size,
+    const std::tuple<int, int> image_size,
     const int bin_size,
     const int points_per_pixel)
 {
-  const int N = bin_points.size(0); // batch_size.
-  const int M = bin_points.size(3);
-  const int S = image_size;
+  const int H = std::get<0>(image_size);
+  const int W = std::get<1>(image_size);
+  const int BH = 1 + (H - 1) / bin_size;
+  const int BW = 1 + (W - 1) / bin_size;
+  const int N = (bin_offsets.size(0) - 1) / (BH * BW); // batch_size.
   const int K = points_per_pixel;
 
   // Initialize output tensors.
   auto int_opts = bin_points.options().dtype(torch::kInt32);
   auto float_opts = points.options().dtype(torch::kFloat32);
-  torch::Tensor point_idxs = torch::full({N, S, S, K}, -1, int_opts);
-  torch::Tensor zbuf = torch::full({N, S, S, K}, -1, float_opts);
-  torch::Tensor qvalue = torch::full({N, S, S, K}, -1, float_opts);
-  torch::Tensor occupancy = torch::full({N, S, S}, 0, float_opts);
+  torch::Tensor point_idxs = torch::full({N, H, W, K}, -1, int_opts);
+  torch::Tensor zbuf = torch::full({N, H, W, K}, -1, float_opts);
+  torch::Tensor qvalue = torch::full({N, H, W, K}, -1, float_opts);
+  torch::Tensor occupancy = torch::full({N, H, W}, 0, float_opts);
 
   auto points_a = points.accessor<float, 2>();
   auto radii_a = radii.accessor<float, 2>();
   auto ellipse_params_a = ellipse_params.accessor<float, 2>();
   auto cutoff_a = cutoff_thres.accessor<float, 1>();
-  auto bin_points_a = bin_points.accessor<int, 4>();
+  auto bin_points_a = bin_points.accessor<int32_t, 1>();
+  auto bin_offsets_a = bin_offsets.accessor<int64_t, 1>();
 
   auto point_idxs_a = point_idxs.accessor<int32_t, 4>();
   auto zbuf_a = zbuf.accessor<float, 4>();
   auto qvalue_a = qvalue.accessor<float, 4>();
   auto occupancy_a = occupancy.accessor<float, 3>();
 
-  for (int n = 0; n < N; ++n)
-  {
-    // Loop through each pointcloud in the batch.
-
-    for (int yi = 0; yi < S; ++yi)
+  // Each (n, yi) pixel row is rasterized independently and written to the
+  // mirrored output row (n, H - 1 - yi), which no other row touches.
+  at::parallel_for(0, N * H, 1, [&](int64_t row_start, int64_t row_end) {
+    // (z, idx, qvalue) of the K closest points of the current pixel
+    PointBuffer q(K);
+    for (int64_t row = row_start; row < row_end; ++row)
     {
+      const int n = row / H;
+      const int yi = row % H;
       // TODO: for consistency with bin_points, here we use yi/xi for yf/xf.
       // Only reverse it when we write back
       const int by = yi / bin_size;
-      const float yf = PixToNdc(yi, S);
-      const int yidx = S - 1 - yi;
-
-      // Reverse the order of yi so that +Y is pointing upwards in the image.
-      // const int yidx = S - 1 - yi;
-      // const float yf = PixToNdc(yidx, S);
+      const float yf = PixToNdc(yi, H, W);
+      const int yidx = H - 1 - yi;
 
-      for (int xi = 0; xi < S; ++xi)
+      for (int xi = 0; xi < W; ++xi)
       {
         // TODO: for consistency with bin_points, here we use yi/xi for yf/xf.
         // Only reverse it when we write back
         const int bx = xi / bin_size;
-        const float xf = PixToNdc(xi, S);
-        const int xidx = S - 1 - xi;
+        const float xf = PixToNdc(xi, W, H);
+        const int xidx = W - 1 - xi;
 
-        // Reverse the order of xi so that +X is pointing to the left in the
-        // image.
-        // const int xidx = S - 1 - xi;
-        // const float xf = PixToNdc(xidx, S);
-
-        // Use a priority queue to hold (z, idx, qvalue)
-        std::priority_queue<std::tuple<float, int, float>> q;
         // loop over all points in this bin
-        for (int i = 0; i < M; ++i)
+        const int64_t bin = ((int64_t)n * BH + by) * BW + bx;
+        SplatPixel(
+            xf, yf, bin_points_a, bin_offsets_a[bin], bin_offsets_a[bin + 1],
+            points_a, ellipse_params_a, cutoff_a, radii_a, q);
+        // Now all the points have been seen, write the sorted buffer into the
+        // output tensors.
+        for (int i = 0; i < q.size; ++i)
         {
-          const int p = bin_points_a[n][by][bx][i];
-          if (p < 0)
-          {
-            // bin_points uses -1 as a sentinal value
-            break;
-          }
-          const float px = points_a[p][0];
-          const float py = points_a[p][1];
-          const float pz = points_a[p][2];
-          if (pz < 0)
-          {
-            continue;
-          }
-          const float dx = xf - px;
-          const float dy = yf - py;
-          const float radiix = radii_a[p][0];
-          const float radiiy = radii_a[p][1];
-          if (abs(dx) > radiix || abs(dy) > radiiy)
-            continue;
-          // The current point hit the current pixel
-          float qvalue_p = Qvalue(dx, dy, ellipse_params_a[p][0], ellipse_params_a[p][1], ellipse_params_a[p][2]);
-          if (qvalue_p > cutoff_a[p])
-            continue;
-          q.emplace(pz, p, qvalue_p);
-          // printf("dx dy = (%g, %g), radii = (%g, %g), qsize = %lu, queue top = (%g, %d, %g)\n", dx, dy, radiix, radiiy,
-          //        q.size(), std::get<0>(q.top()), std::get<1>(q.top()), std::get<2>(q.top()));
-          if ((int)q.size() > K)
-          {
-            q.pop();
-          }
-        }
-        // Now all the points have been seen, so pop elements off the queue
-        // one by one and write them into the output tensors.
-        while (!q.empty())
-        {
-          auto t = q.top();
-          q.pop();
-          int i = q.size();
-          zbuf_a[n][yidx][xidx][i] = std::get<0>(t);
-          point_idxs_a[n][yidx][xidx][i] = std::get<1>(t);
-          qvalue_a[n][yidx][xidx][i] = std::get<2>(t);
+          zbuf_a[n][yidx][xidx][i] = q.z[i];
+          point_idxs_a[n][yidx][xidx][i] = q.idx[i];
+          qvalue_a[n][yidx][xidx][i] = q.qvalue[i];
         }
         // traverse zbuf again to remove elements according to depth_merging_thres
-        if (point_idxs_a[n][yi][xi][0] >= 0 && zbuf_a[n][yi][xi][0] >= 0)
+        // NOTE: this must read the pixel that was just written, i.e. the mirrored
+        // (yidx, xidx), otherwise the result depends on the row visiting order.
+        if (point_idxs_a[n][yidx][xidx][0] >= 0 && zbuf_a[n][yidx][xidx][0] >= 0)
         {
           // set occupancy_map
-          occupancy_a[n][yi][xi] = 1.0f;
-          float closest_z = zbuf_a[n][yi][xi][0];
+          occupancy_a[n][yidx][xidx] = 1.0f;
+          float closest_z = zbuf_a[n][yidx][xidx][0];
           for (int i = 1; i < K; i++)
           {
-            if ((zbuf_a[n][yi][xi][i] - closest_z) > depth_merging_thres)
+            if ((zbuf_a[n][yidx][xidx][i] - closest_z) > depth_merging_thres)
             {
-              point_idxs_a[n][yi][xi][i] = -1;
-              zbuf_a[n][yi][xi][i] = -1;
-              qvalue_a[n][yi][xi][i] = -1;
+              point_idxs_a[n][yidx][xidx][i] = -1;
+              zbuf_a[n][yidx][xidx][i] = -1;
+              qvalue_a[n][yidx][xidx][i] = -1;
             }
           }
         }
       }
     }
-  }
+  });
   return std::make_tuple(point_idxs, zbuf, qvalue, occupancy);
 }
 
+// Fine rasterization over fixed size (N, B, B, M) bins padded with -1.
+std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizePointsFineCpu(
+    const torch::Tensor &points,         // (P, 3)
+    const torch::Tensor &ellipse_params, // (P, 3)
+    const torch::Tensor &cutoff_thres,   // (P,)
+    const torch::Tensor &radii,          // (P,2)
+    const torch::Tensor &bin_points,     // (N, BH, BW, M)
+    const float depth_merging_thres,
+    const std::tuple<int, int> image_size,
+    const int bin_size,
+    const int points_per_pixel)
+{
+  // bin_points uses -1 as a sentinal value, the valid points of each bin are
+  // stored first.
+  const torch::Tensor bin_mask = bin_points >= 0;
+  const torch::Tensor bin_counts = bin_mask.sum({3}).view({-1});
+  const torch::Tensor bin_offsets = torch::cat(
+      {torch::zeros({1}, torch::kInt64), bin_counts.cumsum(0).to(torch::kInt64)});
+  const torch::Tensor bin_points_csr = bin_points.masked_select(bin_mask).to(torch::kInt32);
+  return RasterizePointsFineCsrCpu(
+      points, ellipse_params, cutoff_thres, radii, bin_points_csr, bin_offsets,
+      depth_merging_thres, image_size, bin_size, points_per_pixel);
+}
+
+// Lower bound of the sum of the weights of a pixel used for normalization,
+// the same as NormWeightedCompositor of pytorch3d.
+static const float kWeightSumEpsilon = 1e-4f;
+
+// Minimum number of points handled by a task of the backward passes.
+static const int64_t kPointsGrainSize = 256;
+
+// Fine rasterization over the CSR bins of RasterizePointsCoarseCsrCpu fused
+// with weighted sum compositing, i.e. the (N, H, W, K) fragments are never
+// materialized. Each pixel composites the features of the points that survive
+// depth merging with the weights scaler * exp(-0.5 * qvalue), normalized by
+// their sum if normalize is true.
+std::tuple<torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor, torch::Tensor> RasterizeCompositePointsCsrCpu(
+    const torch::Tensor &points,         // (P, 3)
+    const torch::Tensor &ellipse_params, // (P, 3)
+    const torch::Tensor &cutoff_thres,   // (P,)
+    const torch::Tensor &radii,          // (P, 2)
+    const torch::Tensor &scaler,         // (P,)
+    const torch::Tensor &features,       // (P, C)
+    const torch::Tensor &bin_points,     // (T,)
+    const torch::Tensor &bin_offsets,    // (N * BH * BW + 1,)
+    const float depth_merging_thres,
+    const std::tuple<int, int> image_size,
+    const int bin_size,
+    const int points_per_pixel,
+    const bool normalize,
+    const bool return_weights)
+{
+  const int P = points.size(0);
+  const int C = features.size(1);
+  const int H = std::get<0>(image_size);
+  const int W = std::get<1>(image_size);
+  const int BH = 1 + (H - 1) / bin_size;
+  const int BW = 1 + (W - 1) / bin_size;
+  const int N = (bin_offsets.size(0) - 1) / (BH * BW); // batch_size.
+  const int K = points_per_pixel;
+
+  // Initialize output tensors.
+  auto int_opts = bin_points.options().dtype(torch::kInt32);
+  auto float_opts = points.options().dtype(torch::kFloat32);
+  torch::Tensor images = torch::zeros({N, H, W, C}, float_opts);
+  torch::Tensor occupancy = torch::zeros({N, H, W}, float_opts);
+  // the weights are only needed for the backward pass w.r.t. the features
+  torch::Tensor point_idxs = torch::full({return_weights ? N : 0, H, W, K}, -1, int_opts);
+  torch::Tensor weights = torch::zeros({return_weights ? N : 0, H, W, K}, float_opts);
+
+  auto points_a = points.accessor<float, 2>();
+  auto radii_a = radii.accessor<float, 2>();
+  auto ellipse_params_a = ellipse_params.accessor<float, 2>();
+  auto cutoff_a = cutoff_thres.accessor<float, 1>();
+  auto scaler_a = scaler.accessor<float, 1>();
+  auto features_a = features.accessor<float, 2>();
+  auto bin_points_a = bin_points.accessor<int32_t, 1>();
+  auto bin_offsets_a = bin_offsets.accessor<int64_t, 1>();
+
+  auto images_a = images.accessor<float, 4>();
+  auto occupancy_a = occupancy.accessor<float, 3>();
+  auto point_idxs_a = point_idxs.accessor<int32_t, 4>();
+  auto weights_a = weights.accessor<float, 4>();
+
+  // Pixels of different rows may hit the same point, the threads only ever
+  // store true in this shared buffer so their racing stores are harmless.
+  torch::Tensor visibility = torch::zeros({P}, points.options().dtype(torch::kBool));
+  auto visibility_a = visibility.accessor<bool, 1>();
+
+  at::parallel_for(0, N * H, 1, [&](int64_t row_start, int64_t row_end) {
+    // (z, idx, qvalue) of the K closest points of the current pixel
+    PointBuffer q(K);
+    // the composited points of the current pixel and their weights
+    std::vector<int> pix_idx(K);
+    std::vector<float> pix_w(K);
+    for (int64_t row = row_start; row < row_end; ++row)
+    {
+      const int n = row / H;
+      const int yi = row % H;
+      const int by = yi / bin_size;
+      const float yf = PixToNdc(yi, H, W);
+      const int yidx = H - 1 - yi;
+
+      for (int xi = 0; xi < W; ++xi)
+      {
+        const int bx = xi / bin_size;
+        const float xf = PixToNdc(xi, W, H);
+        const int xidx = W - 1 - xi;
+
+        const int64_t bin = ((int64_t)n * BH + by) * BW + bx;
+        SplatPixel(
+            xf, yf, bin_points_a, bin_offsets_a[bin], bin_offsets_a[bin + 1],
+            points_a, ellipse_params_a, cutoff_a, radii_a, q);
+        if (q.size == 0)
+          continue;
+        occupancy_a[n][yidx][xidx] = 1.0f;
+
+        // remove points according to depth_merging_thres and compute the weights
+        int num_pix = 0;
+        float w_sum = 0.0f;
+        for (int i = 0; i < q.size; ++i)
+        {
+          if ((q.z[i] - q.z[0]) > depth_merging_thres)
+            continue;
+          const int p = q.idx[i];
+          const float w = exp(-0.5f * q.qvalue[i]) * scaler_a[p];
+          pix_idx[num_pix] = p;
+          pix_w[num_pix] = w;
+          w_sum += w;
+          num_pix++;
+          visibility_a[p] = true;
+        }
+        if (normalize)
+        {
+          w_sum = std::max(w_sum, kWeightSumEpsilon);
+          for (int i = 0; i < num_pix; ++i)
+            pix_w[i] /= w_sum;
+        }
+
+        for (int c = 0; c < C; ++c)
+        {
+          float value = 0.0f;
+          for (int i = 0; i < num_pix; ++i)
+            value += pix_w[i] * features_a[pix_idx[i]][c];
+          images_a[n][yidx][xidx][c] = value;
+        }
+        if (return_weights)
+        {
+          for (int i = 0; i < num_pix; ++i)
+          {
+            point_idxs_a[n][yidx][xidx][i] = pix_idx[i];
+            weights_a[n][yidx][xidx][i] = pix_w[i];
+          }
+        }
+      }
+    }
+  });
+  return std::make_tuple(images, occupancy, visibility, point_idxs, weights);
+}
 
 /*
+Backward pass of RasterizeCompositePointsCsrCpu w.r.t. the features. The
+weights are treated as constants.
+Args:
+  grad_images: (N, H, W, C) upstream gradients of the composited images
+  idx: (N, H, W, K) the composited points of each pixel padded with -1
+  weights: (N, H, W, K) the (normalized) weights of the composited points
+  num_points: total number of points P
+Returns:
+  grad_features: (P, C)
+ */
+torch::Tensor RasterizeCompositePointsBackwardCpu(
+    const torch::Tensor &grad_images, // (N, H, W, C)
+    const torch::Tensor &idx,         // (N, H, W, K)
+    const torch::Tensor &weights,     // (N, H, W, K)
+    const int num_points)
+{
+  const int N = idx.size(0);
+  const int H = idx.size(1);
+  const int W = idx.size(2);
+  const int K = idx.size(3);
+  const int C = grad_images.size(3);
+
+  const torch::Tensor grad_images_c = grad_images.contiguous();
+  const torch::Tensor idx_c = idx.contiguous();
+  const torch::Tensor weights_c = weights.contiguous();
+  const float *grad_images_p = grad_images_c.data_ptr<float>();
+  const float *weights_p = weights_c.data_ptr<float>();
+
+  torch::Tensor grad_features = torch::zeros({num_points, C}, grad_images.options());
+  auto grad_features_a = grad_features.accessor<float, 2>();
+
+  // Pixels of different rows may composite the same point, so the (pixel, k)
+  // entries are grouped by point and every point sums its own gradient.
+  std::vector<int64_t> point_offsets, point_entries;
+  GroupEntriesByPoint(idx_c.data_ptr<int32_t>(), (int64_t)N * H * W * K, num_points, point_offsets, point_entries);
+
+  at::parallel_for(0, num_points, kPointsGrainSize, [&](int64_t start, int64_t end) {
+    for (int64_t p = start; p < end; ++p)
+    {
+      for (int64_t i = point_offsets[p]; i < point_offsets[p + 1]; ++i)
+      {
+        const int64_t e = point_entries[i];
+        const float w = weights_p[e];
+        const float *grad_pix = grad_images_p + (e / K) * C;
+        for (int c = 0; c < C; ++c)
+          grad_features_a[p][c] += w * grad_pix[c];
+      }
+    }
+  });
+  return grad_features;
+}
+
+// Linear indices (n * H + y) * W + x of the pixels of grad_occ (N, H, W) with
+// a non-zero gradient. Silhouette gradients are only non-zero along the mask
+// boundaries and in the mismatched regions, so the backward passes only visit
+// these pixels instead of the whole image.
+static torch::Tensor ActivePixels(const torch::Tensor &grad_occ)
+{
+  return torch::nonzero(grad_occ.reshape({-1})).view({-1});
+}
+
+// NDC centers (x, y) and occupancy gradients of the active pixels.
+static void ActivePixelsNdc(
+    const torch::Tensor &active_pixels, const torch::Tensor &grad_occ,
+    std::vector<float> &pix_x, std::vector<float> &pix_y, std::vector<float> &pix_grad)
+{
+  const int H = grad_occ.size(1);
+  const int W = grad_occ.size(2);
+  const int64_t num_active = active_pixels.size(0);
+  auto active_pixels_a = active_pixels.accessor<int64_t, 1>();
+  auto grad_occ_a = grad_occ.accessor<float, 3>();
+  pix_x.resize(num_active);
+  pix_y.resize(num_active);
+  pix_grad.resize(num_active);
+  for (int64_t a = 0; a < num_active; ++a)
+  {
+    const int64_t pix = active_pixels_a[a];
+    const int n = pix / (H * W);
+    const int yidx = (pix / W) % H;
+    const int xidx = pix % W;
+    // reverse because NDC assuming +y is up and +x is left
+    pix_y[a] = PixToNdc(H - 1 - yidx, H, W);
+    pix_x[a] = PixToNdc(W - 1 - xidx, W, H);
+    pix_grad[a] = grad_occ_a[n][yidx][xidx];
+  }
+}
+
+// Counting sort of the active pixels into num_cells cells in CSR layout: the
+// active pixels of cell i are
+//   cell_pixels[cell_offsets[i]:cell_offsets[i + 1]]
+// in increasing order, cell_of(a) being the cell of the a-th active pixel.
+// The points of the occlusion backward look up the active pixels around them
+// in these cells, so every point is only written by the task visiting it.
+template <typename CellOf>
+static void BucketActivePixels(
+    const int64_t num_active, const int64_t num_cells, const CellOf &cell_of,
+    std::vector<int64_t> &cell_offsets, std::vector<int64_t> &cell_pixels)
+{
+  std::vector<int64_t> cells(num_active);
+  cell_offsets.assign(num_cells + 1, 0);
+  for (int64_t a = 0; a < num_active; ++a)
+  {
+    cells[a] = cell_of(a);
+    cell_offsets[cells[a] + 1]++;
+  }
+  std::partial_sum(cell_offsets.begin(), cell_offsets.end(), cell_offsets.begin());
+  std::vector<int64_t> cell_fill(cell_offsets.begin(), cell_offsets.end() - 1);
+  cell_pixels.resize(num_active);
+  for (int64_t a = 0; a < num_active; ++a)
+    cell_pixels[cell_fill[cells[a]]++] = a;
+}
+
+/*
+Only the pixels with a non-zero occupancy gradient are visited. Every point
+sums the gradients of the active pixels of its image, so the points are
+split across the tasks and there is no per-thread copy of the gradients.
 Args:
   radii_s: a scaler for radii. only compute gradient if dx <= radii[0]*radii_s, dy <= radii[1]*radii_s
   Q < radii_s^2 * cutoff
@@ -386,74 +853,73 @@ torch::Tensor RasterizePointsOccBackwardCpu(
     const float radii_s,
     const float depth_merging_thres)
 {
-  const int N = grad_occ.size(0);
   const int P = points.size(0);
+  const int N = cloud_to_packed_first_idx.size(0);
   const int H = grad_occ.size(1);
   const int W = grad_occ.size(2);
+  // half extents of the renderable area in NDC
+  const float x_max = NonSquareNdcRange(W, H) / 2.0f;
+  const float y_max = NonSquareNdcRange(H, W) / 2.0f;
 
-  // For now only support square images.
-  // TODO(jcjohns): Extend to non-square images.
-  if (H != W)
-  {
-    AT_ERROR("RasterizePointsBackwardCpu only supports square images");
-  }
-  const int S = H;
-
+  // if occupancy_grad is 0, then we don't need to accomulate gradient for this pixel
   torch::Tensor grad_points = torch::zeros({P, 2}, points.options());
+  const torch::Tensor active_pixels = ActivePixels(grad_occ);
+  const int64_t num_active = active_pixels.size(0);
+  if (num_active == 0)
+    return grad_points;
+
+  const torch::Tensor first_idxs = cloud_to_packed_first_idx.to(torch::kInt64);
+  const torch::Tensor num_points = num_points_per_cloud.to(torch::kInt64);
 
   // inputs
   auto points_a = points.accessor<float, 2>();
-  auto grad_occ_a = grad_occ.accessor<float, 3>();
   auto radii_a = radii.accessor<float, 2>();
-  // outputs
+  auto first_idxs_a = first_idxs.accessor<int64_t, 1>();
+  auto num_points_a = num_points.accessor<int64_t, 1>();
   auto grad_points_a = grad_points.accessor<float, 2>();
 
+  std::vector<float> pix_x, pix_y, pix_grad;
+  ActivePixelsNdc(active_pixels, grad_occ, pix_x, pix_y, pix_grad);
+  // the active pixels are sorted by image
+  const int64_t *active_pixels_p = active_pixels.data_ptr<int64_t>();
+
   /*
   This is gradient from the weights to the point position
   */
   for (int n = 0; n < N; ++n)
   {
-    // Loop through each pointcloud in the batch.
+    // the active pixels of this image
+    const int64_t a_start = std::lower_bound(active_pixels_p, active_pixels_p + num_active, (int64_t)n * H * W) - active_pixels_p;
+    const int64_t a_end = std::lower_bound(active_pixels_p, active_pixels_p + num_active, (int64_t)(n + 1) * H * W) - active_pixels_p;
+    if (a_start == a_end)
+      continue;
+
     // Get the start index of the points in points_packed and the num points
     // in the point cloud.
-    const int point_start_idx =
-        cloud_to_packed_first_idx[n].item().to<int32_t>();
-    const int point_stop_idx =
-        (point_start_idx + num_points_per_cloud[n].item().to<int32_t>());
+    const int64_t point_start_idx = first_idxs_a[n];
+    const int64_t point_stop_idx = point_start_idx + num_points_a[n];
 
-    for (int yi = 0; yi < S; ++yi)
-    {
-      // Reverse the order of yi so that +Y is pointing upwards in the image.
-      const int yidx = S - 1 - yi;
-      const float yf = PixToNdc(yidx, S);
-
-      for (int xi = 0; xi < S; ++xi)
+    at::parallel_for(point_start_idx, point_stop_idx, kPointsGrainSize, [&](int64_t start, int64_t end) {
+      for (int64_t p = start; p < end; ++p)
       {
-        // Reverse the order of xi so that +X is pointing to the left in the
-        // image.
-        const int xidx = S - 1 - xi;
-        const float xf = PixToNdc(xidx, S);
-        // const float pixz = zbuf0_a[n][yi][xi];
-        const float grad_occ_pix = grad_occ_a[n][yi][xi];
+        const float px = points_a[p][0];
+        const float py = points_a[p][1];
+        const float pz = points_a[p][2];
 
-        // if occupancy_grad is 0, then we don't need to accomulate gradient for this pixel
-        if (grad_occ_pix == 0.0f)
+        if (pz < 0 || abs(py) > y_max || abs(px) > x_max)
           continue;
-        // still need to search all the points since we want to have larger gradient support
-        for (int p = point_start_idx; p < point_stop_idx; ++p)
-        {
-          const float px = points_a[p][0];
-          const float py = points_a[p][1];
-          const float pz = points_a[p][2];
 
-          if (pz < 0 || abs(py) > 1.0 || abs(px) > 1.0)
-            continue;
+        const float radiix = radii_a[p][0] * radii_s;
+        const float radiiy = radii_a[p][1] * radii_s;
 
-          const float dx = xf - px;
-          const float dy = yf - py;
-
-          const float radiix = radii_a[p][0] * radii_s;
-          const float radiiy = radii_a[p][1] * radii_s;
+        float grad_x = 0.0f;
+        float grad_y = 0.0f;
+        // still need to search all the pixels since we want to have larger gradient support
+        for (int64_t a = a_start; a < a_end; ++a)
+        {
+          const float dx = pix_x[a] - px;
+          const float dy = pix_y[a] - py;
+          const float grad_occ_pix = pix_grad[a];
 
           // if grad_occ_pix > 0, it means this pixel shouldn't be occupied, but it's where the splat should
           // be (moving away from this pixel doesn't improve loss), so set the gradient to zero
@@ -467,15 +933,306 @@ torch::Tensor RasterizePointsOccBackwardCpu(
           const float dist2 = dx * dx + dy * dy;
           const float denom = std::max(dist2, 1e-8f);
 
-          grad_points_a[p][0] += dx / denom * grad_occ_pix;
-          grad_points_a[p][1] += dy / denom * grad_occ_pix;
+          grad_x += dx / denom * grad_occ_pix;
+          grad_y += dy / denom * grad_occ_pix;
         }
+        grad_points_a[p][0] = grad_x;
+        grad_points_a[p][1] = grad_y;
       }
-    }
+    });
+  }
+  return grad_points;
+}
+
+/*
+CPU counterpart of RasterizePointsBackwardCudaFast. Only the pixels with a
+non-zero occupancy gradient are bucketed into the cells of a uniform 2D grid,
+so every (visible) point only visits the active pixels in the cells
+overlapping its search radius. The cost follows
+the silhouette error area instead of the image size, and since every point
+sums its own gradient there is no per-thread copy of the gradients.
+Args:
+  points_sorted: (P, 3) packed points, unlike the CUDA kernel they need not
+    be sorted by grid cell
+  radii_sorted: (P, 2) radii of the points
+  rs: (N,) search radius (in NDC) of each cloud
+  grad_occ: (N, H, W) gradients from occupancy loss
+  num_points_per_cloud: (N,)
+  cloud_to_packed_first_idx: (N,)
+  points_grid_off: (N, G) only its number of cells G is used, the values
+    may be uninitialized
+  grid_params: (N, GRID_2D_PARAMS_SIZE)
+Returns:
+  grad_points: (P, 2) gradients of the points in the order of points_sorted
+ */
+torch::Tensor RasterizePointsBackwardCpuFast(
+    const torch::Tensor &points_sorted,             // (P, 3)
+    const torch::Tensor &radii_sorted,              // (P, 2)
+    const torch::Tensor &rs,                        // (N,)
+    const torch::Tensor &grad_occ,                  // (N, H, W)
+    const torch::Tensor &num_points_per_cloud,      // (N,)
+    const torch::Tensor &cloud_to_packed_first_idx, // (N,)
+    const torch::Tensor &points_grid_off,           // (N, G)
+    const torch::Tensor &grid_params)               // (N, GRID_2D_PARAMS_SIZE)
+{
+  const int P = points_sorted.size(0);
+  const int N = cloud_to_packed_first_idx.size(0);
+  const int H = grad_occ.size(1);
+  const int W = grad_occ.size(2);
+  const int G = points_grid_off.size(1);
+  // half extents of the renderable area in NDC
+  const float x_max = NonSquareNdcRange(W, H) / 2.0f;
+  const float y_max = NonSquareNdcRange(H, W) / 2.0f;
+
+  torch::Tensor grad_points = torch::zeros({P, 2}, points_sorted.options());
+  const torch::Tensor active_pixels = ActivePixels(grad_occ);
+  const int64_t num_active = active_pixels.size(0);
+  if (num_active == 0)
+    return grad_points;
+
+  const torch::Tensor first_idxs = cloud_to_packed_first_idx.to(torch::kInt64);
+  const torch::Tensor num_points = num_points_per_cloud.to(torch::kInt64);
+
+  auto points_a = points_sorted.accessor<float, 2>();
+  auto radii_a = radii_sorted.accessor<float, 2>();
+  auto rs_a = rs.accessor<float, 1>();
+  auto first_idxs_a = first_idxs.accessor<int64_t, 1>();
+  auto num_points_a = num_points.accessor<int64_t, 1>();
+  auto grid_params_a = grid_params.accessor<float, 2>();
+  auto active_pixels_a = active_pixels.accessor<int64_t, 1>();
+  auto grad_points_a = grad_points.accessor<float, 2>();
+
+  std::vector<float> pix_x, pix_y, pix_grad;
+  ActivePixelsNdc(active_pixels, grad_occ, pix_x, pix_y, pix_grad);
+
+  // Bucket the active pixels of every cloud into its grid, the pixels outside
+  // the grid fall into the closest cell as the cell ranges of the points are
+  // clamped to the grid as well.
+  std::vector<int64_t> cell_offsets, cell_pixels;
+  BucketActivePixels(num_active, (int64_t)N * G, [&](const int64_t a) {
+    const int n = active_pixels_a[a] / (H * W);
+    const float grid_delta = grid_params_a[n][GRID_2D_DELTA];
+    const int grid_res_x = grid_params_a[n][GRID_2D_RES_X];
+    const int grid_res_y = grid_params_a[n][GRID_2D_RES_Y];
+    const int gc_x = std::min(std::max((int)floor((pix_x[a] - grid_params_a[n][GRID_2D_MIN_X]) * grid_delta), 0), grid_res_x - 1);
+    const int gc_y = std::min(std::max((int)floor((pix_y[a] - grid_params_a[n][GRID_2D_MIN_Y]) * grid_delta), 0), grid_res_y - 1);
+    return (int64_t)n * G + gc_x * grid_res_y + gc_y;
+  }, cell_offsets, cell_pixels);
+
+  for (int n = 0; n < N; ++n)
+  {
+    // no active pixel in this image
+    if (cell_offsets[(int64_t)n * G] == cell_offsets[(int64_t)(n + 1) * G])
+      continue;
+
+    const float cur_r = rs_a[n]; // search radius
+    const float cur_r2 = cur_r * cur_r;
+    const float grid_min_x = grid_params_a[n][GRID_2D_MIN_X];
+    const float grid_min_y = grid_params_a[n][GRID_2D_MIN_Y];
+    const float grid_delta = grid_params_a[n][GRID_2D_DELTA]; // 1/cell_size
+    const int grid_res_x = grid_params_a[n][GRID_2D_RES_X];
+    const int grid_res_y = grid_params_a[n][GRID_2D_RES_Y];
+
+    at::parallel_for(first_idxs_a[n], first_idxs_a[n] + num_points_a[n], kPointsGrainSize, [&](int64_t start, int64_t end) {
+      for (int64_t p = start; p < end; ++p)
+      {
+        const float px = points_a[p][0];
+        const float py = points_a[p][1];
+        const float pz = points_a[p][2];
+        // outside renderable area
+        if (pz < 0 || abs(py) > y_max || abs(px) > x_max)
+          continue;
+
+        const int min_gc_y = std::max((int)floor((py - grid_min_y - cur_r) * grid_delta), 0);
+        const int max_gc_y = std::min((int)floor((py - grid_min_y + cur_r) * grid_delta), grid_res_y - 1);
+        const int min_gc_x = std::max((int)floor((px - grid_min_x - cur_r) * grid_delta), 0);
+        const int max_gc_x = std::min((int)floor((px - grid_min_x + cur_r) * grid_delta), grid_res_x - 1);
+
+        float grad_x = 0.0f;
+        float grad_y = 0.0f;
+        // Search the relevant grid cells
+        for (int x = min_gc_x; x <= max_gc_x; ++x)
+        {
+          for (int y = min_gc_y; y <= max_gc_y; ++y)
+          {
+            const int64_t cell = (int64_t)n * G + x * grid_res_y + y;
+            // Loop over the active pixels of the cell, aggregate gradients
+            for (int64_t i = cell_offsets[cell]; i < cell_offsets[cell + 1]; ++i)
+            {
+              const int64_t a = cell_pixels[i];
+              const float dx = pix_x[a] - px;
+              const float dy = pix_y[a] - py;
+              const float dist2 = dx * dx + dy * dy;
+
+              // inside backpropagation radius?
+              if (dist2 > cur_r2)
+                continue;
+
+              // if grad_occ_pix > 0, it means that this pixel shouldn't be occluded
+              // but if it's outside the splat, it doesn't generate meaninigful information
+              // for in which direction the point should move.
+              const float grad_occ_pix = pix_grad[a];
+              const bool pix_outside_splat = (abs(dx) > radii_a[p][0]) || (abs(dy) > radii_a[p][1]);
+              if (grad_occ_pix > 0.0f && pix_outside_splat)
+                continue;
+
+              const float denom = std::max(dist2, 1e-10f);
+              grad_x += dx / denom * grad_occ_pix;
+              grad_y += dy / denom * grad_occ_pix;
+            }
+          }
+        }
+        grad_points_a[p][0] = grad_x;
+        grad_points_a[p][1] = grad_y;
+      }
+    });
   }
   return grad_points;
 }
 
+/*
+Same as RasterizePointsBackwardCpuFast, but the points are looked up in the
+CSR bins of the forward coarse rasterization instead of a dedicated grid.
+A point is listed in every bin overlapped by its splat, so it only
+contributes from the bin containing its center, which it is always listed
+in, to be counted once. The tasks are split by bins and every point visits
+the active pixels, bucketed by the same bins, within its search radius, so
+each point is written by the task of its center bin only.
+Args:
+  points: (P, 3) packed points
+  radii: (P, 2)
+  points_mask: (P,) only the points where it is true receive gradients
+  rs: (N,) search radius (in NDC) of each cloud
+  grad_occ: (N, H, W) gradients from occupancy loss
+  bin_points: (T,) packed point indices of the bins
+  bin_offsets: (N * BH * BW + 1,)
+  bin_size: bin size (in pixels) used by the coarse rasterization
+Returns:
+  grad_points: (P, 2)
+ */
+torch::Tensor RasterizePointsOccBackwardBinnedCpu(
+    const torch::Tensor &points,      // (P, 3)
+    const torch::Tensor &radii,       // (P, 2)
+    const torch::Tensor &points_mask, // (P,)
+    const torch::Tensor &rs,          // (N,)
+    const torch::Tensor &grad_occ,    // (N, H, W)
+    const torch::Tensor &bin_points,  // (T,)
+    const torch::Tensor &bin_offsets, // (N * BH * BW + 1,)
+    const int bin_size)
+{
+  const int P = points.size(0);
+  const int H = grad_occ.size(1);
+  const int W = grad_occ.size(2);
+  const int BH = 1 + (H - 1) / bin_size;
+  const int BW = 1 + (W - 1) / bin_size;
+  const int64_t num_bins = bin_offsets.size(0) - 1;
+  // half extents of the renderable area in NDC
+  const float x_max = NonSquareNdcRange(W, H) / 2.0f;
+  const float y_max = NonSquareNdcRange(H, W) / 2.0f;
+
+  std::vector<float> bin_min_x, bin_max_x, bin_min_y, bin_max_y;
+  BinEdges(W, H, bin_size, bin_min_x, bin_max_x);
+  BinEdges(H, W, bin_size, bin_min_y, bin_max_y);
+
+  torch::Tensor grad_points = torch::zeros({P, 2}, points.options());
+  const torch::Tensor active_pixels = ActivePixels(grad_occ);
+  const int64_t num_active = active_pixels.size(0);
+  if (num_active == 0)
+    return grad_points;
+
+  const torch::Tensor mask = points_mask.to(torch::kBool);
+  auto points_a = points.accessor<float, 2>();
+  auto radii_a = radii.accessor<float, 2>();
+  auto mask_a = mask.accessor<bool, 1>();
+  auto rs_a = rs.accessor<float, 1>();
+  auto bin_points_a = bin_points.accessor<int32_t, 1>();
+  auto bin_offsets_a = bin_offsets.accessor<int64_t, 1>();
+  auto active_pixels_a = active_pixels.accessor<int64_t, 1>();
+  auto grad_points_a = grad_points.accessor<float, 2>();
+
+  std::vector<float> pix_x, pix_y, pix_grad;
+  ActivePixelsNdc(active_pixels, grad_occ, pix_x, pix_y, pix_grad);
+
+  // Bucket the active pixels into the bins of the forward pass
+  std::vector<int64_t> bin_pix_offsets, bin_pixels;
+  BucketActivePixels(num_active, num_bins, [&](const int64_t a) {
+    const int64_t pix = active_pixels_a[a];
+    const int n = pix / (H * W);
+    const int by = (H - 1 - (pix / W) % H) / bin_size;
+    const int bx = (W - 1 - pix % W) / bin_size;
+    return ((int64_t)n * BH + by) * BW + bx;
+  }, bin_pix_offsets, bin_pixels);
+
+  at::parallel_for(0, num_bins, 1, [&](int64_t bin_start, int64_t bin_end) {
+    for (int64_t bin = bin_start; bin < bin_end; ++bin)
+    {
+      const int n = bin / (BH * BW);
+      const int by = (bin / BW) % BH;
+      const int bx = bin % BW;
+      const float cur_r = rs_a[n]; // search radius
+      const float cur_r2 = cur_r * cur_r;
+
+      for (int64_t i = bin_offsets_a[bin]; i < bin_offsets_a[bin + 1]; ++i)
+      {
+        const int p = bin_points_a[i];
+        if (!mask_a[p])
+          continue;
+        const float px = points_a[p][0];
+        const float py = points_a[p][1];
+        const float pz = points_a[p][2];
+        // outside renderable area
+        if (pz < 0 || abs(py) > y_max || abs(px) > x_max)
+          continue;
+        // only count the point in the bin of its center
+        if (std::upper_bound(bin_min_x.begin(), bin_min_x.end(), px) - bin_min_x.begin() - 1 != bx ||
+            std::upper_bound(bin_min_y.begin(), bin_min_y.end(), py) - bin_min_y.begin() - 1 != by)
+          continue;
+
+        int by0, by1, bx0, bx1;
+        if (!BinRange(bin_min_y, bin_max_y, py - cur_r, py + cur_r, by0, by1) ||
+            !BinRange(bin_min_x, bin_max_x, px - cur_r, px + cur_r, bx0, bx1))
+          continue;
+
+        float grad_x = 0.0f;
+        float grad_y = 0.0f;
+        for (int pby = by0; pby <= by1; ++pby)
+        {
+          for (int pbx = bx0; pbx <= bx1; ++pbx)
+          {
+            const int64_t pix_bin = ((int64_t)n * BH + pby) * BW + pbx;
+            for (int64_t j = bin_pix_offsets[pix_bin]; j < bin_pix_offsets[pix_bin + 1]; ++j)
+            {
+              const int64_t a = bin_pixels[j];
+              const float dx = pix_x[a] - px;
+              const float dy = pix_y[a] - py;
+              const float dist2 = dx * dx + dy * dy;
+
+              // inside backpropagation radius?
+              if (dist2 > cur_r2)
+                continue;
+
+              // if grad_occ_pix > 0, it means that this pixel shouldn't be occluded
+              // but if it's outside the splat, it doesn't generate meaninigful information
+              // for in which direction the point should move.
+              const float grad_occ_pix = pix_grad[a];
+              const bool pix_outside_splat = (abs(dx) > radii_a[p][0]) || (abs(dy) > radii_a[p][1]);
+              if (grad_occ_pix > 0.0f && pix_outside_splat)
+                continue;
+
+              const float denom = std::max(dist2, 1e-10f);
+              grad_x += dx / denom * grad_occ_pix;
+              grad_y += dy / denom * grad_occ_pix;
+            }
+          }
+        }
+        grad_points_a[p][0] = grad_x;
+        grad_points_a[p][1] = grad_y;
+      }
+    }
+  });
+  return grad_points;
+}
+
 void RasterizeZbufBackwardCpu(const at::Tensor &idx, const at::Tensor &grad_zbuf,
                            at::Tensor &point_z_grad)
 {
@@ -21,20 +21,24 @@
 //    features: FloatTensor of shape (C, P) which gives the features
 //            of each point where C is the size of the feature and
 //            P the number of points.
-//    alphas: FloatTensor of shape (N, points_per_pixel, W, W) where
+//    alphas: FloatTensor of shape (N, points_per_pixel, H, W) where
 //            points_per_pixel is the number of points in the z-buffer
-//            sorted in z-order, and W is the image size.
-//    points_idx: IntTensor of shape (N, points_per_pixel, W, W) giving the
+//            sorted in z-order, and (H, W) is the image size.
+//    points_idx: IntTensor of shape (N, points_per_pixel, H, W) giving the
 //            indices of the nearest points at each pixel, sorted in z-order.
 // Returns:
-//    weighted_fs: FloatTensor of shape (N, C, W, W) giving the accumulated
+//    weighted_fs: FloatTensor of shape (N, C, H, W) giving the accumulated
 //            feature in each point. Concretely, it gives:
-//                 weighted_fs[b,c,i,j] = sum_k alphas[b,k,i,j] *
-//                   features[c,points_idx[b,k,i,j]]
+//                 weighted_fs[b,c,y,x] = sum_k alphas[b,k,y,x] *
+//                   features[c,points_idx[b,k,y,x]]
 
 
 
 
+// Lower bound of the sum of the weights of a pixel used for normalization,
+// the same as NormWeightedCompositor of pytorch3d.
+__constant__ const float kWeightSumEpsilon = 1e-4;
+
 __global__ void weightedSumCudaForwardKernel(
     // clang-format off
     at::PackedTensorAccessor64<float, 4, at::RestrictPtrTraits> result,
@@ -43,7 +47,8 @@ __global__ void weightedSumCudaForwardKernel(
     const at::PackedTensorAccessor64<float, 4, at::RestrictPtrTraits> alphas,
     // const at::PackedTensorAccessor64<float, 1, at::RestrictPtrTraits> scalars,
     // const at::PackedTensorAccessor64<float, 4, at::RestrictPtrTraits> qvalue_map,
-    const at::PackedTensorAccessor64<int64_t, 4, at::RestrictPtrTraits> points_idx) {
+    const at::PackedTensorAccessor64<int64_t, 4, at::RestrictPtrTraits> points_idx,
+    const bool normalize) {
   // clang-format on
   const int64_t batch_size = result.size(0);
   const int64_t C = features.size(0);
@@ -60,25 +65,37 @@ __global__ void weightedSumCudaForwardKernel(
   // Parallelize over each feature in each pixel in images of size H * W,
   // for each image in the batch of size batch_size
   for (int pid = tid; pid < num_pixels; pid += num_threads) {
-    int ch = pid / (W * H);
-    int j = (pid % (W * H)) / H;
-    int i = (pid % (W * H)) % H;
+    int ch = pid / (H * W);
+    int y = (pid % (H * W)) / W;
+    int x = pid % W;
+
+    float cum_alpha = 1.0f;
+    if (normalize) {
+      cum_alpha = 0.0f;
+      for (int k = 0; k < points_idx.size(1); ++k) {
+        if (points_idx[batch][k][y][x] < 0) {
+          continue;
+        }
+        cum_alpha += alphas[batch][k][y][x];
+      }
+      cum_alpha = max(cum_alpha, kWeightSumEpsilon);
+    }
 
-    // Iterate through the closest K points for this pixel
+    // Iterate through the closest K points for this pixel, every pixel and
+    // feature is handled by exactly one thread
+    float value = 0.0f;
     for (int k = 0; k < points_idx.size(1); ++k) {
-      int n_idx = points_idx[batch][k][j][i];
+      int n_idx = points_idx[batch][k][y][x];
       // Sentinel value is -1 indicating no point overlaps the pixel
       if (n_idx < 0) {
         continue;
       }
 
       // Accumulate the values
-      float alpha = alphas[batch][k][j][i];
-      // TODO(gkioxari) It might be more efficient to have threads write in a
-      // local variable, and move atomicAdd outside of the loop such that
-      // atomicAdd is executed once per thread.
-      atomicAdd(&result[batch][ch][j][i], features[ch][n_idx] * alpha);
+      float alpha = alphas[batch][k][y][x];
+      value += features[ch][n_idx] * alpha;
     }
+    result[batch][ch][y][x] = value / cum_alpha;
   }
 }
 
@@ -91,7 +108,10 @@ __global__ void weightedSumCudaBackwardKernel(
     const at::PackedTensorAccessor64<float, 4, at::RestrictPtrTraits> grad_outputs,
     const at::PackedTensorAccessor64<float, 2, at::RestrictPtrTraits> features,
     const at::PackedTensorAccessor64<float, 4, at::RestrictPtrTraits> alphas,
-    const at::PackedTensorAccessor64<int64_t, 4, at::RestrictPtrTraits> points_idx) {
+    const at::PackedTensorAccessor64<int64_t, 4, at::RestrictPtrTraits> points_idx,
+    const bool normalize,
+    const bool compute_grad_features,
+    const bool compute_grad_alphas) {
   // clang-format on
   const int64_t batch_size = points_idx.size(0);
   const int64_t C = features.size(0);
@@ -108,27 +128,55 @@ __global__ void weightedSumCudaBackwardKernel(
   // Iterate over each pixel to compute the contribution to the
   // gradient for the features and weights
   for (int pid = tid; pid < num_pixels; pid += num_threads) {
-    int ch = pid / (W * H);
-    int j = (pid % (W * H)) / H;
-    int i = (pid % (W * H)) % H;
+    int ch = pid / (H * W);
+    int y = (pid % (H * W)) / W;
+    int x = pid % W;
+
+    // the sum of the weights and the normalized output of this pixel, the
+    // sum of the weights is a constant if it is clamped
+    float cum_alpha = 1.0f;
+    float out = 0.0f;
+    if (normalize) {
+      cum_alpha = 0.0f;
+      for (int k = 0; k < points_idx.size(1); ++k) {
+        int n_idx = points_idx[batch][k][y][x];
+        if (n_idx < 0) {
+          continue;
+        }
+        cum_alpha += alphas[batch][k][y][x];
+        if (compute_grad_alphas) {
+          out += alphas[batch][k][y][x] * features[ch][n_idx];
+        }
+      }
+      if (cum_alpha < kWeightSumEpsilon) {
+        cum_alpha = kWeightSumEpsilon;
+        out = 0.0f;
+      } else {
+        out /= cum_alpha;
+      }
+    }
 
     // Iterate through the closest K points for this pixel
     for (int k = 0; k < points_idx.size(1); ++k) {
-      int n_idx = points_idx[batch][k][j][i];
+      int n_idx = points_idx[batch][k][y][x];
       // Sentinel value is -1 indicating no point overlaps the pixel
       if (n_idx < 0) {
         continue;
       }
-      float alpha = alphas[batch][k][j][i];
+      float alpha = alphas[batch][k][y][x];
 
       // TODO(gkioxari) It might be more efficient to have threads write in a
       // local variable, and move atomicAdd outside of the loop such that
       // atomicAdd is executed once per thread.
-      atomicAdd(
-          &grad_alphas[batch][k][j][i],
-          features[ch][n_idx] * grad_outputs[batch][ch][j][i]);
-      atomicAdd(
-          &grad_features[ch][n_idx], alpha * grad_outputs[batch][ch][j][i]);
+      if (compute_grad_alphas) {
+        atomicAdd(
+            &grad_alphas[batch][k][y][x],
+            (features[ch][n_idx] - out) / cum_alpha * grad_outputs[batch][ch][y][x]);
+      }
+      if (compute_grad_features) {
+        atomicAdd(
+            &grad_features[ch][n_idx], alpha / cum_alpha * grad_outputs[batch][ch][y][x]);
+      }
     }
   }
 }
@@ -136,7 +184,8 @@ __global__ void weightedSumCudaBackwardKernel(
 at::Tensor weightedSumCudaForward(
     const at::Tensor& features,
     const at::Tensor& alphas,
-    const at::Tensor& points_idx) {
+    const at::Tensor& points_idx,
+    const bool normalize) {
   // Check inputs are on the same device
   at::TensorArg features_t{features, "features", 1},
       alphas_t{alphas, "alphas", 2}, points_idx_t{points_idx, "points_idx", 3};
@@ -172,7 +221,8 @@ at::Tensor weightedSumCudaForward(
       result.packed_accessor64<float, 4, at::RestrictPtrTraits>(),
       features.packed_accessor64<float, 2, at::RestrictPtrTraits>(),
       alphas.packed_accessor64<float, 4, at::RestrictPtrTraits>(),
-      points_idx.packed_accessor64<int64_t, 4, at::RestrictPtrTraits>());
+      points_idx.packed_accessor64<int64_t, 4, at::RestrictPtrTraits>(),
+      normalize);
   // clang-format on
   AT_CUDA_CHECK(cudaGetLastError());
   return result;
@@ -182,7 +232,10 @@ std::tuple<at::Tensor, at::Tensor> weightedSumCudaBackward(
     const at::Tensor& grad_outputs,
     const at::Tensor& features,
     const at::Tensor& alphas,
-    const at::Tensor& points_idx) {
+    const at::Tensor& points_idx,
+    const bool normalize,
+    const bool compute_grad_features,
+    const bool compute_grad_alphas) {
   // Check inputs are on the same device
   at::TensorArg grad_outputs_t{grad_outputs, "grad_outputs", 1},
       features_t{features, "features", 2}, alphas_t{alphas, "alphas", 3},
@@ -195,16 +248,21 @@ std::tuple<at::Tensor, at::Tensor> weightedSumCudaBackward(
   at::cuda::CUDAGuard device_guard(features.device());
   cudaStream_t stream = at::cuda::getCurrentCUDAStream();
 
-  auto grad_features = at::zeros_like(features);
-  auto grad_alphas = at::zeros_like(alphas);
+  const int64_t bs = points_idx.size(0);
+
+  // the gradients which are not needed are empty
+  auto grad_features = at::zeros(
+      {features.size(0), compute_grad_features ? features.size(1) : 0},
+      features.options());
+  auto grad_alphas = at::zeros(
+      {compute_grad_alphas ? bs : 0, alphas.size(1), alphas.size(2), alphas.size(3)},
+      alphas.options());
 
-  if (grad_features.numel() == 0 || grad_alphas.numel() == 0) {
+  if (grad_features.numel() == 0 && grad_alphas.numel() == 0) {
     AT_CUDA_CHECK(cudaGetLastError());
     return std::make_tuple(grad_features, grad_alphas);
   }
 
-  const int64_t bs = points_idx.size(0);
-
   const dim3 threadsPerBlock(64);
   const dim3 numBlocks(bs, 1024 / bs + 1);
 
@@ -219,7 +277,10 @@ std::tuple<at::Tensor, at::Tensor> weightedSumCudaBackward(
       grad_outputs.packed_accessor64<float, 4, at::RestrictPtrTraits>(),
       features.packed_accessor64<float, 2, at::RestrictPtrTraits>(),
       alphas.packed_accessor64<float, 4, at::RestrictPtrTraits>(),
-      points_idx.packed_accessor64<int64_t, 4, at::RestrictPtrTraits>());
+      points_idx.packed_accessor64<int64_t, 4, at::RestrictPtrTraits>(),
+      normalize,
+      compute_grad_features,
+      compute_grad_alphas);
   // clang-format on
   AT_CUDA_CHECK(cudaGetLastError());
   return std::make_tuple(grad_features, grad_alphas);
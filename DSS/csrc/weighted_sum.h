@@ -1,57 +1,93 @@
 // Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
-
+#pragma once
 #include <torch/extension.h>
-#include "utils/pytorch3d_cutils.h"
 
+#include <tuple>
 #include <vector>
 
+#ifndef CHECK_CUDA
+#define CHECK_CUDA(x) TORCH_CHECK(x.is_cuda(), #x "must be a CUDA tensor.")
+#endif
+
 // Perform weighted sum compositing of points in a z-buffer.
 //
 // Inputs:
 //    features: FloatTensor of shape (C, P) which gives the features
 //            of each point where C is the size of the feature and
 //            P the number of points.
-//    alphas: FloatTensor of shape (N, points_per_pixel, W, W) where
+//    alphas: FloatTensor of shape (N, points_per_pixel, H, W) where
 //            points_per_pixel is the number of points in the z-buffer
-//            sorted in z-order, and W is the image size.
-//    points_idx: IntTensor of shape (N, points_per_pixel, W, W) giving the
+//            sorted in z-order, and (H, W) is the image size.
+//    points_idx: LongTensor of shape (N, points_per_pixel, H, W) giving the
 //            indices of the nearest points at each pixel, sorted in z-order.
+//    normalize: divide by the sum of the alphas of each pixel, clamped to
+//            1e-4, as NormWeightedCompositor of pytorch3d.
 // Returns:
-//    weighted_fs: FloatTensor of shape (N, C, W, W) giving the accumulated
+//    weighted_fs: FloatTensor of shape (N, C, H, W) giving the accumulated
 //            feature in each point. Concretely, it gives:
-//                 weighted_fs[b,c,i,j] = sum_k alphas[b,k,i,j] *
-//                   features[c,points_idx[b,k,i,j]]
+//                 weighted_fs[b,c,y,x] = sum_k alphas[b,k,y,x] *
+//                   features[c,points_idx[b,k,y,x]]
+//            divided by sum_k alphas[b,k,y,x] if normalize is true.
+//
+// The backward functions return the gradients w.r.t. the features (C, P) and
+// the alphas (N, points_per_pixel, H, W). Only the gradients selected by
+// compute_grad_features and compute_grad_alphas are computed, the others are
+// empty, i.e. (C, 0) and (0, points_per_pixel, H, W).
 
 // CUDA declarations
 #ifdef WITH_CUDA
 torch::Tensor weightedSumCudaForward(
     const torch::Tensor& features,
     const torch::Tensor& alphas,
-    const torch::Tensor& points_idx);
+    const torch::Tensor& points_idx,
+    const bool normalize);
 
 std::tuple<torch::Tensor, torch::Tensor> weightedSumCudaBackward(
     const torch::Tensor& grad_outputs,
     const torch::Tensor& features,
     const torch::Tensor& alphas,
-    const torch::Tensor& points_idx);
+    const torch::Tensor& points_idx,
+    const bool normalize,
+    const bool compute_grad_features,
+    const bool compute_grad_alphas);
 #endif
 
 // C++ declarations
 torch::Tensor weightedSumCpuForward(
     const torch::Tensor& features,
     const torch::Tensor& alphas,
-    const torch::Tensor& points_idx);
+    const torch::Tensor& points_idx,
+    const bool normalize);
 
 std::tuple<torch::Tensor, torch::Tensor> weightedSumCpuBackward(
     const torch::Tensor& grad_outputs,
     const torch::Tensor& features,
     const torch::Tensor& alphas,
-    const torch::Tensor& points_idx);
+    const torch::Tensor& points_idx,
+    const bool normalize,
+    const bool compute_grad_features,
+    const bool compute_grad_alphas);
+
+// The kernels index the (N, K, H, W) z-buffers and the (N, C, H, W) images by
+// (y, x), so all the (H, W) layouts must agree, including non-square images.
+inline void CheckWeightedSumShapes(
+    const torch::Tensor& features,
+    const torch::Tensor& alphas,
+    const torch::Tensor& points_idx) {
+  TORCH_CHECK(features.dim() == 2, "features must be of shape (C, P)");
+  TORCH_CHECK(
+      points_idx.dim() == 4, "points_idx must be of shape (N, K, H, W)");
+  TORCH_CHECK(
+      alphas.sizes() == points_idx.sizes(),
+      "alphas and points_idx must be of the same shape (N, K, H, W)");
+}
 
 torch::Tensor weightedSumForward(
     torch::Tensor& features,
     torch::Tensor& alphas,
-    torch::Tensor& points_idx) {
+    torch::Tensor& points_idx,
+    const bool normalize) {
+  CheckWeightedSumShapes(features, alphas, points_idx);
   features = features.contiguous();
   alphas = alphas.contiguous();
   points_idx = points_idx.contiguous();
@@ -61,12 +97,12 @@ torch::Tensor weightedSumForward(
     CHECK_CUDA(features);
     CHECK_CUDA(alphas);
     CHECK_CUDA(points_idx);
-    return weightedSumCudaForward(features, alphas, points_idx);
+    return weightedSumCudaForward(features, alphas, points_idx, normalize);
 #else
     AT_ERROR("Not compiled with GPU support");
 #endif
   } else {
-    return weightedSumCpuForward(features, alphas, points_idx);
+    return weightedSumCpuForward(features, alphas, points_idx, normalize);
   }
 }
 
@@ -74,7 +110,17 @@ std::tuple<torch::Tensor, torch::Tensor> weightedSumBackward(
     torch::Tensor& grad_outputs,
     torch::Tensor& features,
     torch::Tensor& alphas,
-    torch::Tensor& points_idx) {
+    torch::Tensor& points_idx,
+    const bool normalize,
+    const bool compute_grad_features,
+    const bool compute_grad_alphas) {
+  CheckWeightedSumShapes(features, alphas, points_idx);
+  TORCH_CHECK(
+      grad_outputs.dim() == 4 && grad_outputs.size(0) == points_idx.size(0) &&
+          grad_outputs.size(1) == features.size(0) &&
+          grad_outputs.size(2) == points_idx.size(2) &&
+          grad_outputs.size(3) == points_idx.size(3),
+      "grad_outputs must be of shape (N, C, H, W)");
   grad_outputs = grad_outputs.contiguous();
   features = features.contiguous();
   alphas = alphas.contiguous();
@@ -87,11 +133,15 @@ std::tuple<torch::Tensor, torch::Tensor> weightedSumBackward(
     CHECK_CUDA(alphas);
     CHECK_CUDA(points_idx);
 
-    return weightedSumCudaBackward(grad_outputs, features, alphas, points_idx);
+    return weightedSumCudaBackward(
+        grad_outputs, features, alphas, points_idx, normalize,
+        compute_grad_features, compute_grad_alphas);
 #else
     AT_ERROR("Not compiled with GPU support");
 #endif
   } else {
-    return weightedSumCpuBackward(grad_outputs, features, alphas, points_idx);
+    return weightedSumCpuBackward(
+        grad_outputs, features, alphas, points_idx, normalize,
+        compute_grad_features, compute_grad_alphas);
   }
 }
@@ -0,0 +1,189 @@
+#include <torch/extension.h>
+#include <ATen/Parallel.h>
+#include <algorithm>
+#include <tuple>
+#include <vector>
+#include "cpu_utils.h"
+
+// Lower bound of the sum of the weights of a pixel used for normalization,
+// the same as NormWeightedCompositor of pytorch3d.
+static const float kWeightSumEpsilon = 1e-4f;
+
+// Minimum number of points handled by a task of the backward pass.
+static const int64_t kPointsGrainSize = 256;
+
+// Sum of the weights of the points of pixel (n, y, x).
+static float WeightSum(
+    const torch::TensorAccessor<float, 4> &alphas_a,
+    const torch::TensorAccessor<int64_t, 4> &points_idx_a,
+    const int n,
+    const int y,
+    const int x)
+{
+  float cum_alpha = 0.0f;
+  for (int k = 0; k < points_idx_a.size(1); ++k)
+  {
+    // Sentinel value is -1 indicating no point overlaps the pixel
+    if (points_idx_a[n][k][y][x] < 0)
+      continue;
+    cum_alpha += alphas_a[n][k][y][x];
+  }
+  return cum_alpha;
+}
+
+torch::Tensor weightedSumCpuForward(
+    const torch::Tensor &features,   // (C, P)
+    const torch::Tensor &alphas,     // (N, K, H, W)
+    const torch::Tensor &points_idx, // (N, K, H, W)
+    const bool normalize)
+{
+  const int N = points_idx.size(0);
+  const int K = points_idx.size(1);
+  const int H = points_idx.size(2);
+  const int W = points_idx.size(3);
+  const int C = features.size(0);
+
+  torch::Tensor result = torch::zeros({N, C, H, W}, features.options());
+
+  auto features_a = features.accessor<float, 2>();
+  auto alphas_a = alphas.accessor<float, 4>();
+  auto points_idx_a = points_idx.accessor<int64_t, 4>();
+  auto result_a = result.accessor<float, 4>();
+
+  // every pixel is written by exactly one row
+  at::parallel_for(0, N * H, 1, [&](int64_t row_start, int64_t row_end) {
+    for (int64_t row = row_start; row < row_end; ++row)
+    {
+      const int n = row / H;
+      const int y = row % H;
+      for (int x = 0; x < W; ++x)
+      {
+        const float cum_alpha = normalize ? std::max(WeightSum(alphas_a, points_idx_a, n, y, x), kWeightSumEpsilon) : 1.0f;
+        for (int c = 0; c < C; ++c)
+        {
+          float value = 0.0f;
+          for (int k = 0; k < K; ++k)
+          {
+            const int64_t p = points_idx_a[n][k][y][x];
+            if (p < 0)
+              continue;
+            value += alphas_a[n][k][y][x] * features_a[c][p];
+          }
+          result_a[n][c][y][x] = value / cum_alpha;
+        }
+      }
+    }
+  });
+  return result;
+}
+
+std::tuple<torch::Tensor, torch::Tensor> weightedSumCpuBackward(
+    const torch::Tensor &grad_outputs, // (N, C, H, W)
+    const torch::Tensor &features,     // (C, P)
+    const torch::Tensor &alphas,       // (N, K, H, W)
+    const torch::Tensor &points_idx,   // (N, K, H, W)
+    const bool normalize,
+    const bool compute_grad_features,
+    const bool compute_grad_alphas)
+{
+  const int N = points_idx.size(0);
+  const int K = points_idx.size(1);
+  const int H = points_idx.size(2);
+  const int W = points_idx.size(3);
+  const int C = features.size(0);
+  const int P = features.size(1);
+
+  // the gradients which are not needed are empty
+  torch::Tensor grad_alphas = torch::zeros({compute_grad_alphas ? N : 0, K, H, W}, alphas.options());
+  torch::Tensor grad_features = torch::zeros({C, compute_grad_features ? P : 0}, features.options());
+  // the (clamped) sum of the weights of every pixel, 1 if not normalized
+  std::vector<float> cum_alphas((int64_t)N * H * W, 1.0f);
+
+  auto grad_outputs_a = grad_outputs.accessor<float, 4>();
+  auto features_a = features.accessor<float, 2>();
+  auto alphas_a = alphas.accessor<float, 4>();
+  auto points_idx_a = points_idx.accessor<int64_t, 4>();
+  auto grad_alphas_a = grad_alphas.accessor<float, 4>();
+  auto grad_features_a = grad_features.accessor<float, 2>();
+
+  // gradients w.r.t. the alphas and the sums of the weights, every pixel is
+  // written by exactly one row
+  if (compute_grad_alphas || (compute_grad_features && normalize))
+  {
+    at::parallel_for(0, N * H, 1, [&](int64_t row_start, int64_t row_end) {
+      for (int64_t row = row_start; row < row_end; ++row)
+      {
+        const int n = row / H;
+        const int y = row % H;
+        for (int x = 0; x < W; ++x)
+        {
+          float cum_alpha = 1.0f;
+          // the sum of the weights is a constant if it is clamped
+          bool normalized = false;
+          if (normalize)
+          {
+            cum_alpha = WeightSum(alphas_a, points_idx_a, n, y, x);
+            normalized = cum_alpha >= kWeightSumEpsilon;
+            cum_alpha = std::max(cum_alpha, kWeightSumEpsilon);
+          }
+          cum_alphas[row * W + x] = cum_alpha;
+          if (!compute_grad_alphas)
+            continue;
+          for (int c = 0; c < C; ++c)
+          {
+            const float grad_out = grad_outputs_a[n][c][y][x];
+            if (grad_out == 0.0f)
+              continue;
+            // the normalized output of this pixel and channel
+            float out = 0.0f;
+            if (normalized)
+            {
+              for (int k = 0; k < K; ++k)
+              {
+                const int64_t p = points_idx_a[n][k][y][x];
+                if (p < 0)
+                  continue;
+                out += alphas_a[n][k][y][x] * features_a[c][p];
+              }
+              out /= cum_alpha;
+            }
+            for (int k = 0; k < K; ++k)
+            {
+              const int64_t p = points_idx_a[n][k][y][x];
+              if (p < 0)
+                continue;
+              grad_alphas_a[n][k][y][x] += (features_a[c][p] - out) / cum_alpha * grad_out;
+            }
+          }
+        }
+      }
+    });
+  }
+  if (!compute_grad_features)
+    return std::make_tuple(grad_features, grad_alphas);
+
+  // Pixels of different rows may composite the same point, so the
+  // (n, k, y, x) entries are grouped by point and every point sums its own
+  // gradient.
+  std::vector<int64_t> point_offsets, point_entries;
+  GroupEntriesByPoint(points_idx.data_ptr<int64_t>(), points_idx.numel(), P, point_offsets, point_entries);
+  const float *alphas_p = alphas.data_ptr<float>();
+  const float *grad_outputs_p = grad_outputs.data_ptr<float>();
+  const int64_t HW = (int64_t)H * W;
+
+  at::parallel_for(0, P, kPointsGrainSize, [&](int64_t start, int64_t end) {
+    for (int64_t p = start; p < end; ++p)
+    {
+      for (int64_t i = point_offsets[p]; i < point_offsets[p + 1]; ++i)
+      {
+        const int64_t e = point_entries[i];
+        const int64_t n = e / (K * HW);
+        const int64_t pix = e % HW;
+        const float alpha = alphas_p[e] / cum_alphas[n * HW + pix];
+        for (int c = 0; c < C; ++c)
+          grad_features_a[c][p] += alpha * grad_outputs_p[(n * C + c) * HW + pix];
+      }
+    }
+  });
+  return std::make_tuple(grad_features, grad_alphas);
+}
@@ -6,10 +6,12 @@ Hui Huang, Dan Li, Hao Zhang, Uri Ascher Daniel Cohen-Or
 [3] Differentiable Surface Splatting for Point-based Geometry Processing
 Wang Yifan, Felice Serena, Shihao Wu, Cengiz Oeztireli, Olga Sorkine-Hornung
 """
-from typing import Optional
+from typing import NamedTuple, Optional
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.autograd as autograd
+from torch.utils.checkpoint import checkpoint
 from pytorch3d import ops
 from pytorch3d.ops import padded_to_packed
 from pytorch3d.ops.knn import _KNN as KNN
@@ -17,6 +19,7 @@ from DSS.core.cloud import PointClouds3D
 from DSS.utils.mathHelper import eps_denom, estimate_pointcloud_normals
 from DSS import get_debugging_mode, get_debugging_tensor
 from DSS import get_logger
+from DSS import _C
 
 logger_py = get_logger(__name__)
 
@@ -145,55 +148,226 @@ class L2Loss(BaseLoss):
             lossImg = lossImg[mask]
         return lossImg
 
+class SurfaceNeighborhood(NamedTuple):
+    """
+    Local neighborhood of the points shared by the surface losses, so that it
+    is computed once per training step.
+    Attributes:
+        knn_tree (KNN): idx, dists (N, maxP, K-1) and knn (N, maxP, K-1, 3) of
+            the neighbors excluding the query point itself
+        knn_mask (N, maxP, K-1): valid knn results
+        phi (N, maxP, K-1): spatial weights [1] Eq.(12)
+        normals (N, maxP, 3): normals after robust normal mollification [1] Sec 4.4
+        knn_normals (N, maxP, K-1, 3): mollified normals of the neighbors,
+            None if built by a loss evaluated in chunks (knn_tree.knn as well)
+    """
+    knn_tree: KNN
+    knn_mask: torch.Tensor
+    phi: torch.Tensor
+    normals: torch.Tensor
+    knn_normals: Optional[torch.Tensor]
+
+
 class SurfaceLoss(BaseLoss):
-    def __init__(self, reduction='mean', knn_k: int = 33, filter_scale: float = 1.0, sharpness_sigma: float = 0.75):
+    """
+    Attributes:
+        knn_k (int): number of neighbors including the point itself
+        knn_skin (int): number of extra nearest neighbors kept as candidates
+            (Verlet list), the knn are then searched among the candidates until
+            the points have moved farther than the margin between the
+            candidates and the knn. 0 searches all points at every rebuild.
+        chunk_size (int): evaluate the loss in blocks of chunk_size points,
+            the (N, chunk_size, K, 3) tensors of a block are recomputed in the
+            backward pass instead of being stored, so that the peak memory
+            is bounded for large point clouds. 0 evaluates all points at once.
+    """
+    def __init__(self, reduction='mean', knn_k: int = 33, filter_scale: float = 1.0, sharpness_sigma: float = 0.75,
+                 knn_skin: int = 0, chunk_size: int = 0):
         super().__init__(reduction=reduction, channel_dim=None)
         self.knn_tree = None
         self.knn_k = knn_k
+        self.knn_skin = knn_skin
+        self.chunk_size = chunk_size
         self.knn_mask = None
         self.filter_scale = filter_scale
         self.sharpness_sigma = sharpness_sigma
+        # Verlet list: candidates (N, maxP, knn_k + knn_skin), the points
+        # and their lengths at the time of the search and the margin
+        # (N, maxP) between the knn_k-th and the farthest candidate
+        self._knn_candidates = None
+        self._knn_points = None
+        self._knn_lengths = None
+        self._knn_margin = None
+
+    def _chunks(self, P):
+        """ (start, end) of the blocks of points """
+        if self.chunk_size <= 0:
+            return [(0, P)]
+        return [(start, min(start + self.chunk_size, P)) for start in range(0, P, self.chunk_size)]
+
+    def _evaluate_in_chunks(self, func, points):
+        """
+        Concatenate func(points[:, start:end], start, end) -> (N, end-start, ...)
+        over the blocks of points. Each block is checkpointed if points
+        requires grad, i.e. recomputed block by block in the backward pass.
+        """
+        chunks = self._chunks(points.shape[1])
+        if len(chunks) == 1:
+            return func(points, 0, points.shape[1])
+        outputs = []
+        for start, end in chunks:
+            def func_chunk(points_chunk, start=start, end=end):
+                return func(points_chunk, start, end)
+            if points.requires_grad and torch.is_grad_enabled():
+                outputs.append(checkpoint(func_chunk, points[:, start:end]))
+            else:
+                outputs.append(func_chunk(points[:, start:end]))
+        return torch.cat(outputs, dim=1)
+
+    def _get_visibility(self, point_clouds, points_filter):
+        """
+        (N, maxP) visibility of the points of each cloud. A single cloud seen
+        from V > 1 views is visible where any of its views sees it, as in
+        _denoise_normals.
+        """
+        visibility = points_filter.visibility
+        if len(point_clouds) != visibility.shape[0]:
+            if len(point_clouds) == 1 and visibility.shape[0] > 1:
+                return visibility.any(dim=0, keepdim=True)
+            raise ValueError("Incompatible point clouds {} and visibility {}".format(
+                len(point_clouds), visibility.shape))
+        return visibility
+
+    def _gather_neighbors(self, x, gathered, idx, start, end, lengths):
+        """
+        x (N, maxP, D) of the neighbors idx (N, maxP, K) of the points
+        [start, end), sliced from the gathered (N, maxP, K, D) tensor if available
+        """
+        if gathered is not None:
+            return gathered[:, start:end]
+        return ops.knn_gather(x, idx[:, start:end], lengths)
 
     def _build_knn(self, point_clouds):
         """
-        search for KNN again set knn_tree and knn_mask attributes
-        TODO(yifan): use a real Kd_tree library to be able to store the data tree and
-        query at each forward pass?
+        search for KNN again set knn_tree and knn_mask attributes,
+        with knn_skin > 0 the knn_k + knn_skin nearest neighbors are saved as
+        candidates for the following _update_knn
         """
         # Find local neighborhood to compute weights
         with torch.autograd.enable_grad():
             points_padded = point_clouds.points_padded()
 
         lengths = point_clouds.num_points_per_cloud()
+        num_candidates = self.knn_k + self.knn_skin
         knn_result = ops.knn_points(
-            points_padded, points_padded, lengths, lengths, K=self.knn_k, return_nn=True)
-        self.knn_mask = torch.full(
-            knn_result.idx.shape, False, dtype=torch.bool, device=points_padded.device)
-        # valid knn result
-        for b in range(self.knn_mask.shape[0]):
-            self.knn_mask[b, :lengths[b], :min(
-                self.knn_k, lengths[b].item())] = True
-            assert(torch.all(knn_result.dists[b][~self.knn_mask[b]] == 0))
+            points_padded, points_padded, lengths, lengths, K=num_candidates,
+            return_nn=self.knn_skin == 0 and self.chunk_size <= 0)
+        if self.knn_skin > 0:
+            self._knn_candidates = knn_result.idx
+            self._knn_points = points_padded.detach().clone()
+            self._knn_lengths = lengths.clone()
+            dists = knn_result.dists.sqrt()
+            self._knn_margin = dists[..., -1] - dists[..., self.knn_k - 1]
+            # a point never misses a neighbor if all points are candidates
+            P = points_padded.shape[1]
+            no_margin = (lengths <= num_candidates).view(-1, 1) | \
+                (torch.arange(P, device=lengths.device).view(1, -1) >= lengths.view(-1, 1))
+            self._knn_margin.masked_fill_(no_margin, float('inf'))
+            knn_result = self._select_knn(points_padded, lengths)
+        self._set_knn(knn_result, lengths)
+
+    def _select_knn(self, points_padded, lengths):
+        """
+        knn_k nearest neighbors among the candidates of the Verlet list
+        at the current point positions
+        Returns:
+            KNN (dists, idx, knn) with zeros for the invalid results, same as
+            ops.knn_points, knn is None if evaluated in chunks
+        """
+        N, P, C = self._knn_candidates.shape
+        all_dists, all_idx, all_knn = [], [], []
+        for start, end in self._chunks(P):
+            candidates = self._knn_candidates[:, start:end]
+            candidate_points = ops.knn_gather(points_padded, candidates, lengths)
+            dists = torch.sum((candidate_points - points_padded[:, start:end, None, :])**2, dim=-1)
+            valid = (torch.arange(C, device=lengths.device).view(1, 1, C) < lengths.view(-1, 1, 1)) & \
+                (torch.arange(start, end, device=lengths.device).view(1, -1, 1) < lengths.view(-1, 1, 1))
+            dists = dists.masked_fill(~valid, float('inf'))
+            dists, order = torch.topk(dists, self.knn_k, dim=-1, largest=False, sorted=True)
+            invalid = torch.isinf(dists)
+            all_dists.append(dists.masked_fill(invalid, 0))
+            all_idx.append(torch.gather(candidates, -1, order).masked_fill(invalid, 0))
+            if self.chunk_size <= 0:
+                knn = torch.gather(candidate_points, 2, order.unsqueeze(-1).expand(-1, -1, -1, 3))
+                all_knn.append(knn.masked_fill(invalid.unsqueeze(-1), 0))
+        return KNN(dists=torch.cat(all_dists, dim=1), idx=torch.cat(all_idx, dim=1),
+                   knn=torch.cat(all_knn, dim=1) if len(all_knn) > 0 else None)
+
+    def _is_knn_stale(self, points_padded, lengths):
+        """
+        The knn among the candidates are exact as long as for every point
+        2 * (its displacement + the largest displacement in its cloud) is
+        smaller than its margin, since any distance changed at most by the sum
+        of the displacements of the two points.
+        """
+        if self.knn_skin == 0 or self._knn_candidates is None or \
+                self._knn_points.shape != points_padded.shape or \
+                not torch.equal(self._knn_lengths, lengths):
+            return True
+        displacement = torch.norm(points_padded.detach() - self._knn_points, dim=-1)
+        max_displacement = displacement.max(dim=-1, keepdim=True)[0]
+        return bool(torch.any(2 * (displacement + max_displacement) > self._knn_margin))
+
+    def _update_knn(self, point_clouds):
+        """
+        Update the knn_tree and knn_mask attributes for the current points,
+        reuse the Verlet list if possible, otherwise search again.
+        """
+        with torch.autograd.enable_grad():
+            points_padded = point_clouds.points_padded()
+        lengths = point_clouds.num_points_per_cloud()
+        if self._is_knn_stale(points_padded, lengths):
+            self._build_knn(point_clouds)
+        else:
+            self._set_knn(self._select_knn(points_padded, lengths), lengths)
+
+    def _set_knn(self, knn_result, lengths):
+        """
+        set knn_tree and knn_mask attributes from the knn_k nearest neighbors
+        including the point itself
+        """
+        # valid knn result, the first min(knn_k, length) neighbors of the points of a cloud
+        N, P, K = knn_result.idx.shape
+        lengths = lengths.view(N, 1, 1)
+        self.knn_mask = (torch.arange(P, device=lengths.device).view(1, P, 1) < lengths) & \
+            (torch.arange(K, device=lengths.device).view(1, 1, K) < lengths)
+        if get_debugging_mode():
+            assert(torch.all(knn_result.dists[~self.knn_mask] == 0))
+        knn = knn_result.knn[:, :, 1:, :] if knn_result.knn is not None else None
         self.knn_tree = KNN(
-            knn=knn_result.knn[:, :, 1:, :], dists=knn_result.dists[:, :, 1:], idx=knn_result.idx[:, :, 1:])
+            knn=knn, dists=knn_result.dists[:, :, 1:], idx=knn_result.idx[:, :, 1:])
         self.knn_mask = self.knn_mask[:, :, 1:]
         assert(self.knn_mask.shape == self.knn_tree.dists.shape)
 
-    def _denoise_normals(self, point_clouds, weights, point_clouds_filter=None, inplace=False):
+    def _denoise_normals(self, point_clouds, weights, point_clouds_filter=None):
         """
         robust normal mollification (Sec 4.4), i.e. replace normals with a weighted average
         from neighboring normals
         do this only for invisible points (?)
         Args:
             weights (tensors): (N,max_P,K)
+        Returns:
+            denoised normals (N,max_P,3)
         """
         lengths = point_clouds.num_points_per_cloud()
-        P_total = lengths.sum().item()
         normals = point_clouds.normals_padded()
 
-        knn_normals = ops.knn_gather(normals, self.knn_tree.idx, lengths)
-        normals_denoised = torch.sum(knn_normals * weights[:, :, :, None], dim=-2) / \
-            eps_denom(torch.sum(weights, dim=-1, keepdim=True))
+        def denoise(normals_chunk, start, end):
+            knn_normals = self._gather_neighbors(normals, None, self.knn_tree.idx, start, end, lengths)
+            weights_chunk = weights[:, start:end]
+            return torch.sum(knn_normals * weights_chunk[:, :, :, None], dim=-2) / \
+                eps_denom(torch.sum(weights_chunk, dim=-1, keepdim=True))
+        normals_denoised = self._evaluate_in_chunks(denoise, normals)
 
         # get point visibility so that we update only the non-visible or out-of-mask normals
         if point_clouds_filter is not None:
@@ -213,19 +387,53 @@ class SurfaceLoss(BaseLoss):
             except KeyError as e:
                 pass
 
-        normals_denoised_packed = ops.padded_to_packed(
-            normals_denoised, point_clouds.cloud_to_packed_first_idx(), P_total)
-        point_clouds = point_clouds.clone()
-        point_clouds.update_normals_(normals_denoised_packed)
-        return point_clouds
+        return normals_denoised
+
+    def build_neighborhood(self, point_clouds, points_filter=None, rebuild_knn=True, **kwargs):
+        """
+        Update the neighbors (unless the current knn_tree can be reused),
+        compute the spatial weights phi and denoise the normals.
+        Returns:
+            SurfaceNeighborhood, which can be passed to the surface losses
+            computed on the same point clouds
+        """
+        with torch.autograd.no_grad():
+            points = point_clouds.points_padded()
+            if rebuild_knn or self.knn_tree is None or self.knn_tree.idx.shape[:2] != points.shape[:2]:
+                self._update_knn(point_clouds)
 
-    def get_normal_w(self, point_clouds: PointClouds3D, normals: Optional[torch.Tensor] = None, **kwargs):
+            phi = self.get_phi(point_clouds, **kwargs)
+            normals = self._denoise_normals(point_clouds, phi, points_filter)
+            knn_normals = None
+            if self.chunk_size <= 0:
+                knn_normals = ops.knn_gather(
+                    normals, self.knn_tree.idx, point_clouds.num_points_per_cloud())
+        return SurfaceNeighborhood(self.knn_tree, self.knn_mask, phi, normals, knn_normals)
+
+    def _get_neighborhood(self, point_clouds, points_filter=None, rebuild_knn=False,
+                          neighborhood=None, **kwargs):
+        """
+        Use the given neighborhood if it was built with the same number of
+        neighbors for these point clouds, otherwise build it.
+        """
+        if neighborhood is not None and \
+                neighborhood.knn_tree.idx.shape == point_clouds.points_padded().shape[:2] + (self.knn_k - 1,):
+            self.knn_tree = neighborhood.knn_tree
+            self.knn_mask = neighborhood.knn_mask
+            return neighborhood
+        return self.build_neighborhood(
+            point_clouds, points_filter=points_filter, rebuild_knn=rebuild_knn, **kwargs)
+
+    def get_normal_w(self, point_clouds: PointClouds3D, normals: Optional[torch.Tensor] = None,
+                     knn_normals: Optional[torch.Tensor] = None, **kwargs):
         """
         Weights exp(-\|n-ni\|^2/sharpness_sigma^2), for i in a local neighborhood
         Args:
             point_clouds: whose normals will be used for ni
             normals (tensor): (N, maxP, 3) padded normals as n, if not provided, use
                 the normals from point_clouds
+            knn_normals (tensor): (N, maxP, K, 3) normals of the neighbors as ni,
+                if not provided, gather them from normals
         Returns:
             weight per point per neighbor (N,maxP,K)
         """
@@ -236,7 +444,8 @@ class SurfaceLoss(BaseLoss):
 
         if normals is None:
             normals = point_clouds.normals_padded()
-        knn_normals = ops.knn_gather(normals, self.knn_tree.idx, lengths)
+        if knn_normals is None:
+            knn_normals = ops.knn_gather(normals, self.knn_tree.idx, lengths)
         normals = torch.nn.functional.normalize(normals, dim=-1)
         knn_normals = torch.nn.functional.normalize(knn_normals, dim=-1)
         normal_diff = knn_normals - normals[:, :, None, :]
@@ -244,17 +453,35 @@ class SurfaceLoss(BaseLoss):
         weight = torch.exp(-torch.sum(normal_diff * normal_diff, dim=-1) * inv_sigma_normal)
         return weight
 
-    def get_spatial_w(self, point_clouds: PointClouds3D, points: Optional[torch.Tensor] = None, **kwargs):
+    def get_inv_sigma_spatial(self, point_clouds: PointClouds3D):
         """
-        Weights exp(\|p-pi\|^2/sigma^2)
+        1/sigma^2 of get_spatial_w, the number of points over the squared
+        bounding box diagonal of each cloud (N,)
         """
         bbox = point_clouds.get_bounding_boxes()
         diag2 = torch.sum((bbox[..., 1] - bbox[..., 0])**2, dim=-1)
-        inv_sigma_spatial = point_clouds.num_points_per_cloud().float() / diag2
+        return point_clouds.num_points_per_cloud().float() / diag2
+
+    def get_spatial_w(self, point_clouds: PointClouds3D, points: Optional[torch.Tensor] = None,
+                      knn: Optional[torch.Tensor] = None,
+                      inv_sigma_spatial: Optional[torch.Tensor] = None, **kwargs):
+        """
+        Weights exp(\|p-pi\|^2/sigma^2)
+        Args:
+            points (tensor): (N, maxP, 3) padded points as p, if not provided,
+                use the points from point_clouds
+            knn (tensor): (N, maxP, K, 3) neighbors as pi, knn_tree.knn if not provided
+            inv_sigma_spatial (tensor): (N,) get_inv_sigma_spatial(point_clouds)
+                if not provided
+        """
+        if inv_sigma_spatial is None:
+            inv_sigma_spatial = self.get_inv_sigma_spatial(point_clouds)
         self.filter_scale = kwargs.get('filter_scale', self.filter_scale)
         if points is None:
             points = point_clouds.points_padded()
-        deltap = self.knn_tree.knn - points[:, :, None, :]
+        if knn is None:
+            knn = self.knn_tree.knn
+        deltap = knn - points[:, :, None, :]
         w = torch.exp(-torch.sum(deltap * deltap, dim=-1) * inv_sigma_spatial * self.filter_scale)
         return w
 
@@ -276,6 +503,44 @@ class SurfaceLoss(BaseLoss):
         return w
 
 
+class _ProjectionLossPoints(autograd.Function):
+    """
+    Fused projection loss [1] of the packed points, computing the weights and
+    the distances to the neighbors' tangent planes per point in one native op.
+    Differentiable w.r.t. the points as query points, the neighbors, normals
+    and weights are constants as in ProjectionLoss.
+    """
+    @staticmethod
+    def forward(ctx, points, normals, knn_idx, phi, visibility, sharpness_sigma: float,
+                invisible_weight: float = 0.1):
+        """
+        Args:
+            points (P, 3): packed points
+            normals (P, 3): packed mollified normals
+            knn_idx (P, K): packed indices of the neighbors, -1 if invalid
+            phi (P, K): spatial weights of the neighbors
+            visibility (P,): bool visibility of the points
+            sharpness_sigma: sigma of the normal weights
+            invisible_weight: weight of the invisible (and invalid) neighbors
+        Returns:
+            loss (P,)
+        """
+        loss = _C._projection_loss(points, normals, knn_idx, phi, visibility,
+                                   sharpness_sigma, invisible_weight)
+        ctx.sharpness_sigma = sharpness_sigma
+        ctx.invisible_weight = invisible_weight
+        ctx.save_for_backward(points, normals, knn_idx, phi, visibility)
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        points, normals, knn_idx, phi, visibility = ctx.saved_tensors
+        grad_points = _C._projection_loss_backward(
+            grad_loss.contiguous(), points, normals, knn_idx, phi, visibility,
+            ctx.sharpness_sigma, ctx.invisible_weight)
+        return grad_points, None, None, None, None, None, None
+
+
 # NOTE(yifan): Essentially an operation that updates point positions from normals.
 # Can we formulate this as a pointflow (neural ODE)?
 # i.e. we predict normals and integrate with neural ODE? TODO(yifan): think more!
@@ -287,7 +552,12 @@ class ProjectionLoss(SurfaceLoss):
     Attributes:
         filter_scale: variance of the low pass filter (default: 2)
         sharpness_sigma: [0.5 (sharp), 2 (smooth)]
+        fused (bool): compute the weights and the weighted distances with one
+            native op on the packed points instead of the (N, maxP, K) tensors
     """
+    def __init__(self, *args, fused: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fused = fused
 
     def get_spatial_w(self, point_clouds, **kwargs):
         """
@@ -297,12 +567,15 @@ class ProjectionLoss(SurfaceLoss):
         w = torch.ones_like(self.knn_tree.dists)
         return w
 
-    def compute(self, point_clouds: PointClouds3D, points_filter=None, rebuild_knn=False, **kwargs):
+    def compute(self, point_clouds: PointClouds3D, points_filter=None, rebuild_knn=False,
+                neighborhood: Optional[SurfaceNeighborhood] = None, **kwargs):
         """
         Args:
             point_clouds
             (optional) knn_tree: output from ops.knn_points excluding the query point itself
             (optional) knn_mask: mask valid knn results
+            (optional) neighborhood: SurfaceNeighborhood of point_clouds shared
+                with the other surface losses
         Returns:
             (P, N)
         """
@@ -321,29 +594,36 @@ class ProjectionLoss(SurfaceLoss):
         # - mask out values outside ballneighbor i.e. d > filterSpatialScale * localPointSpacing
         # - projected distance dot(ni, x-xi)
         # - multiply and normalize the weights
-        with torch.autograd.no_grad():
-            if rebuild_knn or self.knn_tree is None or self.knn_tree.idx.shape[:2] != points.shape[:2]:
-                self._build_knn(point_clouds)
-
-            phi = self.get_phi(point_clouds, **kwargs)
-
-            # robust normal mollification (Sec 4.4), i.e. replace normals with a weighted average
-            # from neighboring normals Eq.(11)
-            point_clouds = self._denoise_normals(
-                point_clouds, phi, points_filter, inplace=False)
-
-            # compute wn and wr
-            normal_w = self.get_normal_w(point_clouds, **kwargs)
-            # visibility weight
-            visibility_nb = ops.knn_gather(points_filter.visibility.unsqueeze(-1), self.knn_tree.idx, lengths)
-            visibility_w = visibility_nb.float()
-            visibility_w[~visibility_nb] = 0.1
-            # compose weights
-            weights = phi * normal_w * visibility_w.squeeze(-1)
+        # robust normal mollification (Sec 4.4), i.e. replace normals with a weighted average
+        # from neighboring normals Eq.(11)
+        neighborhood = self._get_neighborhood(
+            point_clouds, points_filter, rebuild_knn, neighborhood, **kwargs)
+        # the blocks may be recomputed in the backward pass, keep this neighborhood
+        knn_tree = self.knn_tree
+        points_detached = points.detach()
+        visibility = self._get_visibility(point_clouds, points_filter).unsqueeze(-1)
+
+        def chunk_loss(points_chunk, start, end):
+            with torch.autograd.no_grad():
+                knn = self._gather_neighbors(points_detached, knn_tree.knn, knn_tree.idx, start, end, lengths)
+                knn_normals = self._gather_neighbors(
+                    neighborhood.normals, neighborhood.knn_normals, knn_tree.idx, start, end, lengths)
+                # compute wn and wr
+                normal_w = self.get_normal_w(point_clouds, normals=neighborhood.normals[:, start:end],
+                                             knn_normals=knn_normals, **kwargs)
+                # visibility weight
+                visibility_nb = self._gather_neighbors(visibility, None, knn_tree.idx, start, end, lengths)
+                visibility_w = visibility_nb.float()
+                visibility_w[~visibility_nb] = 0.1
+                # compose weights
+                weights = neighborhood.phi[:, start:end] * normal_w * visibility_w.squeeze(-1)
 
             # (B, P, k), dot product distance to surface
-            knn_normals = ops.knn_gather(
-                point_clouds.normals_padded(), self.knn_tree.idx, lengths)
+            sdf = torch.sum((knn - points_chunk.unsqueeze(-2)) * knn_normals, dim=-1)
+            distance_to_face = sdf*sdf
+            # compute weighted signed distance to surface
+            return torch.sum(
+                weights * distance_to_face, dim=-1) / eps_denom(torch.sum(weights, dim=-1))
 
         if get_debugging_mode():
             # points.requires_grad_(True)
@@ -369,26 +649,42 @@ class ProjectionLoss(SurfaceLoss):
                 handle = points.register_hook(save_grad())
                 self.hooks.append(handle)
 
-        sdf = torch.sum(
-            (self.knn_tree.knn.detach() - points.unsqueeze(-2)) * knn_normals, dim=-1)
+        if self.fused:
+            return self._fused_loss(point_clouds, points, neighborhood, points_filter)
+
+        # (N, maxP), evaluated in blocks of points if chunk_size > 0
+        loss = self._evaluate_in_chunks(chunk_loss, points)
 
-        # convert everything to packed
-        weights = ops.padded_to_packed(
-            weights, point_clouds.cloud_to_packed_first_idx(), P_total)
-        sdf = ops.padded_to_packed(
-            sdf, point_clouds.cloud_to_packed_first_idx(), P_total)
+        # convert to packed
+        loss = ops.padded_to_packed(
+            loss, point_clouds.cloud_to_packed_first_idx(), P_total)
+        return loss
 
-        # if get_debugging_mode():
-        #     # save to dbg folder as normal
-        #     from ..utils.io import save_ply
-        #     save_ply('./dbg_repel_diff.ply', point_clouds.points_packed().cpu().detach(), normals=repel_vec.cpu().detach())
+    def _fused_loss(self, point_clouds, points, neighborhood, points_filter):
+        """
+        The loss of compute with the native op on the packed neighborhood
+        Returns:
+            (P,)
+        """
+        N, maxP = points.shape[:2]
+        first_idx = point_clouds.cloud_to_packed_first_idx()
+        padded_to_packed_idx = point_clouds.padded_to_packed_idx()
 
-        distance_to_face = sdf*sdf
-        # compute weighted signed distance to surface
-        loss = torch.sum(
-            weights * distance_to_face, dim=-1) / eps_denom(torch.sum(weights, dim=-1))
+        def to_packed(x):
+            return x.reshape(N * maxP, *x.shape[2:])[padded_to_packed_idx]
 
-        return loss
+        with torch.autograd.no_grad():
+            knn_idx = self.knn_tree.idx + first_idx.view(-1, 1, 1)
+            knn_idx = knn_idx.masked_fill(~self.knn_mask, -1)
+            knn_idx = to_packed(knn_idx)
+            phi = to_packed(neighborhood.phi)
+            normals = to_packed(neighborhood.normals)
+            visibility = to_packed(self._get_visibility(point_clouds, points_filter))
+
+        # padded to packed is differentiable, the gradient reaches the padded points
+        return _ProjectionLossPoints.apply(
+            to_packed(points).contiguous(), normals.contiguous(), knn_idx.contiguous(),
+            phi.contiguous(), visibility.contiguous(), float(self.sharpness_sigma))
 
 
 class RepulsionLoss(SurfaceLoss):
@@ -410,7 +706,8 @@ class RepulsionLoss(SurfaceLoss):
                           * inv_sigma_spatial), dim=-1)
         return w
 
-    def compute(self, point_clouds: PointClouds3D, points_filter=None, rebuild_knn=True, **kwargs):
+    def compute(self, point_clouds: PointClouds3D, points_filter=None, rebuild_knn=True,
+                neighborhood: Optional[SurfaceNeighborhood] = None, **kwargs):
 
         self.knn_tree = kwargs.get('knn_tree', self.knn_tree)
         self.knn_mask = kwargs.get('knn_mask', self.knn_mask)
@@ -422,24 +719,43 @@ class RepulsionLoss(SurfaceLoss):
         if not points_padded.requires_grad:
             logger_py.warn('Computing repulsion loss, but points_padded is not differentiable.')
 
-        # Compute necessary weights to project points to local plane
-        # TODO(yifan): This part is same as ProjectionLoss
-        # how can we at best save repetitive computation
+        # Compute necessary weights to project points to local plane,
+        # the neighborhood is shared with ProjectionLoss if given
+        neighborhood = self._get_neighborhood(
+            point_clouds, points_filter, rebuild_knn, neighborhood, **kwargs)
+        knn_tree = self.knn_tree
+        points_detached = points_padded.detach()
+        # O(P) reduction over the whole clouds, computed once instead of in
+        # every block and again when the blocks are recomputed
         with torch.autograd.no_grad():
-            if rebuild_knn or self.knn_tree is None or points_padded.shape[:2] != self.knn_tree.shape[:2]:
-                self._build_knn(point_clouds)
-            phi = self.get_phi(point_clouds, **kwargs)
-            point_clouds = self._denoise_normals(
-                    point_clouds, phi, points_filter, inplace=False)
+            inv_sigma_spatial = self.get_inv_sigma_spatial(point_clouds)
 
-        # project the point to a local surface
-        knn_diff = points_padded.unsqueeze(-2) - self.knn_tree.knn.detach()
+        def chunk_loss(points_chunk, start, end):
+            with torch.autograd.no_grad():
+                knn = self._gather_neighbors(points_detached, knn_tree.knn, knn_tree.idx, start, end, lengths)
+                knn_normals = self._gather_neighbors(
+                    neighborhood.normals, neighborhood.knn_normals, knn_tree.idx, start, end, lengths)
 
-        knn_normals = ops.knn_gather(
-            point_clouds.normals_padded(), self.knn_tree.idx, lengths)
-        pts_diff_proj = knn_diff - \
+            # project the point to a local surface
+            knn_diff = points_chunk.unsqueeze(-2) - knn
+            pts_diff_proj = knn_diff - \
                 (knn_diff * knn_normals).sum(dim=-1, keepdim=True) * knn_normals
 
+            with torch.autograd.no_grad():
+                spatial_w = self.get_spatial_w(point_clouds, points=points_chunk, knn=knn,
+                                               inv_sigma_spatial=inv_sigma_spatial, **kwargs)
+                # set far neighbors' spatial_w to 0
+                normal_w = self.get_normal_w(point_clouds, normals=neighborhood.normals[:, start:end],
+                                             knn_normals=knn_normals, **kwargs)
+                density_w = torch.sum(spatial_w, dim=-1, keepdim=True) + 1.0
+                weights = spatial_w * normal_w
+
+            # we want to maximize this, so negative sign
+            repel_vec = torch.sum(
+                pts_diff_proj * weights.unsqueeze(-1), dim=2) / eps_denom(torch.sum(weights, dim=2).unsqueeze(-1))
+            repel_vec = repel_vec * density_w
+            return torch.exp(-repel_vec.abs())
+
         if get_debugging_mode():
             # points_padded.requires_grad_(True)
 
@@ -464,34 +780,12 @@ class RepulsionLoss(SurfaceLoss):
                 handle = points_padded.register_hook(save_grad())
                 self.hooks.append(handle)
 
-        with torch.autograd.no_grad():
-            spatial_w = self.get_spatial_w(point_clouds, **kwargs)
-            # set far neighbors' spatial_w to 0
-            normal_w = self.get_normal_w(point_clouds, **kwargs)
-            density_w = torch.sum(spatial_w, dim=-1, keepdim=True) + 1.0
-            weights = spatial_w * normal_w
-
-        # convert everything to packed
-        weights = ops.padded_to_packed(
-            weights, point_clouds.cloud_to_packed_first_idx(), P_total)
-        pts_diff_proj = ops.padded_to_packed(
-            pts_diff_proj.contiguous().view(pts_diff_proj.shape[0], pts_diff_proj.shape[1], -1), point_clouds.cloud_to_packed_first_idx(), P_total).view(P_total, -1, 3)
-        density_w = ops.padded_to_packed(
-            density_w, point_clouds.cloud_to_packed_first_idx(), P_total)
-
-        # we want to maximize this, so negative sign
-        repel_vec = torch.sum(
-            pts_diff_proj * weights.unsqueeze(-1), dim=1) / eps_denom(torch.sum(weights, dim=1).unsqueeze(-1))
-        repel_vec = repel_vec * density_w
-
-        loss = torch.exp(-repel_vec.abs())
-
-        # if get_debugging_mode():
-        #     # save to dbg folder as normal
-        #     from ..utils.io import save_ply
-        #     save_ply('./dbg_repel_diff.ply', point_clouds.points_packed().cpu().detach(), normals=repel_vec.cpu().detach())
-
+        # (N, maxP, 3), evaluated in blocks of points if chunk_size > 0
+        loss = self._evaluate_in_chunks(chunk_loss, points_padded)
 
+        # convert to packed
+        loss = ops.padded_to_packed(
+            loss, point_clouds.cloud_to_packed_first_idx(), P_total)
         return loss
 
 
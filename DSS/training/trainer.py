@@ -15,6 +15,8 @@ from pytorch3d.renderer.cameras import FoVPerspectiveCameras
 from pytorch3d.loss import chamfer_distance
 from .. import set_debugging_mode_, get_debugging_tensor, logger_py
 from ..utils import slice_dict, check_weights
+from ..utils.profiling import (profile_stage, set_profiling_mode_, get_profiling_mode,
+                               get_profiling_stats, dump_profiling_stats, dump_chrome_trace)
 from ..utils.mathHelper import decompose_to_R_and_t
 from ..training.losses import (
     IouLoss, ProjectionLoss, RepulsionLoss,
@@ -132,15 +134,22 @@ class Trainer(BaseTrainer):
         self.scheduler = scheduler
 
         self.projection_loss = ProjectionLoss(
-            reduction='mean', filter_scale=2.0, knn_k=12)
+            reduction='mean', filter_scale=2.0, knn_k=12, knn_skin=self.cfg.get('knn_skin', 8),
+            chunk_size=self.cfg.get('surface_loss_chunk_size', 0),
+            fused=self.cfg.get('fused_projection_loss', False))
         self.repulsion_loss = RepulsionLoss(
-            reduction='mean', filter_scale=2.0, knn_k=12)
+            reduction='mean', filter_scale=2.0, knn_k=12, knn_skin=self.cfg.get('knn_skin', 8),
+            chunk_size=self.cfg.get('surface_loss_chunk_size', 0))
         self.iou_loss = IouLoss(
             reduction='mean', channel_dim=None)
         self.l1_loss = L1Loss(reduction='mean')
         self.l2_loss = L2Loss(reduction='mean')
         self.smape_loss = SmapeLoss(reduction='mean')
 
+        if self.cfg.get('profile', False):
+            set_profiling_mode_(True, cuda_sync=self.cfg.get('profile_cuda_sync', False))
+            logger_py.info('Enabled profiling mode.')
+
     def evaluate_3d(self, val_dataloader, it, **kwargs):
         logger_py.info("[3D Evaluation]")
         t0 = time.time()
@@ -229,14 +238,31 @@ class Trainer(BaseTrainer):
         data = self.process_data_dict(data, cameras, lights=lights)
         self.model.train()
         # autograd.set_detect_anomaly(True)
-        loss = self.compute_loss(data['img'], data['mask_img'], data['input'],
-                                 data['camera'], data['light'], it=it)
-        loss.backward()
-        self.optimizer.step()
+        with profile_stage('compute_loss'):
+            loss = self.compute_loss(data['img'], data['mask_img'], data['input'],
+                                     data['camera'], data['light'], it=it)
+        with profile_stage('backward'):
+            loss.backward()
+        with profile_stage('optimizer_step'):
+            self.optimizer.step()
         check_weights(self.model.state_dict())
 
         return loss.item()
 
+    def get_profiling_stats(self):
+        """
+        Accumulated time and memory of the profiled stages (see DSS.utils.profiling),
+        empty if profiling is disabled
+        """
+        return get_profiling_stats()
+
+    def dump_profiling(self, out_dir, prefix='profile'):
+        """ Save the profiled stages as prefix.json and the Chrome trace prefix_trace.json """
+        if not get_profiling_mode():
+            return
+        dump_profiling_stats(os.path.join(out_dir, '%s.json' % prefix))
+        dump_chrome_trace(os.path.join(out_dir, '%s_trace.json' % prefix))
+
     def process_data_dict(self, data, cameras, lights=None):
         ''' Processes the data dictionary and returns respective tensors
 
@@ -318,12 +344,20 @@ class Trainer(BaseTrainer):
         """
         loss_dr_repel = 0
         loss_dr_proj = 0
+        # the neighbors, spatial weights and denoised normals are shared by both losses
+        neighborhood = None
+        if self.lambda_dr_proj > 0 or self.lambda_dr_repel > 0:
+            with profile_stage('pcl_neighborhood'):
+                neighborhood = self.projection_loss.build_neighborhood(
+                    point_clouds, points_filter=self.model.points_filter, rebuild_knn=True)
         if self.lambda_dr_proj > 0:
             loss_dr_proj = self.projection_loss(
-                point_clouds, rebuild_knn=True, points_filter=self.model.points_filter) * self.lambda_dr_proj
+                point_clouds, points_filter=self.model.points_filter,
+                neighborhood=neighborhood) * self.lambda_dr_proj
         if self.lambda_dr_repel > 0:
             loss_dr_repel = self.repulsion_loss(
-                point_clouds, rebuild_knn=True, points_filter=self.model.points_filter) * self.lambda_dr_repel
+                point_clouds, points_filter=self.model.points_filter,
+                neighborhood=neighborhood) * self.lambda_dr_repel
 
         loss['loss'] = loss_dr_proj + loss_dr_repel + loss['loss']
         loss['loss_dr_proj'] = loss_dr_proj
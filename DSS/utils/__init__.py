@@ -30,12 +30,23 @@ def num_points_2_cloud_to_packed_first_idx(num_points):
     return cloud_to_packed_first_idx[:-1]
 
 
-def num_points_2_packed_to_cloud_idx(num_points):
+def num_points_2_packed_to_cloud_idx(num_points, num_packed=None):
+    """
+    Args:
+        num_points (N,)
+        num_packed (int): total number of points, if given the output size
+            does not need to be computed from num_points (synchronization)
+    """
     batch_size = len(num_points)
-    packed_to_cloud = torch.repeat_interleave(
-        torch.arange(batch_size, device=num_points.device),
-        num_points,
-        dim=0)
+    if num_packed is None:
+        return torch.repeat_interleave(
+            torch.arange(batch_size, device=num_points.device), num_points, dim=0)
+    # the cloud of a point is the number of clouds starting at or before it
+    # minus one (empty clouds start at the same index as the next cloud)
+    first_idx = num_points_2_cloud_to_packed_first_idx(num_points)
+    cloud_starts = torch.zeros(num_packed + 1, dtype=torch.long, device=num_points.device)
+    cloud_starts.scatter_add_(0, first_idx.clamp(max=num_packed), torch.ones_like(first_idx))
+    packed_to_cloud = torch.cumsum(cloud_starts[:num_packed], dim=0) - 1
     return packed_to_cloud
 
 
@@ -324,20 +335,21 @@ def get_per_point_visibility_mask(pointclouds: Pointclouds,
     Returns:
         boolean mask for packed tensors (P_total,)
     """
-    P_total = pointclouds.num_points_per_cloud().sum().item()
+    P_total = pointclouds.points_packed().shape[0]
     try:
         mask = fragments.occupancy.bool()  # float
     except:
         mask = fragments.idx[..., 0] >= 0  # bool
 
-    pts_visibility = torch.full(
-        (P_total,), False, dtype=torch.bool, device=pointclouds.device)
-
-    # all rendered points (indices in packed points)
-    visible_idx = fragments.idx[mask].unique().long().view(-1)
-    visible_idx = visible_idx[visible_idx >= 0]
-    pts_visibility[visible_idx] = True
-    return pts_visibility
+    # scatter the rendered points (indices in packed points) shifted by one,
+    # the empty slots and the pixels outside the mask go to the dummy index 0,
+    # which avoids the host synchronization of masking and unique
+    idx = fragments.idx.long()
+    idx = torch.where((idx >= 0) & mask.unsqueeze(-1), idx + 1, torch.zeros_like(idx))
+    pts_visibility = torch.zeros(
+        (P_total + 1,), dtype=torch.bool, device=pointclouds.device)
+    pts_visibility.scatter_(0, idx.view(-1), True)
+    return pts_visibility[1:]
 
 
 def intersection_with_unit_cube(ray0, ray_direction, side_length=1.0, padding=0.1,
@@ -183,3 +183,27 @@ def to_homogen(x, dim=-1):
     x_homogen = x.new_ones(new_shp)
     x_homogen = torch.cat([x, x_homogen], dim=dim)
     return x_homogen
+
+
+def orthonormal_basis(normals):
+    """
+    Deterministic, branchless tangent frame of unit normals, see
+    Duff et al. "Building an Orthonormal Basis, Revisited" (2017)
+    Args:
+        normals (tensor): (..., 3) unit normals
+    Returns:
+        tangents (tensor): (..., 2, 3) two unit vectors perpendicular to
+            the normals and each other
+    """
+    nx, ny, nz = normals.unbind(dim=-1)
+    sign = torch.where(nz >= 0, torch.ones_like(nz), -torch.ones_like(nz))
+    a = -1.0 / (sign + nz)
+    b = nx * ny * a
+    tangents = normals.new_empty(normals.shape[:-1] + (2, 3))
+    tangents[..., 0, 0] = 1.0 + sign * nx * nx * a
+    tangents[..., 0, 1] = sign * b
+    tangents[..., 0, 2] = -sign * nx
+    tangents[..., 1, 0] = b
+    tangents[..., 1, 1] = sign + ny * ny * a
+    tangents[..., 1, 2] = -ny
+    return tangents
@@ -0,0 +1,172 @@
+"""
+Opt-in per-stage profiling of the rendering pipeline.
+
+A stage is marked with the profile_stage(name) context (or the profiled(name)
+decorator). When profiling is enabled, the stage is a named
+torch.autograd.profiler.record_function range, so that it shows up in the
+pytorch profiler, and its wall time and cuda memory are accumulated in a
+registry which can be queried with get_profiling_stats() or dumped as JSON or
+as a Chrome trace (chrome://tracing). When profiling is disabled, profile_stage
+returns a shared no-op context, so the stages can stay in the code.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import torch
+
+__all__ = ['set_profiling_mode_', 'get_profiling_mode', 'profile_stage', 'profiled',
+           'get_profiling_stats', 'reset_profiling_stats_',
+           'dump_profiling_stats', 'dump_chrome_trace']
+
+_profiling = False
+# synchronize cuda at the stage boundaries, otherwise only the time to
+# launch the kernels of a stage is measured
+_cuda_sync = False
+_stats = OrderedDict()
+_trace_events = deque(maxlen=100000)
+_lock = threading.Lock()
+
+
+class _NullStage(object):
+    """ Context of a stage when profiling is disabled """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class _StageStats(object):
+    __slots__ = ['count', 'total_time', 'max_time', 'max_memory_delta']
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.max_memory_delta = 0
+
+    def as_dict(self):
+        return OrderedDict([('count', self.count),
+                            ('total_time', self.total_time),
+                            ('mean_time', self.total_time / max(self.count, 1)),
+                            ('max_time', self.max_time),
+                            ('max_memory_delta', self.max_memory_delta)])
+
+
+class _Stage(object):
+    """ Context of a stage when profiling is enabled """
+
+    def __init__(self, name):
+        self.name = name
+        self._record = torch.autograd.profiler.record_function(name)
+        self._cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+
+    def __enter__(self):
+        self._record.__enter__()
+        if self._cuda:
+            if _cuda_sync:
+                torch.cuda.synchronize()
+            self._memory = torch.cuda.memory_allocated()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        memory_delta = 0
+        if self._cuda:
+            if _cuda_sync:
+                torch.cuda.synchronize()
+            memory_delta = torch.cuda.memory_allocated() - self._memory
+        duration = time.perf_counter() - self._start
+        self._record.__exit__(*args)
+
+        with _lock:
+            stats = _stats.get(self.name)
+            if stats is None:
+                stats = _stats[self.name] = _StageStats()
+            stats.count += 1
+            stats.total_time += duration
+            stats.max_time = max(stats.max_time, duration)
+            stats.max_memory_delta = max(stats.max_memory_delta, memory_delta)
+            _trace_events.append({'name': self.name, 'ph': 'X',
+                                  'ts': self._start * 1e6, 'dur': duration * 1e6,
+                                  'pid': os.getpid(), 'tid': threading.get_ident()})
+        return False
+
+
+def set_profiling_mode_(is_profiling, cuda_sync=False, max_trace_events=100000):
+    """
+    Args:
+        is_profiling (bool): enable the profiling of the stages
+        cuda_sync (bool): synchronize cuda at the beginning and the end of the
+            stages to measure the execution instead of the launch time
+        max_trace_events (int): number of the most recent stages kept for
+            the Chrome trace
+    """
+    global _profiling, _cuda_sync, _trace_events
+    _profiling = is_profiling
+    _cuda_sync = cuda_sync
+    with _lock:
+        if _trace_events.maxlen != max_trace_events:
+            _trace_events = deque(_trace_events, maxlen=max_trace_events)
+
+
+def get_profiling_mode():
+    return _profiling
+
+
+def profile_stage(name):
+    """ Context manager profiling the enclosed code as the stage name """
+    if not _profiling:
+        return _null_stage
+    return _Stage(name)
+
+
+def profiled(name):
+    """ Decorator profiling a function as the stage name """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _profiling:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_profiling_stats():
+    """
+    Returns:
+        OrderedDict {stage name: {count, total_time, mean_time, max_time,
+            max_memory_delta}}, times in seconds and memory in bytes
+    """
+    with _lock:
+        return OrderedDict((k, v.as_dict()) for k, v in _stats.items())
+
+
+def reset_profiling_stats_():
+    with _lock:
+        _stats.clear()
+        _trace_events.clear()
+
+
+def dump_profiling_stats(filename):
+    """ Save the accumulated stage statistics as JSON """
+    with open(filename, 'w') as f:
+        json.dump(get_profiling_stats(), f, indent=2)
+
+
+def dump_chrome_trace(filename):
+    """ Save the most recent stages in the Chrome trace event format """
+    with _lock:
+        events = list(_trace_events)
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -258,5 +258,6 @@ def create_renderer(render_opt):
         rasterizer=Raster(
             cameras=FoVPerspectiveCameras(), raster_settings=raster_settings),
         compositor=compositor,
+        fused=render_opt.get('fused', False),
     )
     return renderer
@@ -0,0 +1,421 @@
+"""
+Benchmark the splatting rasterizer and save the results as a JSON baseline.
+
+Every case of the grid (workload x num_points x image_size x points_per_pixel
+x bin_size) is run in a fresh process so that the reported peak memory
+belongs to that case only. The bin sizes are 0 (naive rasterization), auto
+(selected by _select_bin_size as the renderer does by default) or an explicit
+number of pixels. Two stages are measured:
+    kernels: the forward rasterization (_C.splat_points or the coarse-to-fine
+        kernels), the occupancy backward (_C._splat_points_occ_backward or the
+        binned backward reusing the bins of the forward pass) and the depth
+        backward (_C._backward_zbuf) on screen space splats built directly
+        from the points, without camera and splat size computations
+    renderer: forward and backward of SurfaceSplattingRenderer
+Workloads are the point clouds in example_data/pointclouds and uniform random
+clouds (random_<num_points>).
+
+Usage:
+    python scripts/benchmark_rasterizer.py --output baseline.json
+    python scripts/benchmark_rasterizer.py --workloads random --num_points 100000 \
+        --image_size 256 --points_per_pixel 8 --compare baseline.json
+    python scripts/benchmark_rasterizer.py --workloads random --bin_size 0 auto 16 32 64
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from collections import OrderedDict
+from glob import glob
+from itertools import product
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+DEFAULT_SHAPES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'example_data', 'pointclouds')
+TIMED_KEYS = ['forward', 'occ_backward', 'zbuf_backward', 'backward']
+
+
+def get_shape_paths(source):
+    if os.path.isdir(source):
+        return sorted(glob(os.path.join(source, '*.ply')))
+    return sorted(glob(source))
+
+
+def load_points(workload, num_points, seed=0):
+    """
+    Args:
+        workload: path to a ply file or 'random'
+        num_points: number of points of the random clouds, ignored for the
+            ply files
+    Returns:
+        points (P, 3) normalized into the unit sphere, normals (P, 3)
+    """
+    rng = np.random.RandomState(seed)
+    if workload == 'random':
+        points = rng.uniform(-1, 1, (num_points, 3))
+        normals = rng.normal(size=(num_points, 3))
+    else:
+        from DSS.utils.io import read_ply
+        data = read_ply(workload)
+        points = data[:, :3]
+        if data.shape[1] >= 6:
+            normals = data[:, 3:6]
+        else:
+            normals = rng.normal(size=points.shape)
+    points = points - points.mean(axis=0)
+    points = points / np.linalg.norm(points, axis=-1).max()
+    normals = normals / np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-8)
+    return (torch.from_numpy(points).float().contiguous(),
+            torch.from_numpy(normals).float().contiguous())
+
+
+def make_screen_splats(points, image_size, splat_scale, device):
+    """
+    Orthographic projection of the points into NDC with isotropic splats
+    covering the point spacing of a surface sampled with P points.
+    """
+    from DSS.core.rasterizer import _ellipse_splat_params
+    P = points.shape[0]
+    H, W = image_size
+    pts_screen = points.clone()
+    pts_screen[:, :2] *= 0.9
+    pts_screen[:, 2] += 2.0
+    # at least one pixel wide
+    radius = max(splat_scale * 2.0 / np.sqrt(P), 2.0 / min(H, W))
+    variance = torch.zeros(P, 2, 2)
+    variance[:, 0, 0] = variance[:, 1, 1] = radius ** 2
+    detMk = torch.ones(P)
+    radii, ellipse_params, cutoff_threshold, _ = _ellipse_splat_params(
+        variance, detMk, 1.0)
+    num_points_per_cloud = torch.tensor([P], dtype=torch.long)
+    first_idx = torch.tensor([0], dtype=torch.long)
+    return [x.to(device=device).contiguous() for x in
+            (pts_screen, ellipse_params, cutoff_threshold.view(-1), radii,
+             first_idx, num_points_per_cloud)]
+
+
+def time_function(func, warmup, repeat, device):
+    """ Returns the output of the last call and the wall times in seconds """
+    for _ in range(warmup):
+        out = func()
+    times = []
+    for _ in range(repeat):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = func()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return out, times
+
+
+def bench_kernels(case, opt, device):
+    from DSS import _C
+    from DSS.core.rasterizer import _select_bin_size, _splat_points_occ_fast_backward
+    image_size = (case['image_size'], case['image_size'])
+    K = case['points_per_pixel']
+    points, _ = load_points(case['workload'], case['num_points'], opt.seed)
+    pts_screen, ellipse_params, cutoff_threshold, radii, first_idx, num_points_per_cloud = \
+        make_screen_splats(points, image_size, opt.splat_scale, device)
+
+    bin_size, max_points_per_bin = case['bin_size'], None
+    if bin_size is None:
+        bin_size, max_points_per_bin = _select_bin_size(
+            pts_screen, radii, num_points_per_cloud, image_size)
+    if max_points_per_bin is None:
+        # the same default as rasterize_elliptical_points
+        max_points_per_bin = int(max(10000, pts_screen.shape[0]))
+
+    def forward():
+        bin_points, bin_offsets = None, None
+        if bin_size == 0:
+            outputs = _C.splat_points(
+                pts_screen, ellipse_params, cutoff_threshold, radii, first_idx,
+                num_points_per_cloud, opt.depth_merging_threshold, image_size, K,
+                0, 0)
+        elif device.type == 'cuda':
+            bin_points = _C._rasterize_coarse(
+                pts_screen, radii, first_idx, num_points_per_cloud,
+                image_size, bin_size, max_points_per_bin)
+            outputs = _C._rasterize_fine(
+                pts_screen, ellipse_params, cutoff_threshold, radii, bin_points,
+                opt.depth_merging_threshold, image_size, bin_size, K)
+        else:
+            bin_points, bin_offsets = _C._rasterize_coarse_csr(
+                pts_screen, radii, first_idx, num_points_per_cloud,
+                image_size, bin_size)
+            outputs = _C._rasterize_fine_csr(
+                pts_screen, ellipse_params, cutoff_threshold, radii, bin_points,
+                bin_offsets, opt.depth_merging_threshold, image_size, bin_size, K)
+        return outputs, bin_points, bin_offsets
+
+    result = OrderedDict()
+    result['effective_bin_size'] = bin_size
+    (outputs, bin_points, bin_offsets), result['forward'] = time_function(
+        forward, opt.warmup, opt.repeat, device)
+    idx, zbuf, _, occ_map = outputs
+
+    # a sparse occupancy gradient, as the one of a silhouette loss
+    generator = torch.Generator().manual_seed(opt.seed)
+    occ_grad = torch.randn(occ_map.shape, generator=generator)
+    occ_grad *= (torch.rand(occ_map.shape, generator=generator) < opt.grad_density).float()
+    occ_grad = occ_grad.to(device)
+    P = pts_screen.shape[0]
+    pts_visibility = pts_screen.new_zeros(P + 1, dtype=torch.bool).index_fill_(
+        0, idx.view(-1).long() + 1, True)[1:]
+    result['visible_points'] = int(pts_visibility.sum())
+
+    if bin_size == 0:
+        num_visible = pts_visibility.sum().view(1)
+        pts_visible, radii_visible = pts_screen[pts_visibility], radii[pts_visibility]
+
+        def occ_backward():
+            return _C._splat_points_occ_backward(
+                pts_visible, radii_visible, occ_grad, torch.zeros_like(num_visible),
+                num_visible, opt.radii_backward_scaler, opt.depth_merging_threshold)
+    else:
+        def occ_backward():
+            return _splat_points_occ_fast_backward(
+                pts_screen, radii, pts_visibility, occ_grad, first_idx,
+                num_points_per_cloud, opt.radii_backward_scaler,
+                bin_points, bin_offsets, bin_size)
+    _, result['occ_backward'] = time_function(occ_backward, opt.warmup, opt.repeat, device)
+
+    zbuf_grad = torch.randn(zbuf.shape, generator=generator).to(device)
+
+    def zbuf_backward():
+        grads_z = pts_screen.new_zeros(P, 1)
+        _C._backward_zbuf(idx, zbuf_grad, grads_z)
+        return grads_z
+    _, result['zbuf_backward'] = time_function(zbuf_backward, opt.warmup, opt.repeat, device)
+    return result
+
+
+def bench_renderer(case, opt, device):
+    from pytorch3d.renderer import FoVPerspectiveCameras, look_at_view_transform
+    from DSS.core.cloud import PointClouds3D
+    from DSS.core.compositing import NormWeightedCompositor
+    from DSS.core.rasterizer import PointsRasterizationSettings, SurfaceSplatting
+    from DSS.core.renderer import SurfaceSplattingRenderer
+
+    points, normals = load_points(case['workload'], case['num_points'], opt.seed)
+    points, normals = points.to(device), normals.to(device)
+    colors = torch.rand_like(points)
+    R, T = look_at_view_transform(dist=2.5, elev=20, azim=30)
+    cameras = FoVPerspectiveCameras(R=R, T=T, device=device)
+    raster_settings = PointsRasterizationSettings(
+        image_size=case['image_size'], points_per_pixel=case['points_per_pixel'],
+        bin_size=case['bin_size'],
+        cutoff_threshold=opt.cutoff_threshold,
+        depth_merging_threshold=opt.depth_merging_threshold,
+        radii_backward_scaler=opt.radii_backward_scaler,
+        backface_culling=False)
+    renderer = SurfaceSplattingRenderer(
+        rasterizer=SurfaceSplatting(cameras=cameras, raster_settings=raster_settings),
+        compositor=NormWeightedCompositor()).to(device)
+
+    target = torch.rand(1, case['image_size'], case['image_size'], 4, device=device)
+    points = points.requires_grad_(True)
+    normals = normals.requires_grad_(True)
+
+    def forward():
+        pointclouds = PointClouds3D([points], normals=[normals], features=[colors])
+        return renderer(pointclouds, cameras=cameras)
+
+    result = OrderedDict()
+    images, result['forward'] = time_function(
+        lambda: forward().detach(), opt.warmup, opt.repeat, device)
+
+    def forward_backward():
+        loss = torch.nn.functional.mse_loss(forward(), target)
+        loss.backward()
+        return loss
+    _, forward_backward_times = time_function(
+        forward_backward, opt.warmup, opt.repeat, device)
+    result['backward'] = [max(t - f, 0.0) for t, f in
+                          zip(forward_backward_times, result['forward'])]
+    result['visible_points'] = int(points.grad.abs().sum(-1).gt(0).sum())
+    return result
+
+
+def run_case(case, opt):
+    """ Run a case (in its own process) and attach the timings and memory """
+    device = torch.device(opt.device)
+    torch.set_num_threads(opt.num_threads)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    bench = bench_kernels if case['stage'] == 'kernels' else bench_renderer
+    result = bench(case, opt, device)
+    # ru_maxrss is in KB on linux and in bytes on macOS
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit / 2 ** 20
+    result['rss_start_mb'] = rss_start * rss_unit / 2 ** 20
+    if device.type == 'cuda':
+        result['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+
+    num_points = case['num_points']
+    for key in TIMED_KEYS:
+        if key in result:
+            times = result.pop(key)
+            result[key] = OrderedDict([('median', float(np.median(times))),
+                                       ('min', float(np.min(times))),
+                                       ('points_per_s', num_points / max(float(np.median(times)), 1e-12))])
+    case.update(result)
+    return case
+
+
+def _run_case_star(args):
+    return run_case(*args)
+
+
+def build_cases(opt):
+    workloads = []
+    for workload in opt.workloads:
+        if workload == 'shapes':
+            for path in get_shape_paths(opt.shapes):
+                workloads.append((os.path.splitext(os.path.basename(path))[0], path,
+                                  load_points(path, 0)[0].shape[0]))
+        elif workload == 'random':
+            for num_points in opt.num_points:
+                workloads.append(('random_%d' % num_points, 'random', num_points))
+        else:
+            workloads.append((os.path.splitext(os.path.basename(workload))[0], workload,
+                              load_points(workload, 0)[0].shape[0]))
+
+    cases = []
+    for (name, workload, num_points), stage, S, K, bin_size in product(
+            workloads, opt.stages, opt.image_size, opt.points_per_pixel, opt.bin_size):
+        case = OrderedDict([('name', name), ('workload', workload),
+                            ('num_points', num_points), ('stage', stage),
+                            ('image_size', S), ('points_per_pixel', K),
+                            ('bin_size', bin_size)])
+        # the naive kernels test every point against every pixel
+        if bin_size == 0 and num_points * S * S > opt.max_naive_work:
+            case['skipped'] = 'naive work %.1e > --max_naive_work' % (num_points * S * S)
+        cases.append(case)
+    return cases
+
+
+def case_key(case):
+    bin_size = 'auto' if case['bin_size'] is None else case['bin_size']
+    return '{}/{}/S{}/K{}/B{}'.format(case['name'], case['stage'], case['image_size'],
+                                      case['points_per_pixel'], bin_size)
+
+
+def parse_bin_size(value):
+    """ 'auto' (or 'none') for the automatic selection, otherwise an int """
+    if value.lower() in ('auto', 'none'):
+        return None
+    bin_size = int(value)
+    if bin_size < 0:
+        raise argparse.ArgumentTypeError('bin_size must be >= 0, got %d' % bin_size)
+    return bin_size
+
+
+def compare(results, baseline, tolerance):
+    """ Print the speedup w.r.t. a previous baseline, returns the regressions """
+    previous = {case_key(c): c for c in baseline['results']}
+    regressions = []
+    for case in results:
+        old = previous.get(case_key(case))
+        if old is None or 'skipped' in case or 'skipped' in old:
+            continue
+        for key in TIMED_KEYS:
+            if key not in case or key not in old:
+                continue
+            ratio = old[key]['median'] / max(case[key]['median'], 1e-12)
+            flag = ''
+            if ratio < 1.0 / (1.0 + tolerance):
+                flag = ' REGRESSION'
+                regressions.append((case_key(case), key, ratio))
+            print('{:<60s} {:<14s} {:6.2f}x{}'.format(case_key(case), key, ratio, flag))
+    return regressions
+
+
+parser = argparse.ArgumentParser(description='Benchmark the splatting rasterizer.')
+parser.add_argument('--workloads', type=str, nargs='+', default=['shapes', 'random'],
+                    help="'shapes' (all ply files of --shapes), 'random' or paths to ply files")
+parser.add_argument('--shapes', type=str, default=DEFAULT_SHAPES,
+                    help='directory or glob pattern of the ply files')
+parser.add_argument('--num_points', type=int, nargs='+',
+                    default=[10000, 100000, 500000, 2000000],
+                    help='number of points of the random clouds')
+parser.add_argument('--image_size', type=int, nargs='+', default=[128, 256, 512, 1024])
+parser.add_argument('--points_per_pixel', type=int, nargs='+', default=[1, 4, 8, 16])
+parser.add_argument('--bin_size', type=parse_bin_size, nargs='+', default=[0, None],
+                    help="0 (naive), auto (selected automatically) or bin sizes in pixels")
+parser.add_argument('--stages', type=str, nargs='+', default=['kernels', 'renderer'],
+                    choices=['kernels', 'renderer'])
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--num_threads', type=int, default=torch.get_num_threads())
+parser.add_argument('--warmup', type=int, default=1)
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--splat_scale', type=float, default=2.0,
+                    help='splat radius in units of the point spacing')
+parser.add_argument('--grad_density', type=float, default=0.1,
+                    help='fraction of pixels with a non-zero occupancy gradient')
+parser.add_argument('--cutoff_threshold', type=float, default=1.0)
+parser.add_argument('--depth_merging_threshold', type=float, default=0.05)
+parser.add_argument('--radii_backward_scaler', type=float, default=10.0)
+parser.add_argument('--max_naive_work', type=float, default=2e10,
+                    help='skip the naive cases with more num_points * pixels')
+parser.add_argument('--no_isolate', action='store_true',
+                    help='run all cases in this process, the peak memory is then cumulative')
+parser.add_argument('--output', type=str, default='rasterizer_benchmark.json')
+parser.add_argument('--compare', type=str, default=None,
+                    help='baseline JSON to compare the timings with')
+parser.add_argument('--tolerance', type=float, default=0.1,
+                    help='slowdown w.r.t. --compare reported as regression')
+
+
+if __name__ == '__main__':
+    opt = parser.parse_args()
+    cases = build_cases(opt)
+    print('Running {} cases'.format(sum('skipped' not in c for c in cases)))
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for case in cases:
+        if 'skipped' not in case:
+            if opt.no_isolate:
+                case = run_case(case, opt)
+            else:
+                with context.Pool(1) as pool:
+                    case = pool.map(_run_case_star, [(case, opt)])[0]
+        results.append(case)
+        if 'skipped' in case:
+            print('{:<60s} skipped: {}'.format(case_key(case), case['skipped']))
+        else:
+            print('{:<60s} '.format(case_key(case)) + ' '.join(
+                '{} {:.4f}s'.format(key, case[key]['median']) for key in TIMED_KEYS if key in case) +
+                ' peak {:.0f}MB'.format(case['peak_rss_mb']))
+
+    meta = OrderedDict([('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+                        ('torch', torch.__version__),
+                        ('device', opt.device),
+                        ('num_threads', opt.num_threads),
+                        ('processor', platform.processor() or platform.machine()),
+                        ('platform', platform.platform()),
+                        ('options', vars(opt))])
+    with open(opt.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print('Saved to {}'.format(opt.output))
+
+    if opt.compare is not None:
+        with open(opt.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, opt.tolerance)
+        if len(regressions) > 0:
+            print('{} regressions'.format(len(regressions)))
+            sys.exit(1)
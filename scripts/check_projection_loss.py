@@ -0,0 +1,97 @@
+"""
+Check that the fused native projection loss (ProjectionLoss(fused=True))
+matches the PyTorch implementation (fused=False) on random point clouds,
+both the per-point loss and the gradient w.r.t. the points. Two cases are
+checked: a batch of clouds with one visibility row each, and the first cloud
+alone seen from --num_views views, i.e. with one visibility row per view.
+Exits with 1 if the relative difference of either exceeds the tolerance.
+
+Usage:
+    python scripts/check_projection_loss.py
+    python scripts/check_projection_loss.py --device cuda --num_points 20000 15000
+"""
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from DSS.core.cloud import PointClouds3D, PointCloudsFilters
+from DSS.training.losses import ProjectionLoss
+
+
+def random_clouds(num_points, device, seed=0, num_views=None):
+    """
+    Returns:
+        points and normals lists of the clouds, (N, max_P) random visibility,
+        or (num_views, max_P) if num_views is given
+    """
+    generator = torch.Generator().manual_seed(seed)
+    points = [torch.rand(n, 3, generator=generator).to(device) * 2 - 1 for n in num_points]
+    normals = [torch.nn.functional.normalize(torch.randn(n, 3, generator=generator), dim=-1).to(device)
+               for n in num_points]
+    num_rows = len(num_points) if num_views is None else num_views
+    visibility = (torch.rand(num_rows, max(num_points), generator=generator) > 0.3).to(device)
+    return points, normals, visibility
+
+
+def compute(fused, points, normals, visibility, args):
+    """
+    Returns:
+        loss (P,), gradient (P, 3) of the weighted sum of the loss w.r.t. the packed points
+    """
+    points = [p.clone().requires_grad_(True) for p in points]
+    point_clouds = PointClouds3D(points, normals=normals)
+    points_filter = PointCloudsFilters(device=visibility.device, visibility=visibility)
+    loss_fn = ProjectionLoss(reduction='none', knn_k=args.knn_k, filter_scale=2.0,
+                             sharpness_sigma=args.sharpness_sigma,
+                             chunk_size=args.chunk_size, fused=fused)
+    loss = loss_fn(point_clouds, points_filter=points_filter, rebuild_knn=True)
+    # a non-uniform upstream gradient
+    weights = torch.linspace(0.5, 2.0, loss.shape[0], device=loss.device)
+    (loss * weights).sum().backward()
+    return loss.detach(), torch.cat([p.grad for p in points])
+
+
+def relative_error(x, reference):
+    return ((x - reference).abs().max() / reference.abs().max().clamp(min=1e-12)).item()
+
+
+parser = argparse.ArgumentParser(description='Compare the fused and the PyTorch projection loss.')
+parser.add_argument('--num_points', type=int, nargs='+', default=[3000, 2000],
+                    help='number of points of each cloud of the batch')
+parser.add_argument('--knn_k', type=int, default=12)
+parser.add_argument('--sharpness_sigma', type=float, default=0.75)
+parser.add_argument('--num_views', type=int, default=3,
+                    help='number of views of the single cloud case')
+parser.add_argument('--chunk_size', type=int, default=0)
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--tolerance', type=float, default=1e-4,
+                    help='maximum relative difference of the loss and the gradient')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    cases = [('batch', args.num_points, None),
+             ('views', args.num_points[:1], args.num_views)]
+
+    failed = False
+    for name, num_points, num_views in cases:
+        points, normals, visibility = random_clouds(num_points, device, args.seed, num_views)
+
+        loss, grad = compute(False, points, normals, visibility, args)
+        fused_loss, fused_grad = compute(True, points, normals, visibility, args)
+
+        loss_error = relative_error(fused_loss, loss)
+        grad_error = relative_error(fused_grad, grad)
+        print('{}: loss max relative difference {:.3e}'.format(name, loss_error))
+        print('{}: grad max relative difference {:.3e}'.format(name, grad_error))
+        if max(loss_error, grad_error) > args.tolerance:
+            print('{}: fused projection loss differs by more than {}'.format(name, args.tolerance))
+            failed = True
+    if failed:
+        sys.exit(1)
+    print('ok')
@@ -40,6 +40,8 @@ ext_modules = [
     CppExtension('DSS._C', [
         'DSS/csrc/ext.cpp',
         'DSS/csrc/rasterize_points_cpu.cpp',
+        'DSS/csrc/weighted_sum_cpu.cpp',
+        'DSS/csrc/projection_loss_cpu.cpp',
     ])
 ]
 include_dirs = torch.utils.cpp_extension.include_paths()
@@ -49,6 +51,10 @@ ext_modules += [
         'DSS/csrc/rasterize_points.cu',
         'DSS/csrc/rasterize_points_backward.cu',
         'DSS/csrc/rasterize_points_cpu.cpp',
+        'DSS/csrc/weighted_sum.cu',
+        'DSS/csrc/projection_loss.cu',
+        'DSS/csrc/weighted_sum_cpu.cpp',
+        'DSS/csrc/projection_loss_cpu.cpp',
     ],
         include_dirs=['DSS/csrc'],
         define_macros=define_macros,
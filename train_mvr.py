@@ -186,6 +186,7 @@ while True:
             print('Saving checkpoint')
             checkpoint_io.save('model.pt', epoch_it=epoch_it, it=it,
                                loss_val_best=metric_val_best)
+            trainer.dump_profiling(out_dir)
 
         # Backup if necessary
         if it > 0 and (backup_every > 0 and (it % backup_every) == 0):